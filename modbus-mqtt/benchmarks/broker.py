@@ -0,0 +1,155 @@
+import asyncio
+import struct
+import threading
+import time
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for idx, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if idx >= len(topic_levels) or (level != "+" and level != topic_levels[idx]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length > 0 else byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    data = value.encode("utf-8")
+    return struct.pack(">H", len(data)) + data
+
+
+def publish_packet(topic, payload, retain=False):
+    body = encode_string(topic) + payload
+    return bytes([0x30 | (1 if retain else 0)]) + encode_length(len(body)) + body
+
+
+class Broker(object):
+    '''
+    MQTT 3.1.1 stand-in for benchmarks: accepts any client, keeps subscriptions and
+    retained messages and forwards publishes (delivered with qos 0). Every publish
+    received from a client is passed to 'on_message(topic, payload, timestamp)' with
+    a 'time.perf_counter' timestamp, 'publish' sends a message to the subscribers.
+    '''
+
+    def __init__(self, host="127.0.0.1", port=0, on_message=None):
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.clients = {}
+        self.retained = {}
+        self.messages = 0
+        self.loop = None
+        self.thread = None
+
+    async def read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F)*multiplier
+            multiplier *= 128
+            if byte & 0x80 == 0:
+                break
+        return header, await reader.readexactly(length)
+
+    def deliver(self, topic, payload, retain=False):
+        for writer, filters in list(self.clients.items()):
+            if any(topic_matches(f, topic) for f in filters):
+                writer.write(publish_packet(topic, payload, retain))
+
+    async def on_client(self, reader, writer):
+        filters = set()
+        try:
+            while True:
+                header, body = await self.read_packet(reader)
+                packet_type = header >> 4
+                if packet_type == 1:
+                    # CONNECT
+                    self.clients[writer] = filters
+                    writer.write(b"\x20\x02\x00\x00")
+                elif packet_type == 3:
+                    # PUBLISH
+                    timestamp = time.perf_counter()
+                    qos = (header >> 1) & 3
+                    length = struct.unpack_from(">H", body)[0]
+                    topic = body[2:2+length].decode("utf-8")
+                    pos = 2+length
+                    if qos > 0:
+                        packet_id = body[pos:pos+2]
+                        pos += 2
+                        writer.write(b"\x40\x02" + packet_id)
+                    payload = body[pos:]
+                    self.messages += 1
+                    if header & 1:
+                        self.retained[topic] = payload
+                    if self.on_message is not None:
+                        self.on_message(topic, payload, timestamp)
+                    self.deliver(topic, payload)
+                elif packet_type == 8:
+                    # SUBSCRIBE
+                    packet_id = body[:2]
+                    pos = 2
+                    granted = bytearray()
+                    while pos < len(body):
+                        length = struct.unpack_from(">H", body, pos)[0]
+                        topic_filter = body[pos+2:pos+2+length].decode("utf-8")
+                        pos += 2+length+1
+                        filters.add(topic_filter)
+                        granted.append(0)
+                        for topic, payload in self.retained.items():
+                            if topic_matches(topic_filter, topic):
+                                writer.write(publish_packet(topic, payload, retain=True))
+                    writer.write(bytes([0x90]) + encode_length(2+len(granted)) + packet_id + bytes(granted))
+                elif packet_type == 10:
+                    # UNSUBSCRIBE
+                    packet_id = body[:2]
+                    pos = 2
+                    while pos < len(body):
+                        length = struct.unpack_from(">H", body, pos)[0]
+                        filters.discard(body[pos+2:pos+2+length].decode("utf-8"))
+                        pos += 2+length
+                    writer.write(b"\xb0\x02" + packet_id)
+                elif packet_type == 12:
+                    # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 14:
+                    # DISCONNECT
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    def publish(self, topic, payload):
+        ''' send a message to the subscribers, may be called from any thread '''
+        data = payload.encode("utf-8") if isinstance(payload, str) else payload
+        self.loop.call_soon_threadsafe(self.deliver, topic, data)
+
+    async def serve(self, started):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.on_client, self.host, self.port, reuse_address=True)
+        self.port = server.sockets[0].getsockname()[1]
+        started.set()
+        await asyncio.Event().wait()
+
+    def start(self):
+        ''' serves in a background thread, returns the port '''
+        started = threading.Event()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.serve(started)), daemon=True, name="broker")
+        self.thread.start()
+        started.wait()
+        return self.port
@@ -0,0 +1,47 @@
+import json
+import os
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+GATEWAY_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "gateway")
+
+
+def setup_environment(options=None):
+    '''
+    Makes the gateway modules importable outside of the add-on container: the
+    configuration is read from CONFIG_PATH, when it is not set the default options
+    of config.json (updated with 'options') are used.
+    '''
+    if GATEWAY_DIR not in sys.path:
+        sys.path.insert(0, GATEWAY_DIR)
+
+    if "CONFIG_PATH" not in os.environ:
+        with open(os.path.join(os.path.dirname(BENCHMARKS_DIR), "config.json")) as json_file:
+            defaults = json.load(json_file)["options"]
+        defaults.update(options or {})
+        path = os.path.join(tempfile.mkdtemp(prefix="modbus-mqtt-bench-"), "options.json")
+        with open(path, "w") as json_file:
+            json.dump(defaults, json_file)
+        os.environ["CONFIG_PATH"] = path
+
+    os.environ.setdefault("MQTT_HOST", "localhost")
+    os.environ.setdefault("MQTT_USER", "")
+    os.environ.setdefault("MQTT_PASSWORD", "")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values)-1, int(len(values)*p/100))]
+
+
+def summary(values):
+    return {
+        "count": len(values),
+        "mean": sum(values)/len(values) if len(values) > 0 else 0.0,
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "max": max(values) if len(values) > 0 else 0.0
+    }
@@ -0,0 +1,195 @@
+'''
+CPU cost of one poll on the receive side: decoding the read response PDU and
+diffing it against the previous block of the entity set, for a coil set and a
+register set. The list path is the pymodbus decoding into lists of bools/ints
+followed by the list based diff, the raw path keeps the response bytes and
+decodes them into the reusable buffer of the read request.
+
+The meter case decodes a bank of scaled float32 registers that all change on
+every poll, once per entity and once per read with the block decoder of the set.
+
+    python3 benchmarks/decode_hot_path.py --coils 80 --changes 1
+    python3 benchmarks/decode_hot_path.py --meters 60
+'''
+import argparse
+import json
+import struct
+import timeit
+from array import array
+
+from common import setup_environment
+setup_environment()
+
+from pymodbus.bit_read_message import ReadCoilsResponse
+from pymodbus.register_read_message import ReadHoldingRegistersResponse
+
+import entity
+from planner import ReadRequest, ReadSlice
+from transport import RawReadCoilsResponse, RawReadRegistersResponse
+
+
+class StubGateway(entity.GatewayInterface):
+    def mqtt_publish(self, topic, payload, retain=False, event=False):
+        pass
+
+    def mqtt_publish_discovery(self, topic, payload):
+        pass
+
+    def mqtt_remove_discovery(self, topic):
+        pass
+
+    def mqtt_subscribe(self, topic, callback):
+        pass
+
+    def mqtt_unsubscribe(self, topic):
+        pass
+
+    def modbus_write_coils(self, address, data):
+        pass
+
+    def modbus_write_registers(self, address, data):
+        pass
+
+    def call_at(self, deadline, callback):
+        pass
+
+
+class ListEntitySet(entity.EntitySet):
+    ''' the diff on lists of values as returned by pymodbus '''
+
+    def changed(self, values, offset, first, count):
+        data_size = self.modbus_class.data_size
+        start = first*data_size
+        end = start + count*data_size
+        if self.modbus_class.data_type == entity.TYPE_COIL:
+            block = bytes(values[offset:offset+end-start])
+        else:
+            block = array('H', values[offset:offset+end-start])
+
+        old = self.previous[start:end]
+        if old == block:
+            changed = []
+        elif data_size == 1:
+            changed = [first+i for i, (a, b) in enumerate(zip(old, block)) if a != b]
+        else:
+            changed = sorted({first+i//data_size for i, (a, b) in enumerate(zip(old, block)) if a != b})
+        self.previous[start:end] = block
+        return changed
+
+
+def entity_set(cls, data_type, count, data_size, defaults=None):
+    modbus_class = entity.ModbusClass("bench", data_type=data_type, data_size=data_size, defaults=defaults or {})
+    entity_type = entity.BinarySensorEntity if data_type == entity.TYPE_COIL else entity.SensorEntity
+    gateway = StubGateway()
+    entities = [entity_type(gateway, {"name": "e{}".format(idx), "component": ""}, modbus_class, idx) for idx in range(count)]
+    return cls(modbus_class, entities)
+
+
+def coil_pdus(count, changes, polls):
+    ''' response pdus without the function code, 'changes' coils toggle every poll '''
+    pdus = []
+    for poll in range(polls):
+        packed = bytearray((count+7)//8)
+        for idx in range(changes):
+            if poll % 2:
+                packed[idx >> 3] |= 1 << (idx & 7)
+        pdus.append(bytes([len(packed)]) + bytes(packed))
+    return pdus
+
+
+def register_pdus(count, changes, polls):
+    pdus = []
+    for poll in range(polls):
+        words = [poll % 2 if idx < changes else 0 for idx in range(count)]
+        pdus.append(struct.pack(">B{}H".format(count), 2*count, *words))
+    return pdus
+
+
+def bench(data_type, count, data_size, changes, number):
+    words = count*data_size
+    pdus = (coil_pdus if data_type == entity.TYPE_COIL else register_pdus)(words, changes, 2)
+    list_response = ReadCoilsResponse if data_type == entity.TYPE_COIL else ReadHoldingRegistersResponse
+    raw_response = RawReadCoilsResponse if data_type == entity.TYPE_COIL else RawReadRegistersResponse
+
+    list_set = entity_set(ListEntitySet, data_type, count, data_size)
+    raw_set = entity_set(entity.EntitySet, data_type, count, data_size)
+    request = ReadRequest(data_type, 0, words, [ReadSlice(raw_set, 0, 0, count)])
+
+    state = {"poll": 0}
+
+    def list_path():
+        response = list_response()
+        response.decode(pdus[state["poll"] % 2])
+        values = response.bits if data_type == entity.TYPE_COIL else response.registers
+        list_set.on_modbus_data(0, values, 0, 0, count)
+        state["poll"] += 1
+
+    def raw_path():
+        response = raw_response()
+        response.decode(pdus[state["poll"] % 2])
+        request.dispatch(0, response.data)
+        state["poll"] += 1
+
+    results = {}
+    for name, path in [("list", list_path), ("raw", raw_path)]:
+        state["poll"] = 0
+        path()
+        results[name] = min(timeit.repeat(path, number=number, repeat=5)) / number * 1e6
+    return results
+
+
+def bench_meters(count, number):
+    defaults = {"value_type": "float32", "word_order": "big", "scale": "0.1", "precision": "2"}
+    pdus = [struct.pack(">B{}f".format(count), 4*count, *[poll + idx*0.5 for idx in range(count)]) for poll in range(2)]
+
+    entity_sets = {
+        "per_entity": entity_set(entity.EntitySet, entity.TYPE_REGISTER, count, 2, defaults),
+        "block": entity_set(entity.EntitySet, entity.TYPE_REGISTER, count, 2, defaults)
+    }
+    # without a decoder every entity decodes its own value
+    entity_sets["per_entity"].decoder = None
+
+    results = {}
+    for name, eset in entity_sets.items():
+        request = ReadRequest(entity.TYPE_REGISTER, 0, 2*count, [ReadSlice(eset, 0, 0, count)])
+        state = {"poll": 0}
+
+        def path():
+            response = RawReadRegistersResponse()
+            response.decode(pdus[state["poll"] % 2])
+            request.dispatch(0, response.data)
+            state["poll"] += 1
+
+        path()
+        results[name] = min(timeit.repeat(path, number=number, repeat=5)) / number * 1e6
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--coils", type=int, default=80, help="entities of the coil set")
+    parser.add_argument("--registers", type=int, default=18, help="entities of the register set, two words each")
+    parser.add_argument("--meters", type=int, default=60, help="float32 entities of the meter set, all changing on every poll")
+    parser.add_argument("--changes", type=int, default=1, help="values changing on every poll")
+    parser.add_argument("--number", type=int, default=20000, help="polls per measurement")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = {
+        "coils": bench(entity.TYPE_COIL, args.coils, 1, args.changes, args.number),
+        "registers": bench(entity.TYPE_REGISTER, args.registers, 2, args.changes, args.number)
+    }
+    meters = bench_meters(args.meters, max(1, args.number//10))
+
+    if args.json:
+        results["meters"] = meters
+        print(json.dumps(results, indent=2))
+    else:
+        print("us per poll, {} changing values".format(args.changes))
+        print("{:<12}{:>10}{:>10}{:>10}".format("set", "list", "raw", "speedup"))
+        for name, r in results.items():
+            print("{:<12}{:>10.2f}{:>10.2f}{:>9.1f}x".format(name, r["list"], r["raw"], r["list"]/r["raw"]))
+        print()
+        print("us per poll, {} float32 values changing".format(args.meters))
+        print("{:<12}{:>10}{:>10}{:>10}".format("set", "entity", "block", "speedup"))
+        print("{:<12}{:>10.2f}{:>10.2f}{:>9.1f}x".format("meters", meters["per_entity"], meters["block"], meters["per_entity"]/meters["block"]))
@@ -0,0 +1,281 @@
+'''
+End to end benchmark of the gateway: a simulated PLC and an MQTT broker stand-in
+run in this process, the gateway runs as a separate process with a generated
+configuration of many entity sets, like the add-on does.
+
+Measured are the startup (until the gateway is online, until the first read and
+until every entity has published its state), the poll cycle time of every set,
+the gateway CPU time per poll cycle of the fastest set, the latency from an input
+edge in the PLC to the state message at the broker and the latency from a set
+command at the broker to the coil write arriving at the PLC.
+
+    python3 benchmarks/end_to_end.py --input-sets 20 --output-sets 10 --output results.json
+    python3 benchmarks/end_to_end.py --transport tcp-pipelined --latency-ms 2
+
+The CPU time is read from /proc and is not reported on other systems.
+'''
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from common import BENCHMARKS_DIR, GATEWAY_DIR, summary
+from broker import Broker
+from simulator import SimulatedPlc
+
+DEVICE = "plc"
+AVAILABILITY_TOPIC = "plc/{}/availability".format(DEVICE)
+
+
+def entity_sets(args):
+    ''' input (button) sets and output (relay) sets on coils, sensor sets on registers '''
+    sets = []
+    address = 0
+    for k in range(args.input_sets):
+        sets.append({
+            "set_id": "in{}".format(k),
+            "entity_type": "button",
+            "defaults": "component=",
+            "entity_count": args.coils,
+            "entities": ["name=in{}_{}".format(k, idx) for idx in range(args.coils)],
+            "data_type": "coil",
+            "read_offset": address,
+            "poll_delay_ms": args.input_poll_ms
+        })
+        address += args.coils
+    for k in range(args.output_sets):
+        sets.append({
+            "set_id": "out{}".format(k),
+            "entity_type": "relay",
+            "defaults": "component=light",
+            "entity_count": args.coils,
+            "entities": ["name=out{}_{}".format(k, idx) for idx in range(args.coils)],
+            "data_type": "coil",
+            "read_only": False,
+            "read_offset": address,
+            "write_offset": address,
+            "poll_delay_ms": args.output_poll_ms
+        })
+        address += args.coils
+    for k in range(args.register_sets):
+        sets.append({
+            "set_id": "reg{}".format(k),
+            "entity_type": "sensor",
+            "defaults": "component=sensor",
+            "entity_count": args.registers,
+            "entities": ["name=reg{}_{}".format(k, idx) for idx in range(args.registers)],
+            "data_type": "register",
+            "read_offset": k*args.registers,
+            "poll_delay_ms": args.register_poll_ms
+        })
+    return sets
+
+
+def options(args, modbus_port):
+    with open(os.path.join(os.path.dirname(BENCHMARKS_DIR), "config.json")) as json_file:
+        opts = json.load(json_file)["options"]
+    opts.update({
+        "entity_sets": [dict(eset, device=DEVICE) for eset in entity_sets(args)],
+        "catchup_rate": args.catchup_rate,
+        "discovery_rate": args.discovery_rate,
+        "devices": [{
+            "name": DEVICE,
+            "modbus_host": "127.0.0.1",
+            "modbus_port": modbus_port,
+            "transport": args.transport,
+            "availability_topic": AVAILABILITY_TOPIC
+        }]
+    })
+    return opts
+
+
+def cpu_seconds(pid):
+    ''' user and system time of a process, None where /proc is not available '''
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12]))/os.sysconf("SC_CLK_TCK")
+
+
+class Probe(object):
+    ''' timestamps of the broker messages and PLC requests, waits for the expected ones '''
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.states = set()
+        self.online = None
+        self.first_read = None
+        self.reads = {}
+        self.expect = None
+        self.seen = None
+
+    def on_message(self, topic, payload, timestamp):
+        with self.lock:
+            if topic.endswith("/state"):
+                self.states.add(topic)
+            elif topic == AVAILABILITY_TOPIC and payload == b"online" and self.online is None:
+                self.online = timestamp
+            if self.expect == ("mqtt", topic, payload):
+                self.seen = timestamp
+            self.lock.notify_all()
+
+    def on_request(self, function_code, address, timestamp):
+        with self.lock:
+            if function_code in (0x01, 0x03):
+                if self.first_read is None:
+                    self.first_read = timestamp
+                self.reads.setdefault((function_code, address), []).append(timestamp)
+            elif self.expect == ("write", address, None):
+                self.seen = timestamp
+            self.lock.notify_all()
+
+    def arm(self, *expect):
+        with self.lock:
+            self.expect = expect
+            self.seen = None
+
+    def wait(self, timeout):
+        ''' timestamp of the expected message or request, None on timeout '''
+        with self.lock:
+            self.lock.wait_for(lambda: self.seen is not None, timeout)
+            self.expect = None
+            return self.seen
+
+    def wait_for(self, predicate, timeout):
+        with self.lock:
+            return self.lock.wait_for(predicate, timeout)
+
+
+def poll_cycles(reads, since, until):
+    ''' intervals between the reads of every request, in ms '''
+    cycles = {}
+    for (function_code, address), timestamps in sorted(reads.items()):
+        timestamps = [t for t in timestamps if since <= t <= until]
+        if len(timestamps) > 1:
+            name = "{}@{}".format("coils" if function_code == 0x01 else "registers", address)
+            cycles[name] = summary([(b - a)*1000 for a, b in zip(timestamps, timestamps[1:])])
+    return cycles
+
+
+def run(args):
+    probe = Probe()
+    plc = SimulatedPlc(coils=65536, registers=65536, latency_ms=args.latency_ms)
+    plc.on_request = probe.on_request
+    modbus_port = plc.start()
+    broker = Broker(on_message=probe.on_message)
+    mqtt_port = broker.start()
+
+    opts = options(args, modbus_port)
+    entity_count = (args.input_sets + args.output_sets)*args.coils + args.register_sets*args.registers
+    data_dir = tempfile.mkdtemp(prefix="modbus-mqtt-e2e-")
+    config_path = os.path.join(data_dir, "options.json")
+    with open(config_path, "w") as json_file:
+        json.dump(opts, json_file)
+
+    env = dict(os.environ, CONFIG_PATH=config_path, MQTT_HOST="127.0.0.1", MQTT_PORT=str(mqtt_port), MQTT_USER="", MQTT_PASSWORD="")
+    start = time.perf_counter()
+    gateway = subprocess.Popen(
+        [sys.executable, os.path.join(GATEWAY_DIR, "runner.py")],
+        env=env,
+        cwd=data_dir,
+        stdout=subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL
+    )
+    results = {"entities": entity_count, "entity_sets": len(opts["entity_sets"]), "transport": args.transport}
+    try:
+        # startup
+        if not probe.wait_for(lambda: len(probe.states) >= entity_count, args.startup_timeout):
+            raise Exception("only {} of {} entities published their state within {}s".format(len(probe.states), entity_count, args.startup_timeout))
+        results["startup"] = {
+            "first_read_s": probe.first_read - start,
+            "online_s": probe.online - start if probe.online is not None else None,
+            "all_states_s": time.perf_counter() - start
+        }
+
+        # steady state polling without changes
+        window_start = time.perf_counter()
+        cpu_start = cpu_seconds(gateway.pid)
+        time.sleep(args.duration)
+        cpu_end = cpu_seconds(gateway.pid)
+        window_end = time.perf_counter()
+        with probe.lock:
+            reads = {key: list(timestamps) for key, timestamps in probe.reads.items()}
+        fastest = [t for t in reads.get((0x01, 0), []) if window_start <= t <= window_end]
+        results["poll_cycle_ms"] = poll_cycles(reads, window_start, window_end)
+        results["requests_per_s"] = sum(1 for timestamps in reads.values() for t in timestamps if t >= window_start)/(window_end - window_start)
+        if cpu_start is not None and cpu_end is not None and len(fastest) > 0:
+            results["cpu"] = {
+                "percent": (cpu_end - cpu_start)/(window_end - window_start)*100,
+                "ms_per_cycle": (cpu_end - cpu_start)*1000/len(fastest)
+            }
+
+        # input edge in the PLC -> state at the broker
+        rng = random.Random(args.seed)
+        latencies = []
+        for _ in range(args.samples):
+            k, idx = rng.randrange(args.input_sets), rng.randrange(args.coils)
+            address = k*args.coils + idx
+            value = plc.coils[address] ^ 1
+            probe.arm("mqtt", "plc/in{}/in{}_{}/state".format(k, k, idx), b"ON" if value else b"OFF")
+            edge = time.perf_counter()
+            plc.coils[address] = value
+            seen = probe.wait(5)
+            if seen is not None:
+                latencies.append((seen - edge)*1000)
+            time.sleep(rng.uniform(0, args.input_poll_ms/1000))
+        results["edge_to_mqtt_ms"] = summary(latencies)
+
+        # set command at the broker -> coil write in the PLC
+        latencies = []
+        for _ in range(args.samples):
+            k, idx = rng.randrange(args.output_sets), rng.randrange(args.coils)
+            address = (args.input_sets + k)*args.coils + idx
+            probe.arm("write", address, None)
+            command = time.perf_counter()
+            broker.publish("plc/out{}/out{}_{}/set".format(k, k, idx), "OFF" if plc.coils[address] else "ON")
+            seen = probe.wait(5)
+            if seen is not None:
+                latencies.append((seen - command)*1000)
+            time.sleep(0.01)
+        results["set_to_write_ms"] = summary(latencies)
+    finally:
+        gateway.terminate()
+        gateway.wait()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input-sets", type=int, default=10, help="button sets")
+    parser.add_argument("--output-sets", type=int, default=5, help="relay sets")
+    parser.add_argument("--register-sets", type=int, default=5, help="sensor sets")
+    parser.add_argument("--coils", type=int, default=80, help="entities of a coil set")
+    parser.add_argument("--registers", type=int, default=50, help="entities of a register set")
+    parser.add_argument("--input-poll-ms", type=int, default=20)
+    parser.add_argument("--output-poll-ms", type=int, default=500)
+    parser.add_argument("--register-poll-ms", type=int, default=1000)
+    parser.add_argument("--transport", default="tcp", choices=["udp", "tcp", "tcp-pipelined"])
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="round trip delay of the simulated PLC")
+    parser.add_argument("--catchup-rate", type=float, default=0, help="catch-up rate of the gateway, 0 publishes the startup states unpaced")
+    parser.add_argument("--discovery-rate", type=float, default=1000, help="discovery configs published per second")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of steady state polling")
+    parser.add_argument("--samples", type=int, default=50, help="edges and commands measured")
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this file as json")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the gateway")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+    print(json.dumps(results, indent=2))
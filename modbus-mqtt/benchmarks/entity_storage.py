@@ -0,0 +1,169 @@
+'''
+Memory and poll cost of the entity sets of a large device: half of the points are
+coils mapped to buttons, half are registers mapped to sensors, only a part of them
+is named. The compact model is the current one: the state of the points lives in the
+buffers of the set, named points have an entity with '__slots__', unnamed points have
+no object at all. The object model is the previous one, rebuilt here: an entity with
+a '__dict__' for every point, keeping its definition.
+
+The memory is what the entity sets allocate (tracemalloc), the cycle is one poll of
+all sets with 'changes' percent of the points changing, dispatched like the gateway
+does: planned read requests, decoded response data, changed entities processed.
+
+    python3 benchmarks/entity_storage.py --points 10000 50000 --named 50
+'''
+import argparse
+import gc
+import json
+import logging
+import random
+import struct
+import timeit
+import tracemalloc
+
+from common import setup_environment
+setup_environment()
+
+import entity
+import registers
+from decode_hot_path import StubGateway
+from planner import ReadPlanner
+from transport import pack_bits
+
+# the read plan of thousands of points is not of interest here
+logging.getLogger("planner").setLevel(logging.WARNING)
+
+SET_SIZE = 2000
+
+
+def object_model(entity_type):
+    ''' 'entity_type' as it was before: a __dict__ per instance, keeping its definition '''
+
+    class ObjectEntity(entity_type):
+
+        def initialize(self, entity_def):
+            self.entity_def = entity_def
+            attr = "component"
+            cmp = entity_def.get(attr) if attr in entity_def else self.modbus_class.defaults.get(attr)
+            self.component = cmp if cmp else self.class_component
+            super(ObjectEntity, self).initialize(entity_def)
+            # kept per instance, shadowing the method
+            self.discovery_topic = entity.Entity.DISCOVERY_TOPIC_PATTERN.format(component=self.component, e=self) if self.component else None
+            if getattr(self, "value_format", None) is not None:
+                # a format of its own, not shared with the other entities
+                f = self.value_format
+                self.value_format = registers.ValueFormat(f.value_type, f.word_order, f.byte_order, f.scale, f.value_offset, f.precision)
+
+    ObjectEntity.__name__ = entity_type.__name__
+    return ObjectEntity
+
+
+def build(points, named_pct, compact):
+    ''' entity sets of 'points' points, every SET_SIZE points form a set '''
+    gateway = StubGateway()
+    entity_sets = []
+    for k, first in enumerate(range(0, points, SET_SIZE)):
+        count = min(SET_SIZE, points - first)
+        if k % 2 == 0:
+            modbus_class = entity.ModbusClass("in{}".format(k), data_type=entity.TYPE_COIL, read_offset=first)
+            entity_type = entity.ButtonEntity
+        else:
+            modbus_class = entity.ModbusClass("reg{}".format(k), data_type=entity.TYPE_REGISTER, read_offset=first)
+            entity_type = entity.SensorEntity
+        if not compact:
+            entity_type = object_model(entity_type)
+
+        # the definitions as the config parser returns them, named points spread over the set
+        items = [{"name": "p{}_{}".format(k, idx) if idx*named_pct//100 != (idx+1)*named_pct//100 else ""} for idx in range(count)]
+        if compact:
+            entities = [entity_type(gateway, items[idx], modbus_class, idx) if items[idx]["name"] else None for idx in range(count)]
+        else:
+            entities = [entity_type(gateway, items[idx], modbus_class, idx) for idx in range(count)]
+        entity_sets.append(entity.EntitySet(modbus_class, entities, poll_delay_ms=100))
+    return entity_sets
+
+
+def measure_memory(points, named_pct, compact):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    entity_sets = build(points, named_pct, compact)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return entity_sets, size
+
+
+def responses(requests, changed, poll):
+    ''' raw response data of every request, the points at the addresses in 'changed' toggle between polls '''
+    data = []
+    for request in requests:
+        values = [(poll % 2) if request.address + idx in changed else 0 for idx in range(request.count)]
+        if request.data_type == entity.TYPE_COIL:
+            data.append(pack_bits(values))
+        else:
+            data.append(struct.pack(">{}H".format(request.count), *values))
+    return data
+
+
+def poll_cycle(entity_sets, changes_pct):
+    ''' a function polling all sets once '''
+    planner = ReadPlanner()
+    requests = [request for group in planner.plan(entity_sets) for request in group.requests]
+    points = sum(len(eset) for eset in entity_sets)
+    # the same points change in both models
+    changed = set(random.Random(1).sample(range(points), points*changes_pct//100))
+    polls = [responses(requests, changed, poll) for poll in range(2)]
+    state = {"poll": 0}
+
+    def cycle():
+        data = polls[state["poll"] % 2]
+        for request, response in zip(requests, data):
+            request.dispatch(0, response)
+        state["poll"] += 1
+
+    # the first poll publishes every named point, it is not part of the measurement
+    cycle()
+    cycle()
+    return cycle
+
+
+def bench(points, named_pct, changes_pct, number, repeat=7):
+    results = {}
+    cycles = {}
+    for name, compact in [("object", False), ("compact", True)]:
+        entity_sets, size = measure_memory(points, named_pct, compact)
+        results[name] = {"memory_mb": size/1e6, "bytes_per_point": size/points}
+        cycles[name] = (entity_sets, poll_cycle(entity_sets, changes_pct))
+
+    # the models take turns, so a busy machine slows down both of them
+    times = {name: [] for name in cycles}
+    for _ in range(repeat):
+        for name, (entity_sets, cycle) in cycles.items():
+            times[name].append(timeit.timeit(cycle, number=number) / number * 1e3)
+    for name in cycles:
+        results[name]["cycle_ms"] = min(times[name])
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, nargs="+", default=[10000, 50000], help="points of the device")
+    parser.add_argument("--named", type=int, default=50, help="percent of the points with a name")
+    parser.add_argument("--changes", type=int, default=1, help="percent of the points changing on every poll")
+    parser.add_argument("--number", type=int, default=20, help="polls per measurement")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = {points: bench(points, args.named, args.changes, args.number) for points in args.points}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{}% of the points named, {}% changing on every poll".format(args.named, args.changes))
+        print("{:<8}{:<10}{:>12}{:>16}{:>12}".format("points", "model", "memory MB", "bytes/point", "cycle ms"))
+        for points, r in results.items():
+            for name in ("object", "compact"):
+                print("{:<8}{:<10}{:>12.1f}{:>16.0f}{:>12.2f}".format(points, name, r[name]["memory_mb"], r[name]["bytes_per_point"], r[name]["cycle_ms"]))
+            print("{:<8}{:<10}{:>11.1f}x{:>16}{:>11.1f}x".format(
+                "", "ratio", r["object"]["memory_mb"]/r["compact"]["memory_mb"], "", r["object"]["cycle_ms"]/r["compact"]["cycle_ms"]))
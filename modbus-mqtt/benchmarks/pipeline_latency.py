@@ -0,0 +1,89 @@
+'''
+Poll cycle latency of the modbus transports: every cycle reads the same set of
+coil and register ranges, like a read group of the scheduler does, and the time
+until all responses are in is recorded.
+
+    python3 benchmarks/pipeline_latency.py --latency-ms 2
+    python3 benchmarks/pipeline_latency.py --host 192.168.1.10 --port 502
+
+Without --host a simulated PLC is started, --latency-ms adds a round trip delay to
+each of its responses and --serial makes it answer one request at a time.
+'''
+import argparse
+import asyncio
+import json
+import time
+
+from common import setup_environment, summary
+setup_environment()
+
+from pymodbus.client.sync import ModbusTcpClient, ModbusUdpClient
+
+import entity
+from simulator import SimulatedPlc
+from transport import PipelinedTcpTransport, SyncTransport
+
+
+def read_plan(requests, coils, registers):
+    ''' alternating coil and register reads at distinct addresses '''
+    plan = []
+    for idx in range(requests):
+        if idx % 2 == 0:
+            plan.append((entity.TYPE_COIL, idx*coils, coils))
+        else:
+            plan.append((entity.TYPE_REGISTER, idx*registers, registers))
+    return plan
+
+
+async def run_cycles(transport, plan, cycles, warmup=5):
+    latencies = []
+    for cycle in range(warmup + cycles):
+        start = time.perf_counter()
+        await asyncio.gather(*[transport.read(data_type, address, count) for data_type, address, count in plan])
+        if cycle >= warmup:
+            latencies.append((time.perf_counter() - start)*1000)
+    return latencies
+
+
+async def main(args):
+    host, port = args.host, args.port
+    if host is None:
+        plc = SimulatedPlc(latency_ms=args.latency_ms, serial=args.serial)
+        host, port = "127.0.0.1", plc.start()
+
+    plan = read_plan(args.requests, args.coils, args.registers)
+    transports = [
+        ("udp", SyncTransport(ModbusUdpClient(host, port=port, timeout=3))),
+        ("tcp", SyncTransport(ModbusTcpClient(host, port=port))),
+        ("tcp-pipelined depth=1", PipelinedTcpTransport(host, port=port, depth=1)),
+        ("tcp-pipelined depth={}".format(args.depth), PipelinedTcpTransport(host, port=port, depth=args.depth))
+    ]
+
+    results = {}
+    for name, transport in transports:
+        results[name] = summary(await run_cycles(transport, plan, args.cycles))
+        transport.close()
+
+    if args.json:
+        print(json.dumps({"requests_per_cycle": len(plan), "results": results}, indent=2))
+        return
+
+    print("{} requests per cycle, {} cycles, latency per cycle in ms".format(len(plan), args.cycles))
+    print("{:<24}{:>10}{:>10}{:>10}{:>10}".format("transport", "mean", "p50", "p99", "max"))
+    for name, r in results.items():
+        print("{:<24}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(name, r["mean"], r["p50"], r["p99"], r["max"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", help="modbus device, a simulated PLC is used when not set")
+    parser.add_argument("--port", type=int, default=502)
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="round trip delay of the simulated PLC")
+    parser.add_argument("--serial", action="store_true", help="simulated PLC answers one request at a time")
+    parser.add_argument("--requests", type=int, default=8, help="read requests per cycle")
+    parser.add_argument("--coils", type=int, default=64, help="coils per coil read")
+    parser.add_argument("--registers", type=int, default=16, help="registers per register read")
+    parser.add_argument("--depth", type=int, default=8, help="pipeline depth")
+    parser.add_argument("--cycles", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,175 @@
+'''
+Replay of a recording of raw read responses (written by the gateway with the
+'record' option) through the entity layer: the entity sets of the recording are
+built again and every response is decoded and dispatched like a poll, timers of
+the entities (click and long press detection) run on the recorded clock.
+
+    python3 benchmarks/replay.py /data/record_plc_20240101-120000.bin
+    python3 benchmarks/replay.py record.bin --speed 1 --output published.jsonl
+
+By default the log is replayed as fast as possible, --speed 1 replays it at the
+recorded speed. --output writes every published message as a json line, two
+outputs of the same recording can be diffed to find behaviour changes.
+'''
+import argparse
+import json
+import time
+
+from common import setup_environment
+setup_environment()
+
+import entity
+from planner import ReadRequest, ReadSlice
+from recorder import RecordReader
+from timers import Timers
+
+# the recorded timestamps are wall clock already, event payloads stay reproducible
+entity.wall_ms = lambda timestamp: timestamp
+
+
+class ReplayGateway(entity.GatewayInterface):
+    ''' collects the published messages, writes are counted only '''
+
+    def __init__(self, output=None):
+        self.timers = Timers()
+        self.output = output
+        self.timestamp = 0
+        self.published = 0
+        self.events = 0
+        self.writes = 0
+
+    def mqtt_publish(self, topic, payload, retain=False, event=False):
+        self.published += 1
+        if event:
+            self.events += 1
+        if self.output is not None:
+            self.output.write(json.dumps({"timestamp": self.timestamp, "topic": topic, "payload": payload, "retain": retain}) + "\n")
+
+    def mqtt_publish_discovery(self, topic, payload):
+        pass
+
+    def mqtt_remove_discovery(self, topic):
+        pass
+
+    def mqtt_subscribe(self, topic, callback):
+        pass
+
+    def mqtt_unsubscribe(self, topic):
+        pass
+
+    def modbus_write_coils(self, address, data):
+        self.writes += 1
+
+    def modbus_write_registers(self, address, data):
+        self.writes += 1
+
+    def call_at(self, deadline, callback):
+        return self.timers.call_at(deadline, callback)
+
+    def advance(self, timestamp):
+        ''' fire the entity timers due until 'timestamp' '''
+        self.timestamp = timestamp
+        self.timers.run_due(timestamp)
+
+
+def build_entity_sets(gateway, layout):
+    entity_sets = []
+    for set_def in layout:
+        modbus_class = entity.ModbusClass(
+            set_def["set_id"],
+            data_type=set_def["data_type"],
+            data_size=set_def["data_size"],
+            read_offset=set_def["read_offset"],
+            write_offset=set_def["write_offset"],
+            read_only=set_def["read_only"],
+            defaults=set_def["defaults"]
+        )
+        entity_type = getattr(entity, set_def["entity_type"]) if set_def["entity_type"] else None
+        items = set_def["entities"]
+        entities = [entity_type(gateway, items[idx], modbus_class, idx) if items[idx] and items[idx].get("name") else None for idx in range(len(items))]
+        eset = entity.EntitySet(modbus_class, entities)
+        eset.entity_type = entity_type
+        entity_sets.append(eset)
+    return entity_sets
+
+
+def read_slice(entity_set, address, count):
+    ''' the part of the request at 'address' covering 'entity_set' '''
+    read_offset = entity_set.modbus_class.read_offset
+    data_size = entity_set.modbus_class.data_size
+    first = max(0, (address - read_offset)//data_size)
+    end = min(len(entity_set), (address + count - read_offset)//data_size)
+    return ReadSlice(entity_set, read_offset + first*data_size - address, first, end - first)
+
+
+def replay(path, speed=0, output=None):
+    reader = RecordReader(path)
+    gateway = ReplayGateway(output)
+    entity_sets = build_entity_sets(gateway, reader.layout)
+
+    # a request per recorded address range, so the decode buffers are reused like in the gateway
+    requests = {}
+    records = 0
+    changed = 0
+    first_timestamp = None
+    timestamp = 0
+    start = time.perf_counter()
+
+    for timestamp, data_type, address, count, sets, data in reader:
+        if first_timestamp is None:
+            first_timestamp = timestamp
+        if speed > 0:
+            delay = (timestamp - first_timestamp)/1000/speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        key = (data_type, address, count, sets)
+        request = requests.get(key)
+        if request is None:
+            request = ReadRequest(data_type, address, count, [read_slice(entity_sets[idx], address, count) for idx in sets])
+            requests[key] = request
+
+        gateway.advance(timestamp)
+        changed += request.dispatch(timestamp, data)
+        records += 1
+
+    # the last clicks and long presses
+    next_deadline = gateway.timers.next_deadline()
+    while next_deadline is not None:
+        gateway.advance(next_deadline)
+        next_deadline = gateway.timers.next_deadline()
+
+    elapsed = time.perf_counter() - start
+    reader.close()
+
+    return {
+        "records": records,
+        "recorded_s": (timestamp - first_timestamp)/1000 if first_timestamp is not None else 0,
+        "replay_s": elapsed,
+        "records_per_s": records/elapsed if elapsed > 0 else 0,
+        "changed_entities": changed,
+        "published": gateway.published,
+        "events": gateway.events
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="recording written by the gateway")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed relative to the recording, 0 is as fast as possible")
+    parser.add_argument("--output", help="write the published messages to this file as json lines")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    output = open(args.output, "w") if args.output else None
+    try:
+        results = replay(args.path, speed=args.speed, output=output)
+    finally:
+        if output is not None:
+            output.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, value in results.items():
+            print("{:<18}{:>14}".format(name, round(value, 1) if isinstance(value, float) else value))
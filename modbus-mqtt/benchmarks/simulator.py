@@ -0,0 +1,118 @@
+import asyncio
+import struct
+import threading
+import time
+from array import array
+
+MBAP_HEADER = struct.Struct(">HHHB")
+
+
+class SimulatedPlc(object):
+    '''
+    Minimal Modbus TCP/UDP server for benchmarks: coils and holding registers starting
+    at address 0, answers read coils/registers and the four write functions.
+
+    Every response is delayed by 'latency_ms' to model the network round trip, the
+    responses of pipelined requests overlap unless 'serial' is set, which models a
+    device handling one request per connection at a time.
+
+    The optional 'on_request(function_code, address, timestamp)' is called for every
+    request with a 'time.perf_counter' timestamp, before it is answered.
+    '''
+
+    def __init__(self, host="127.0.0.1", port=0, coils=20000, registers=20000, latency_ms=0.0, serial=False):
+        self.host = host
+        self.port = port
+        self.coils = bytearray(coils)
+        self.registers = array('H', bytes(2*registers))
+        self.latency_ms = latency_ms
+        self.serial = serial
+        self.requests = 0
+        self.on_request = None
+        self.loop = None
+        self.thread = None
+
+    # data model
+    def handle(self, pdu):
+        self.requests += 1
+        function_code = pdu[0]
+        if self.on_request is not None and len(pdu) >= 3:
+            self.on_request(function_code, struct.unpack_from(">H", pdu, 1)[0], time.perf_counter())
+        try:
+            if function_code == 0x01:
+                address, count = struct.unpack_from(">HH", pdu, 1)
+                packed = bytearray((count+7)//8)
+                for idx in range(count):
+                    if self.coils[address+idx]:
+                        packed[idx >> 3] |= 1 << (idx & 7)
+                return struct.pack(">BB", function_code, len(packed)) + bytes(packed)
+            elif function_code == 0x03:
+                address, count = struct.unpack_from(">HH", pdu, 1)
+                return struct.pack(">BB{}H".format(count), function_code, 2*count, *self.registers[address:address+count])
+            elif function_code == 0x05:
+                address, value = struct.unpack_from(">HH", pdu, 1)
+                self.coils[address] = 1 if value == 0xFF00 else 0
+                return pdu[:5]
+            elif function_code == 0x06:
+                address, value = struct.unpack_from(">HH", pdu, 1)
+                self.registers[address] = value
+                return pdu[:5]
+            elif function_code == 0x0F:
+                address, count, _ = struct.unpack_from(">HHB", pdu, 1)
+                for idx in range(count):
+                    self.coils[address+idx] = (pdu[6 + (idx >> 3)] >> (idx & 7)) & 1
+                return pdu[:5]
+            elif function_code == 0x10:
+                address, count, _ = struct.unpack_from(">HHB", pdu, 1)
+                self.registers[address:address+count] = array('H', struct.unpack_from(">{}H".format(count), pdu, 6))
+                return pdu[:5]
+            return struct.pack(">BB", function_code | 0x80, 1)
+        except (IndexError, struct.error):
+            return struct.pack(">BB", function_code | 0x80, 2)
+
+    def frame(self, header, pdu):
+        transaction_id, protocol_id, _, unit = MBAP_HEADER.unpack(header)
+        response = self.handle(pdu)
+        return MBAP_HEADER.pack(transaction_id, protocol_id, len(response)+1, unit) + response
+
+    # servers
+    async def on_tcp_client(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(MBAP_HEADER.size)
+                pdu = await reader.readexactly(MBAP_HEADER.unpack(header)[2]-1)
+                response = self.frame(header, pdu)
+                if self.serial:
+                    await asyncio.sleep(self.latency_ms/1000)
+                    writer.write(response)
+                else:
+                    self.loop.call_later(self.latency_ms/1000, writer.write, response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    class UdpProtocol(asyncio.DatagramProtocol):
+        def __init__(self, plc):
+            self.plc = plc
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            response = self.plc.frame(data[:MBAP_HEADER.size], data[MBAP_HEADER.size:])
+            self.plc.loop.call_later(self.plc.latency_ms/1000, self.transport.sendto, response, addr)
+
+    async def serve(self, started):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.on_tcp_client, self.host, self.port, reuse_address=True)
+        self.port = server.sockets[0].getsockname()[1]
+        await self.loop.create_datagram_endpoint(lambda: SimulatedPlc.UdpProtocol(self), local_addr=(self.host, self.port))
+        started.set()
+        await asyncio.Event().wait()
+
+    def start(self):
+        ''' serves tcp and udp on the same port in a background thread, returns the port '''
+        started = threading.Event()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.serve(started)), daemon=True, name="simulated-plc")
+        self.thread.start()
+        started.wait()
+        return self.port
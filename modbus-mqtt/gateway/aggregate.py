@@ -0,0 +1,113 @@
+import json
+import logging
+from abc import ABC, abstractmethod
+from array import array
+
+import entity
+from decoder import SWAP_WORDS
+from scheduler import wall_ms
+
+logger = logging.getLogger('aggregate')
+logger.setLevel(logging.INFO)
+
+# a byte per coil -> the digits of a binary number
+BIT_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+class Aggregate(ABC):
+    '''
+    Single message per entity set and poll on 'plc/<set_id>/aggregate', next to the
+    topics of the entities. The changed entities are collected while the read requests
+    of a poll are dispatched, 'flush' publishes once when anything changed.
+    '''
+
+    TOPIC = "plc/{}/aggregate"
+
+    def __init__(self, gateway, entity_set):
+        self.gateway = gateway
+        self.entity_set = entity_set
+        self.topic = Aggregate.TOPIC.format(entity_set.name)
+        self.changed = []
+
+    def add(self, indexes):
+        self.changed.extend(indexes)
+
+    def flush(self, timestamp):
+        if len(self.changed) == 0:
+            return
+        self.publish(timestamp)
+        self.changed = []
+
+    @abstractmethod
+    def publish(self, timestamp):
+        ''' publish the message of the changes collected in 'changed' '''
+        raise NotImplementedError
+
+
+class PackedAggregate(Aggregate):
+    '''
+    The whole set as a hex string, retained: for coils a bitmask with entity i in bit i,
+    for registers the big endian words of the set in address order.
+    '''
+
+    def publish(self, timestamp):
+        previous = self.entity_set.previous
+        if self.entity_set.modbus_class.data_type == entity.TYPE_COIL:
+            payload = "{:0{}x}".format(int(previous[::-1].translate(BIT_DIGITS), 2), (len(previous)+3)//4)
+        else:
+            words = array('H', previous)
+            if SWAP_WORDS:
+                words.byteswap()
+            payload = words.tobytes().hex()
+        self.gateway.mqtt_publish(self.topic, payload, retain=True)
+
+
+class JsonAggregate(Aggregate):
+    '''
+    The values of the named entities that changed since the previous poll, keyed by
+    their unique id. Entities with a typed register value are decoded by their
+    'value_format', like on their state topic, the others keep the raw point value.
+    Every message is a delta, so none of them is coalesced.
+    '''
+
+    @staticmethod
+    def value(e, data):
+        value_format = getattr(e, "value_format", None)
+        if value_format is not None:
+            return value_format.decode(data)
+        if len(data) == 1:
+            return data[0]
+        return list(data)
+
+    def publish(self, timestamp):
+        data_size = self.entity_set.modbus_class.data_size
+        previous = self.entity_set.previous_view
+        values = {}
+        for idx in self.changed:
+            e = self.entity_set.named[idx]
+            if e is None:
+                continue
+            values[e.discovery_uid] = self.value(e, previous[idx*data_size:(idx+1)*data_size])
+        if len(values) == 0:
+            return
+        self.gateway.mqtt_publish(
+            self.topic,
+            json.dumps({"timestamp": wall_ms(timestamp), "changed": values}),
+            retain=False,
+            event=True
+        )
+
+
+AGGREGATES = {
+    "packed": PackedAggregate,
+    "json": JsonAggregate
+}
+
+
+def create(gateway, entity_set, kind):
+    ''' the aggregate of the configured kind, None when disabled '''
+    if not kind:
+        return None
+    if kind not in AGGREGATES:
+        raise Exception("aggregate not supported: {}, expected one of {}".format(kind, ", ".join(AGGREGATES)))
+    return AGGREGATES[kind](gateway, entity_set)
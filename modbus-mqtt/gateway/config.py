@@ -2,6 +2,10 @@ import logging
 import json
 import os
 
+def duplicates(values):
+    seen = set()
+    return [x for x in values if x in seen or seen.add(x)]
+
 def text_to_dict(txt):
     items = txt.split(",")
     rsp = {}
@@ -24,6 +28,7 @@ with open(CONFIG_PATH) as json_file:
 logger.debug("reading configuration from {}: {}".format(CONFIG_PATH, CONFIG))
 
 MQTT_HOST = os.environ["MQTT_HOST"]
+MQTT_PORT = int(os.environ.get("MQTT_PORT") or 1883)
 MQTT_USER = os.environ["MQTT_USER"]
 MQTT_PASSWORD = os.environ["MQTT_PASSWORD"]
 
@@ -35,11 +40,119 @@ MQTT_CLIENT_NAME = "modbus-gateway"
 #MQTT_USERNAME = "mosquitto-modbus-gw"
 #MQTT_PASSWORD = "YVz4Bcqen2sZaL"
 
+# messages waiting for the mqtt broker, states are coalesced per topic
+MQTT_QUEUE_SIZE = int(CONFIG.get("mqtt_queue_size", 1000))
+
+# persistent add-on storage, the options file lives there too
+DATA_DIR = os.path.dirname(CONFIG_PATH)
+
 DISCOVERY_PREFIX = CONFIG.get("discovery_prefix", "homeassistant")
+# hashes of the published discovery configs
+DISCOVERY_CACHE_PATH = os.path.join(DATA_DIR, "discovery_cache.json")
+# discovery configs published per second, 0 publishes them without pacing
+DISCOVERY_RATE = float(CONFIG.get("discovery_rate", 20))
 
 MODBUS_SERVER_HOST = CONFIG.get("modbus_host", "192.168.40.10")
 MODBUS_SERVER_PORT = int(CONFIG.get("modbus_port", 502))
 
+# sets polled at the same rate are read together when at most this many addresses apart
+READ_GAP_COILS = int(CONFIG.get("read_gap_coils", 32))
+READ_GAP_REGISTERS = int(CONFIG.get("read_gap_registers", 8))
+
+# writes arriving within this window are coalesced into one request
+WRITE_WINDOW_MS = int(CONFIG.get("write_window_ms", 5))
+WRITE_QUEUE_SIZE = int(CONFIG.get("write_queue_size", 256))
+# written ranges are read back right after the write, at most once per this interval per set
+READ_AFTER_WRITE_MS = int(CONFIG.get("read_after_write_ms", 50))
+
+# upper limit of modbus requests per second, 0 means unlimited
+POLL_BUDGET_RPS = float(CONFIG.get("poll_budget_rps", 0))
+
+# entities published per second after a (re)start when their value differs from the snapshot, 0 means unpaced
+CATCHUP_RATE = float(CONFIG.get("catchup_rate", 50))
+
 ENTITY_SETS = CONFIG.get("entity_sets", [])
 
+# record the raw read responses to DATA_DIR, for replaying them with benchmarks/replay.py
+RECORD = bool(CONFIG.get("record", False))
+RECORD_MAX_MB = int(CONFIG.get("record_max_mb", 512))
+
+# prometheus metrics on http://<host>:<metrics_port>/metrics, 0 disables the endpoint;
+# off unless configured, the endpoint has no authentication
+METRICS_PORT = int(CONFIG.get("metrics_port", 0))
+# a retained json summary per device on plc/<device>/metrics every interval, 0 disables it
+METRICS_INTERVAL_S = float(CONFIG.get("metrics_interval_s", 0))
+
+# spans of polls, reads, dispatches, writes and publishes in a ring buffer, dumped as a chrome trace
+# to DATA_DIR on SIGUSR1 or "dump" on TRACE_TOPIC, "on"/"off" there switch tracing at runtime
+TRACE = bool(CONFIG.get("trace", False))
+TRACE_BUFFER = int(CONFIG.get("trace_buffer", 50000))
+TRACE_TOPIC = "plc/trace"
+
+# button gestures and sensor thresholds mapped to writes, executed by the gateway itself
+RULES = CONFIG.get("rules", [])
+
+# the options file is checked for changes every interval and the entity sets and rules are updated
+# in place, 0 disables the check; a message on RELOAD_TOPIC reloads at once
+RELOAD_INTERVAL_S = float(CONFIG.get("reload_interval_s", 10))
+RELOAD_TOPIC = "plc/reload"
+
 DEVICE = CONFIG.get("device")
+
+# transport taking over while the configured one does not reach the device, "none" for no failover
+FAILOVER_TRANSPORTS = {
+    "udp": "tcp",
+    "tcp": "udp",
+    "tcp-pipelined": "tcp"
+}
+
+def device_config(dev, entity_sets):
+    name = dev.get("name")
+    transport = dev.get("transport", "udp")
+    return {
+        "name": name,
+        "modbus_host": dev.get("modbus_host"),
+        "modbus_port": int(dev.get("modbus_port", 502)),
+        "transport": transport,
+        "pipeline_depth": int(dev.get("pipeline_depth", 4)),
+        "failover_transport": dev.get("failover_transport", FAILOVER_TRANSPORTS.get(transport, "none")),
+        "timeout_ms": int(dev.get("timeout_ms", 1000)),
+        "availability_topic": dev.get("availability_topic", "plc/{}/availability".format(name)),
+        "device": text_to_dict(dev["device_info"]) if dev.get("device_info") else DEVICE,
+        "entity_sets": entity_sets
+    }
+
+def read_devices(cfg):
+    '''
+    every device gets its own modbus connection and scheduler, the entity sets name
+    their device; without devices the top level modbus_host/entity_sets form a single
+    device using the gateway availability topic
+    '''
+    entity_sets = cfg.get("entity_sets", [])
+    if cfg.get("devices"):
+        names = [dev.get("name") for dev in cfg.get("devices")]
+        dupes = duplicates(names)
+        if len(dupes) > 0:
+            raise Exception("device names must be unique, duplicates: {}".format(dupes))
+        unknown = [eset.get("set_id") for eset in entity_sets if eset.get("device") not in names]
+        if len(unknown) > 0:
+            raise Exception("entity sets without a configured device: {}, devices: {}".format(unknown, names))
+        devices = [
+            device_config(dev, [eset for eset in entity_sets if eset.get("device") == dev.get("name")])
+            for dev in cfg.get("devices")
+        ]
+    else:
+        devices = [device_config({
+            "name": "plc",
+            "modbus_host": cfg.get("modbus_host", MODBUS_SERVER_HOST),
+            "modbus_port": int(cfg.get("modbus_port", MODBUS_SERVER_PORT)),
+            "availability_topic": MQTT_AVAILABILITY_TOPIC
+        }, entity_sets)]
+
+    # set ids are part of the mqtt topics, so they must be unique across all devices
+    dupes = duplicates([eset.get("set_id") for dev in devices for eset in dev["entity_sets"]])
+    if len(dupes) > 0:
+        raise Exception("set_id must be unique across all devices, duplicates: {}".format(dupes))
+    return devices
+
+DEVICES = read_devices(CONFIG)
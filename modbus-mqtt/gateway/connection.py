@@ -0,0 +1,240 @@
+from pymodbus.exceptions import ModbusException
+
+import logging
+import random
+
+import entity
+from metrics import Histogram
+from scheduler import now_ms
+from transport import ModbusErrorResponse, ModbusDisconnected
+
+logger = logging.getLogger('connection')
+logger.setLevel(logging.INFO)
+
+CONNECTED = "connected"
+DEGRADED = "degraded"
+DOWN = "down"
+STATES = [CONNECTED, DEGRADED, DOWN]
+
+# recovery times in ms, from going down until a probe succeeds
+RECOVERY_BUCKETS_MS = [500, 1000, 2000, 5000, 10000, 30000, 60000, 300000, 900000]
+
+
+class Link(object):
+    ''' one way to reach the device: a transport kind with its read and write transport '''
+
+    def __init__(self, kind, read_transport, write_transport):
+        self.kind = kind
+        self.read_transport = read_transport
+        self.write_transport = write_transport
+
+    def transports(self):
+        ''' (role, transport) pairs, a shared transport once '''
+        if self.write_transport is self.read_transport:
+            return [("read", self.read_transport)]
+        return [("read", self.read_transport), ("write", self.write_transport)]
+
+    def __str__(self):
+        return self.kind
+
+
+class Connection(object):
+    '''
+    Connection state of a device, reached over the first of 'links' or, when that one fails,
+    over the others (failover).
+
+    - connected: requests succeed
+    - degraded: the last request failed, less than 'down_after' in a row, requests go on
+    - down: 'down_after' requests in a row failed, only probes are sent
+
+    A device answering with a modbus exception is reachable, that is not a failure. Failed
+    requests are not retried here, the polls come again anyway, a failed write is repeated
+    once unless the connection went down meanwhile.
+
+    While down, the gateway calls 'probe' after 'next_probe_ms': the delay grows exponentially
+    from 'backoff_min_ms' to 'backoff_max_ms' with random jitter, so devices coming back do not
+    see probes in lockstep. Every PROBES_PER_LINK failed probes the next link is tried, the
+    first one answering becomes the active link. While on another than the first link, the first
+    one is probed every 'failback_ms' and taken back once it answers.
+
+    'on_state(old, new)' is called on every state change. The time spent in every state, the
+    transitions and the recovery times are kept for the metrics.
+    '''
+
+    PROBES_PER_LINK = 2
+    WRITE_ATTEMPTS = 2
+
+    def __init__(self, links, name="modbus", down_after=3, backoff_min_ms=500, backoff_max_ms=30000, failback_ms=60000, on_state=None):
+        self.links = links
+        self.name = name
+        self.down_after = down_after
+        self.backoff_min_ms = backoff_min_ms
+        self.backoff_max_ms = backoff_max_ms
+        self.failback_ms = failback_ms
+        self.on_state = on_state
+
+        self.active = 0
+        self.state = DOWN
+        self.failures = 0
+        self.probe_failures = 0
+        self.probe_link = 0
+        self.state_timestamp = now_ms()
+        # no recovery to measure on start
+        self.down_timestamp = None
+        self.failback_timestamp = self.state_timestamp
+
+        # statistics
+        self.state_ms = {state: 0 for state in STATES}
+        self.transitions = 0
+        self.failed_requests = 0
+        self.failovers = 0
+        self.probes = 0
+        self.recovery = Histogram(RECOVERY_BUCKETS_MS)
+        self.last_recovery_ms = None
+
+    @property
+    def link(self):
+        return self.links[self.active]
+
+    @property
+    def available(self):
+        return self.state != DOWN
+
+    def time_in_state(self, timestamp=None):
+        ''' ms spent in every state, including the current one '''
+        timestamp = timestamp if timestamp is not None else now_ms()
+        times = dict(self.state_ms)
+        times[self.state] += timestamp - self.state_timestamp
+        return times
+
+    def __set_state(self, state):
+        if state == self.state:
+            return
+        timestamp = now_ms()
+        old = self.state
+        self.state_ms[old] += timestamp - self.state_timestamp
+        self.state_timestamp = timestamp
+        self.state = state
+        self.transitions += 1
+
+        if state == DOWN:
+            self.down_timestamp = timestamp
+            self.probe_failures = 0
+            self.probe_link = self.active
+            logger.error("{}: down after {} failed requests over {}".format(self.name, self.failures, self.link))
+        elif old == DOWN and self.down_timestamp is not None:
+            self.last_recovery_ms = timestamp - self.down_timestamp
+            self.recovery.observe(self.last_recovery_ms)
+            logger.info("{}: {} over {} after {}ms".format(self.name, state, self.link, self.last_recovery_ms))
+        else:
+            logger.info("{}: {} over {}".format(self.name, state, self.link))
+
+        if self.on_state is not None:
+            self.on_state(old, state)
+
+    def __succeeded(self, link):
+        if link is not self.link:
+            return
+        self.failures = 0
+        if self.state == DEGRADED:
+            self.__set_state(CONNECTED)
+
+    def __failed(self, link, e):
+        self.failed_requests += 1
+        if link is not self.link or self.state == DOWN:
+            # a request still running on a link given up on, or already known
+            return
+        if isinstance(e, ModbusDisconnected):
+            # dropped with the connection, the request that brought it down counts
+            return
+        self.failures += 1
+        logger.warning("{}: request over {} failed ({} in a row): {}".format(self.name, link, self.failures, e))
+        self.__set_state(DOWN if self.failures >= self.down_after else DEGRADED)
+
+    async def __request(self, link, transport, method, *args):
+        try:
+            result = await getattr(transport, method)(*args)
+        except ModbusErrorResponse:
+            # the device is there, it just does not like the request
+            self.__succeeded(link)
+            raise
+        except ModbusException as e:
+            self.__failed(link, e)
+            raise
+        self.__succeeded(link)
+        return result
+
+    async def read(self, data_type, address, count):
+        link = self.link
+        return await self.__request(link, link.read_transport, "read", data_type, address, count)
+
+    async def write(self, data_type, address, data):
+        for attempt in range(Connection.WRITE_ATTEMPTS):
+            link = self.link
+            try:
+                return await self.__request(link, link.write_transport, "write", data_type, address, data)
+            except ModbusErrorResponse:
+                raise
+            except ModbusException:
+                if attempt + 1 == Connection.WRITE_ATTEMPTS or self.state == DOWN:
+                    raise
+
+    async def probe(self):
+        ''' probe the device while down, or the first link while failed over, returns True when a probe was sent '''
+        if self.state == DOWN:
+            index = self.probe_link
+        elif self.active != 0 and now_ms() - self.failback_timestamp >= self.failback_ms:
+            index = 0
+            self.failback_timestamp = now_ms()
+        else:
+            return False
+
+        link = self.links[index]
+        self.probes += 1
+        try:
+            await link.read_transport.read(entity.TYPE_COIL, 0, 1)
+        except ModbusErrorResponse:
+            # answered, with an exception
+            pass
+        except ModbusException as e:
+            if self.state == DOWN:
+                self.probe_failures += 1
+                if self.probe_failures % Connection.PROBES_PER_LINK == 0 and len(self.links) > 1:
+                    self.probe_link = (self.probe_link + 1) % len(self.links)
+                    logger.info("{}: probing over {}".format(self.name, self.links[self.probe_link]))
+            logger.debug("{}: probe over {} failed: {}".format(self.name, link, e))
+            return True
+
+        if index != self.active:
+            logger.warning("{}: switching from {} to {}".format(self.name, self.link, link))
+            self.active = index
+            self.failovers += 1
+            self.failback_timestamp = now_ms()
+        self.failures = 0
+        self.__set_state(CONNECTED)
+        return True
+
+    def next_probe_ms(self, default_ms):
+        ''' delay until the next 'probe', 'default_ms' while up ('probe' checks the failback time itself) '''
+        if self.state != DOWN:
+            return default_ms
+        backoff_ms = min(self.backoff_max_ms, self.backoff_min_ms*2**min(self.probe_failures, 16))
+        # equal jitter: half of the delay is fixed, the other half random
+        return int(backoff_ms/2 + random.uniform(0, backoff_ms/2))
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "link": self.link.kind,
+            "time_in_state_ms": self.time_in_state(),
+            "transitions": self.transitions,
+            "failed_requests": self.failed_requests,
+            "failovers": self.failovers,
+            "probes": self.probes,
+            "last_recovery_ms": self.last_recovery_ms
+        }
+
+    def close(self):
+        for link in self.links:
+            for role, transport in link.transports():
+                transport.close()
@@ -0,0 +1,43 @@
+from array import array
+import sys
+
+import entity
+
+# byte value -> the 8 coils it holds, a byte per coil, least significant bit first
+BIT_TABLE = [bytes((b >> i) & 1 for i in range(8)) for b in range(256)]
+
+SWAP_WORDS = sys.byteorder == "little"
+
+
+class ResponseBuffer(object):
+    '''
+    Reusable decode buffer of a read request: the raw response data (packed coils or
+    big endian registers) is decoded into a byte per coil or a native word per register,
+    entities read their values through memoryview slices of it without any copies.
+    '''
+
+    def __init__(self, data_type, count):
+        self.data_type = data_type
+        self.count = count
+        if data_type == entity.TYPE_COIL:
+            self.buffer = bytearray(count)
+        elif data_type == entity.TYPE_REGISTER:
+            self.buffer = array('H', bytes(2*count))
+        else:
+            raise Exception("data type not supported: {}".format(data_type))
+        self.view = memoryview(self.buffer)
+        self.raw = self.view.cast('B')
+
+    def decode(self, data):
+        ''' decode the raw response data, returns a view valid until the next decode '''
+        if self.data_type == entity.TYPE_COIL:
+            if len(data) < (self.count+7)//8:
+                raise Exception("short coil response: {} bytes for {} coils".format(len(data), self.count))
+            self.buffer[:] = b"".join([BIT_TABLE[b] for b in data])[:self.count]
+        else:
+            if len(data) < 2*self.count:
+                raise Exception("short register response: {} bytes for {} registers".format(len(data), self.count))
+            self.raw[:] = data[:2*self.count]
+            if SWAP_WORDS:
+                self.buffer.byteswap()
+        return self.view
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger('discovery')
+logger.setLevel(logging.INFO)
+
+
+def digest(payload):
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class DiscoveryPublisher(object):
+    '''
+    Publishes the homeassistant discovery configs in the background at 'rate' messages
+    per second, without pacing when 'rate' is 0.
+
+    'publish(topic, payload)' returns whether the message was handed to the client. A
+    config counts as published only then. While disconnected the configs stay queued,
+    they go out after 'on_connect'.
+
+    The hashes of the published configs are kept in 'cache_path'. After a restart only
+    new or changed configs are published, and the retained configs of entities no
+    longer configured are cleared.
+
+    'republish' forgets the cache, it is called when homeassistant comes back online
+    and may have lost the entities. It is safe to call from other threads, like
+    'on_connect' and 'on_disconnect'.
+    '''
+
+    RETRY_S = 1
+
+    def __init__(self, publish, cache_path=None, rate=20):
+        self.publish = publish
+        self.cache_path = cache_path
+        self.rate = rate
+
+        self.configs = {}
+        self.published = self.load()
+        self.queue = {}
+        self.dirty = False
+        self.connected = False
+        # configs skipped by 'add' since the last log
+        self.unchanged = 0
+        self.loop = None
+        self.wakeup = None
+
+    def load(self):
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as json_file:
+                return json.load(json_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("discovery cache {} not readable, publishing all configs: {}".format(self.cache_path, e))
+            return {}
+
+    def save(self):
+        if self.cache_path is None or not self.dirty:
+            return
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as json_file:
+                json.dump(self.published, json_file)
+            os.replace(tmp_path, self.cache_path)
+            self.dirty = False
+        except OSError as e:
+            logger.warning("discovery cache {} not writable: {}".format(self.cache_path, e))
+
+    def __wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def add(self, topic, payload):
+        ''' 'payload' becomes the config on 'topic', published unless it is already there '''
+        self.configs[topic] = payload
+        if self.published.get(topic) != digest(payload):
+            self.queue[topic] = None
+            self.__wake()
+        else:
+            # removed and added again unchanged, the clear queued by 'remove' is not needed
+            self.queue.pop(topic, None)
+            self.unchanged += 1
+
+    def remove(self, topic):
+        ''' the config on 'topic' is cleared, unless it was never published '''
+        if self.configs.pop(topic, None) is None:
+            return
+        if topic in self.published:
+            self.queue[topic] = None
+            self.__wake()
+        else:
+            self.queue.pop(topic, None)
+
+    def on_connect(self):
+        self.connected = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.__wake)
+
+    def on_disconnect(self):
+        self.connected = False
+
+    def republish(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.__republish)
+
+    def __republish(self):
+        logger.info("publishing all {} discovery configs again".format(len(self.configs)))
+        self.published = {}
+        self.dirty = True
+        for topic in self.configs:
+            self.queue[topic] = None
+        self.__wake()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+
+        # configs published by a previous run for entities that are gone
+        for topic in self.published:
+            if topic not in self.configs:
+                self.queue[topic] = None
+
+        while True:
+            published = cleared = 0
+            while len(self.queue) > 0 and self.connected:
+                topic = next(iter(self.queue))
+                payload = self.configs.get(topic)
+                if not self.publish(topic, payload if payload is not None else ""):
+                    # stays queued, sent again once the client takes it or after the next connect
+                    logger.warning("discovery config {} not published, retrying".format(topic))
+                    await asyncio.sleep(DiscoveryPublisher.RETRY_S)
+                    continue
+
+                del self.queue[topic]
+                if payload is None:
+                    self.published.pop(topic, None)
+                    cleared += 1
+                else:
+                    self.published[topic] = digest(payload)
+                    published += 1
+                self.dirty = True
+                if self.rate > 0:
+                    await asyncio.sleep(1/self.rate)
+
+            if self.dirty:
+                logger.info("discovery: {} configs published, {} cleared, {} unchanged".format(
+                    published, cleared, self.unchanged))
+                self.unchanged = 0
+            self.save()
+
+            self.wakeup.clear()
+            await self.wakeup.wait()
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+from planner import ReadRequest, ReadSlice
+from scheduler import now_ms
+
+logger = logging.getLogger('echo')
+logger.setLevel(logging.INFO)
+
+
+class EchoSet(object):
+    ''' pending re-read of a writable entity set '''
+
+    def __init__(self, entity_set):
+        self.entity_set = entity_set
+        self.first = None
+        self.end = None
+        self.timer = None
+        self.reading = False
+        self.timestamp = 0
+
+    def add(self, first, end):
+        self.first = first if self.first is None else min(self.first, first)
+        self.end = end if self.end is None else max(self.end, end)
+
+    def take(self):
+        ''' the pending range as a read request, clears the pending range '''
+        modbus_class = self.entity_set.modbus_class
+        first, count = self.first, self.end - self.first
+        self.first = self.end = None
+        return ReadRequest(
+            modbus_class.data_type,
+            modbus_class.read_offset + first*modbus_class.data_size,
+            count*modbus_class.data_size,
+            [ReadSlice(self.entity_set, 0, first, count)]
+        )
+
+
+class EchoReader(object):
+    '''
+    Re-reads the written address range right after a write has been acknowledged,
+    so the new state is published without waiting for the next poll of the set.
+    Re-reads of a set are at least 'min_interval_ms' apart, writes arriving in
+    between extend the pending range instead of causing another read.
+    '''
+
+    def __init__(self, entity_sets, read, timers, min_interval_ms=50):
+        self.read = read
+        self.timers = timers
+        self.min_interval_ms = min_interval_ms
+        # running re-reads, the event loop keeps only weak references to tasks
+        self.tasks = set()
+        self.sets = [EchoSet(eset) for eset in entity_sets if not eset.modbus_class.read_only and len(eset) > 0]
+
+    def update(self, entity_sets):
+        ''' follow a reload of the entity sets, the sets still there keep their pending re-reads '''
+        echos = {id(echo.entity_set): echo for echo in self.sets}
+        self.sets = [echos.pop(id(eset), None) or EchoSet(eset) for eset in entity_sets if not eset.modbus_class.read_only and len(eset) > 0]
+        for echo in echos.values():
+            if echo.timer is not None:
+                echo.timer.cancel()
+                echo.timer = None
+
+    def on_written(self, data_type, address, count):
+        for echo in self.sets:
+            modbus_class = echo.entity_set.modbus_class
+            if modbus_class.data_type != data_type:
+                continue
+
+            # written addresses as entity indexes of the set
+            start = max(address - modbus_class.write_offset, 0)
+            end = min(address + count - modbus_class.write_offset, len(echo.entity_set)*modbus_class.data_size)
+            if start >= end:
+                continue
+
+            echo.add(start // modbus_class.data_size, (end - 1) // modbus_class.data_size + 1)
+            self.__schedule(echo)
+
+    def __schedule(self, echo):
+        if echo.timer is not None or echo.reading:
+            return
+        deadline = max(now_ms(), echo.timestamp + self.min_interval_ms)
+        echo.timer = self.timers.call_at(deadline, lambda timestamp: self.__start(echo))
+
+    def __start(self, echo):
+        echo.timer = None
+        echo.reading = True
+        task = asyncio.ensure_future(self.__read(echo))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def __read(self, echo):
+        request = echo.take()
+        try:
+            logger.debug("read after write: {}".format(request))
+            await self.read(request)
+        except Exception as e:
+            # nobody awaits the task, the next poll of the set reads the range anyway
+            logger.exception("read after write {} failed: {}".format(request, e))
+        finally:
+            echo.timestamp = now_ms()
+            echo.reading = False
+            if echo.first is not None:
+                self.__schedule(echo)
@@ -1,9 +1,14 @@
 import re
 import json
+from array import array
 import logging
 from unidecode import unidecode
 
 from config import DISCOVERY_PREFIX, MQTT_AVAILABILITY_TOPIC
+from metrics import Histogram
+from policy import PublishFilter, PublishPolicy
+from registers import RegisterBlockDecoder, ValueFormat
+from scheduler import wall_ms
 from abc import ABC, ABCMeta, abstractmethod
 
 logger = logging.getLogger('entity')
@@ -11,14 +16,33 @@ logger.setLevel(logging.INFO)
 
 class GatewayInterface(metaclass=ABCMeta):
 
+    # availability topic of the device the entities belong to
+    availability_topic = MQTT_AVAILABILITY_TOPIC
+
+    @abstractmethod
+    def mqtt_publish(self, topic, payload, retain=False, event=False):
+        ''' states are coalesced per topic on the way out, events never are '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def mqtt_publish_discovery(self, topic, payload):
+        ''' retained discovery config, published in the background '''
+        raise NotImplementedError
+
     @abstractmethod
-    def mqtt_publish(self, topic, payload, retain=False):
+    def mqtt_remove_discovery(self, topic):
+        ''' clear the discovery config on 'topic' '''
         raise NotImplementedError
 
     @abstractmethod
     def mqtt_subscribe(self, topic, callback):
         raise NotImplementedError
 
+    @abstractmethod
+    def mqtt_unsubscribe(self, topic):
+        ''' drop the handlers of 'topic' and of the topics below it '''
+        raise NotImplementedError
+
     @abstractmethod
     def modbus_write_coils(self, address, data):
         raise NotImplementedError
@@ -27,6 +51,11 @@ class GatewayInterface(metaclass=ABCMeta):
     def modbus_write_registers(self, address, data):
         raise NotImplementedError
 
+    @abstractmethod
+    def call_at(self, deadline, callback):
+        ''' arm a one-shot timer, returns an object with a 'cancel()' method '''
+        raise NotImplementedError
+
 
 TYPE_REGISTER = "register"
 TYPE_COIL = "coil"
@@ -61,89 +90,399 @@ class ModbusClass(object):
         )
 
 
+def diff_indexes(old, new, width):
+    ''' indexes of the 'width' bytes wide items that differ between two equally sized buffers '''
+    bits = 8*width
+    diff = int.from_bytes(old, "little") ^ int.from_bytes(new, "little")
+    indexes = []
+    base = 0
+    while diff:
+        idx = ((diff & -diff).bit_length() - 1) // bits
+        indexes.append(base+idx)
+        diff >>= bits*(idx+1)
+        base += idx+1
+    return indexes
+
+
+class EntitySet(object):
+    '''
+    Keeps the last raw data block of the set (a byte per coil, an array('H') for registers)
+    and dispatches only the entities whose data changed. Entities that need to act
+    between changes arm a timer with 'gateway.call_at'.
+
+    The values are memoryviews of the decode buffer of the read request, they are
+    compared and copied without creating python objects per value, entities get a
+    slice of it and must not keep it beyond 'on_modbus_data'.
+
+    With a 'snapshot' attached, the first value of an entity after a (re)start is
+    compared with its last published value: the entity takes over the snapshot value
+    silently and publishes only when the value differs, through the paced 'catch_up'.
+
+    With an 'aggregate' attached, the changed indexes are collected for it as well and
+    'publish_aggregate' sends a single message for the set after a poll.
+
+    Entities with a typed register value ('value_format') get their values from the
+    'decoder' of the set, which decodes all values of a read in one go.
+
+    'entities' has an entry per point of the set, None for the unnamed ones: the state
+    of all points lives in the buffers of the set, only named points have an entity.
+    Iterating the set yields the entities, 'len' is the number of points.
+    '''
+
+    def __init__(self, modbus_class: ModbusClass, entities, poll_delay_ms=0, poll_min_ms=None, poll_max_ms=None, priority=0, definitions=None):
+        self.modbus_class = modbus_class
+        self.size = len(entities)
+        self.definitions = definitions
+        self.entity_type = None
+        self.poll_delay_ms = poll_delay_ms
+        self.poll_min_ms = poll_min_ms
+        self.poll_max_ms = poll_max_ms
+        self.priority = priority
+        self.snapshot = None
+        self.catch_up_queue = None
+        self.aggregate = None
+        self.poll_task = None
+
+        # statistics
+        self.polls = 0
+        self.changes = 0
+        self.poll_latency = Histogram()
+
+        # only named entities are processed
+        self.named = [e if e is not None and e.entity_name else None for e in entities]
+        for e in self:
+            e.entity_set = self
+
+        self.update_decoder()
+        self.reset_buffer()
+
+    @property
+    def name(self):
+        return self.modbus_class.name
+
+    def update_decoder(self):
+        formats = [getattr(e, "value_format", None) if e is not None else None for e in self.named]
+        self.decoder = RegisterBlockDecoder(formats, self.modbus_class.data_size) if any(formats) else None
+
+    @property
+    def adaptive(self):
+        ''' the poll interval adapts between 'poll_min_ms' and 'poll_max_ms' '''
+        return self.poll_min_ms is not None and self.poll_max_ms is not None and self.poll_min_ms < self.poll_max_ms
+
+    @property
+    def poll_interval_ms(self):
+        ''' current interval of the scheduler task polling the set '''
+        return self.poll_task.interval_ms if self.poll_task is not None else self.poll_delay_ms
+
+    def __iter__(self):
+        return (e for e in self.named if e is not None)
+
+    def __len__(self):
+        return self.size
+
+    def reset_buffer(self):
+        size = self.size*self.modbus_class.data_size
+        if self.modbus_class.data_type == TYPE_COIL:
+            self.previous = bytearray(size)
+        else:
+            self.previous = array('H', bytes(2*size))
+        self.previous_view = memoryview(self.previous)
+        # entities without a known previous value
+        self.unknown = bytearray(b"\x01"*self.size)
+        self.unknown_count = self.size
+        if self.aggregate is not None:
+            self.aggregate.changed = []
+
+    def reset(self):
+        [ e.reset() for e in self ]
+        self.reset_buffer()
+
+    def replace(self, idx, e):
+        ''' put entity 'e' (None for an unnamed point) in place of entity 'idx', its value is published with the next poll '''
+        if e is not None:
+            e.entity_set = self
+        self.named[idx] = e
+        self.update_decoder()
+        if not self.unknown[idx]:
+            self.unknown[idx] = 1
+            self.unknown_count += 1
+        if self.snapshot is not None:
+            # the snapshot holds what the previous entity published
+            self.snapshot.valid[idx] = 0
+
+    def remove(self, definitions):
+        ''' take all entities out of service, 'definitions' are the ones they were created from '''
+        for idx, e in enumerate(self.named):
+            if e is not None:
+                e.remove(definitions[idx])
+        # a poll still in flight finds no entities anymore
+        self.named = [None]*self.size
+        self.decoder = None
+        self.aggregate = None
+        self.snapshot = None
+
+    def changed(self, values, offset, first, count):
+        ''' store the new block and return the indexes of the changed entities '''
+        data_size = self.modbus_class.data_size
+        start = first*data_size
+        end = start + count*data_size
+        block = values[offset:offset+end-start]
+
+        old = self.previous_view[start:end]
+        if old == block:
+            changed = []
+        else:
+            changed = [first+i for i in diff_indexes(old, block, old.itemsize*data_size)]
+            old[:] = block
+
+        if self.unknown_count > 0 and self.unknown.count(1, first, first+count) > 0:
+            changed = sorted(set(changed) | {first+i for i in range(count) if self.unknown[first+i]})
+            self.unknown[first:first+count] = bytes(count)
+            self.unknown_count = self.unknown.count(1)
+
+        return changed
+
+    def store(self, idx, data):
+        ''' remember 'data' as the last published value of entity 'idx' '''
+        if self.snapshot is not None:
+            data_size = self.modbus_class.data_size
+            self.snapshot.data[idx*data_size:(idx+1)*data_size] = data
+            self.snapshot.valid[idx] = 1
+
+    def restore(self, e, idx, data):
+        ''' restore the last published value, returns True when it equals 'data' '''
+        if self.snapshot is None or not self.snapshot.valid[idx]:
+            return False
+        data_size = self.modbus_class.data_size
+        published = self.snapshot.data[idx*data_size:(idx+1)*data_size]
+        e.restore(published)
+        if published == data:
+            return True
+        # the value changed while the gateway was down, the first live value is no edge
+        e.restored = True
+        return False
+
+    def catch_up(self, timestamp, idx):
+        ''' publish the current value of entity 'idx' '''
+        if self.unknown[idx]:
+            # reset while queued, the next poll queues it again
+            return
+        e = self.named[idx]
+        if e is None:
+            # removed by a reload while queued
+            return
+        data_size = self.modbus_class.data_size
+        data = self.previous_view[idx*data_size:(idx+1)*data_size]
+        e.on_modbus_data(timestamp, data)
+        self.store(idx, data)
+
+    def on_modbus_data(self, timestamp, values, offset, first, count):
+        '''
+        process 'count' entities starting at index 'first',
+        their data starts at 'offset' within 'values', returns the number of changed entities
+        '''
+        data_size = self.modbus_class.data_size
+        fresh = bytes(self.unknown[first:first+count]) if self.unknown_count > 0 else None
+        changed = self.changed(values, offset, first, count)
+        self.changes += len(changed)
+        if self.aggregate is not None and len(changed) > 0:
+            self.aggregate.add(changed)
+        named = self.named
+        decoded = None
+        if self.decoder is not None and any(named[idx] is not None for idx in changed):
+            decoded = self.decoder.decode(values, offset, first, count)
+        for idx in changed:
+            e = named[idx]
+            if e is None:
+                continue
+            pos = offset + (idx-first)*data_size
+            data = values[pos:pos+data_size]
+            if fresh is not None and fresh[idx-first]:
+                # first value after a (re)start
+                if self.restore(e, idx, data):
+                    continue
+                if self.catch_up_queue is not None:
+                    self.catch_up_queue.add(self, idx)
+                    continue
+            if decoded is not None:
+                e.process_value(timestamp, decoded[idx-first])
+            else:
+                e.on_modbus_data(timestamp, data)
+            self.store(idx, data)
+        return len(changed)
+
+    def publish_aggregate(self, timestamp):
+        ''' publish the changes collected since the previous call as a single message '''
+        if self.aggregate is not None:
+            self.aggregate.flush(timestamp)
+
+
 class Entity(ABC):
+    '''
+    A named point of an entity set. Entities are plentiful on large devices, so they
+    keep only what is needed after the discovery: no '__dict__' (every subclass
+    declares its '__slots__'), no reference to their definition and no attributes that
+    are cheap to derive when needed (the addresses).
+    '''
+
+    __slots__ = ("gateway", "modbus_class", "modbus_idx", "entity_name", "discovery_uid", "mqtt_topic_base",
+                 "publish_filter", "entity_set", "rules", "state", "muted", "restored")
 
     TOPIC_BASE   = "plc/{e.modbus_class.name}/{e.discovery_uid}"
     TOPIC_STATE = "state"
     TOPIC_SET    = "set"
 
-    DISCOVERY_TOPIC_PATTERN = DISCOVERY_PREFIX+"/{e.component}/plc/{e.discovery_uid}/config"
+    DISCOVERY_TOPIC_PATTERN = DISCOVERY_PREFIX+"/{component}/plc/{e.discovery_uid}/config"
+
+    # definition keys used by the gateway only, not passed on in the discovery payload
+    LOCAL_KEYS = ValueFormat.KEYS + PublishPolicy.KEYS
 
     def __init__(self,
             gateway,
             entity_def,
             modbus_class: ModbusClass,
             modbus_idx):
-        # do not process unnamed entities
-        if entity_def is None:
-            return
+        self.check(entity_def, modbus_class)
 
         # entity attributes
         self.gateway = gateway
-        self.entity_def = entity_def
         self.modbus_class = modbus_class
         self.modbus_idx = modbus_idx
+        self.entity_set = None
+        # rule engine notified about the events of the entity, when it triggers rules
+        self.rules = None
 
-        self.entity_name = self.entity_def.get("name")
+        self.entity_name = entity_def.get("name")
         uid = unidecode(self.entity_name.lower())
         self.discovery_uid = re.sub(r"\s+", "_", uid)
-
-        attr = "component"
-        cmp = self.entity_def.get(attr) if attr in self.entity_def else self.modbus_class.defaults.get(attr)
-        self.component = cmp if cmp else self.class_component
-
-        self.modbus_read_address = self.modbus_idx+self.modbus_class.read_offset
-        self.modbus_write_address = self.modbus_idx*self.modbus_class.data_size+self.modbus_class.write_offset
         self.mqtt_topic_base = Entity.TOPIC_BASE.format(e=self)
-        self.discovery_topic = Entity.DISCOVERY_TOPIC_PATTERN.format(e=self) if self.component else None
+
+        # deadband and publish intervals, from the entity definition or the set defaults
+        policy = PublishPolicy.from_definition(entity_def, self.modbus_class.defaults)
+        self.publish_filter = PublishFilter(policy, self.send, gateway.call_at) if policy is not None else None
 
         # state data
         self.reset()
 
         # initialize
-        self.initialize()
+        self.initialize(entity_def)
+
+    @property
+    def modbus_read_address(self):
+        return self.modbus_idx+self.modbus_class.read_offset
+
+    @property
+    def modbus_write_address(self):
+        return self.modbus_idx*self.modbus_class.data_size+self.modbus_class.write_offset
 
     def reset(self):
         self.state = None
+        self.muted = False
+        self.restored = False
+        if self.publish_filter is not None:
+            self.publish_filter.reset()
+
+    @classmethod
+    def check(cls, entity_def, modbus_class):
+        ''' raises when no entity can be created from 'entity_def', without creating one '''
+        if modbus_class.data_type not in [TYPE_REGISTER, TYPE_COIL]:
+            raise Exception("Data class not supported: {}".format(modbus_class.data_type))
+        PublishPolicy.from_definition(entity_def, modbus_class.defaults)
 
-    def initialize(self):
+    def initialize(self, entity_def):
+        ''' 'entity_def' is the definition of the entity, it is not kept afterwards '''
 
         if not self.entity_name:
             return
 
-        data_type = self.modbus_class.data_type
-        if data_type not in [TYPE_REGISTER, TYPE_COIL]:
-            raise Exception("Data class not supported: {}".format(data_type))
-
         # send discovery info to mqtt
-        topic = self.discovery_topic
+        topic = self.discovery_topic(entity_def)
         payload = {}
         payload.update(self.modbus_class.defaults)
-        payload.update(self.entity_def)
+        payload.update(entity_def)
         payload.update(self.discovery_payload())
+        for key in Entity.LOCAL_KEYS:
+            payload.pop(key, None)
         if topic is not None and payload is not None:
-            self.gateway.mqtt_publish(
-                topic=topic,
-                payload=json.dumps({k:v for k,v in payload.items() if v is not None}),
-                retain=True
+            self.gateway.mqtt_publish_discovery(
+                topic,
+                json.dumps({k:v for k,v in payload.items() if v is not None})
             )
 
+    def discovery_topic(self, entity_def):
+        ''' topic of the discovery config, None without a component '''
+        attr = "component"
+        cmp = entity_def.get(attr) if attr in entity_def else self.modbus_class.defaults.get(attr)
+        component = cmp if cmp else self.class_component
+        return Entity.DISCOVERY_TOPIC_PATTERN.format(component=component, e=self) if component else None
+
+    def remove(self, entity_def):
+        ''' take the entity out of service: no timers, no command handlers, no discovery config '''
+        self.reset()
+        self.gateway.mqtt_unsubscribe(self.mqtt_topic_base)
+        topic = self.discovery_topic(entity_def)
+        if topic is not None:
+            self.gateway.mqtt_remove_discovery(topic)
+
     @property
     def class_component(self):
         ''' default homeassistant component implemented by this entity class '''
         return None
 
     def discovery_payload(self):
-        return {
+        payload = {
             "~": self.mqtt_topic_base,
             "name": self.entity_name,
             # "device": self.gateway.device_info,
             "unique_id": self.discovery_uid,
-            "availability_topic": MQTT_AVAILABILITY_TOPIC,
             "command_topic": "~/{}".format(Entity.TOPIC_SET),
             "state_topic": "~/{}".format(Entity.TOPIC_STATE),
         }
 
+        if self.gateway.availability_topic == MQTT_AVAILABILITY_TOPIC:
+            payload["availability_topic"] = MQTT_AVAILABILITY_TOPIC
+        else:
+            # available only while both the gateway and the device are online
+            payload["availability"] = [{"topic": MQTT_AVAILABILITY_TOPIC}, {"topic": self.gateway.availability_topic}]
+            payload["availability_mode"] = "all"
+
+        return payload
+
+    def publish(self, topic, value, retain=True, timestamp=None):
+        ''' publish a state of the entity on 'topic' below its base topic, subject to the publish policy '''
+        if self.muted:
+            return
+        if self.publish_filter is not None:
+            self.publish_filter.offer(topic, value, retain, timestamp)
+        else:
+            self.send(topic, value, retain)
+
+    def send(self, topic, value, retain=True):
+        self.gateway.mqtt_publish(self.mqtt_topic(topic), value, retain=retain)
+
+    def fire(self, event, value, old=None, timestamp=None):
+        ''' pass an event to the rules triggered by this entity, restored values are no events '''
+        if self.muted:
+            return
+        if self.restored:
+            # 'old' was restored from the snapshot, the change happened across the restart
+            self.restored = False
+            old = None
+        if self.rules is not None:
+            self.rules.on_event(self, event, value, old, timestamp)
+
+    def command(self, payload):
+        ''' execute a command in the format of the mqtt set topic, returns False when not supported '''
+        return False
+
+    def restore(self, data):
+        ''' take over the last published value without publishing it again '''
+        self.muted = True
+        try:
+            self.process_modbus_data(None, data)
+        finally:
+            self.muted = False
+
     def mqtt_topic(self, *args):
         topic = "/".join([self.mqtt_topic_base]+list(args))
         logging.debug("topic: {}".format(topic))
@@ -166,6 +505,8 @@ class Entity(ABC):
 
 class BitEntity(Entity):
 
+    __slots__ = ()
+
     def process_modbus_data(self, timestamp, data):
         # store current value
         old_val = self.state
@@ -175,12 +516,9 @@ class BitEntity(Entity):
             # retain mqtt messages for outputs (with write operation supported)
             retain = self.modbus_class.read_only
             value = "ON" if new_val else "OFF"
-            self.gateway.mqtt_publish(
-                self.mqtt_topic(Entity.TOPIC_STATE),
-                value,
-                retain=retain
-            )
+            self.publish(Entity.TOPIC_STATE, value, retain=retain, timestamp=timestamp)
             self.state = new_val
+            self.fire("on" if new_val else "off", new_val, old_val, timestamp)
 
         # pass back the old value
         return old_val
@@ -188,71 +526,100 @@ class BitEntity(Entity):
 
 class BinarySensorEntity(BitEntity):
 
+    __slots__ = ()
+
     @property
     def class_component(self):
         return "binary_sensor"
 
 class ButtonEntity(BitEntity):
 
+    __slots__ = ("click_count", "hold", "timestamp", "timer")
+
     CLICK_PAUSE_MAX = 250
     LONG_PRESS_MIN = 400
 
+    TOPIC_EVENT = "event"
+
     def reset(self):
         super(ButtonEntity, self).reset()
 
+        self.cancel_timer()
         self.click_count = 0
         self.hold = False
         self.timestamp = 0
 
+    def cancel_timer(self):
+        timer = getattr(self, "timer", None)
+        if timer is not None:
+            timer.cancel()
+        self.timer = None
+
+    def start_timer(self, deadline, callback):
+        self.cancel_timer()
+        self.timer = self.gateway.call_at(deadline, callback)
+
+    def restore(self, data):
+        # no edge, the click and long press detection starts from the restored state
+        self.state = data[0]
+
+    def publish_event(self, event, value):
+        ''' publish the event together with the timestamp of the edge that caused it '''
+        self.fire(event, value, timestamp=self.timestamp)
+        self.gateway.mqtt_publish(self.mqtt_topic(event), value, retain=True, event=True)
+        self.gateway.mqtt_publish(
+            self.mqtt_topic(ButtonEntity.TOPIC_EVENT),
+            json.dumps({"event": event, "value": value, "timestamp": wall_ms(self.timestamp)}),
+            retain=False,
+            event=True
+        )
+
     def process_modbus_data(self, timestamp, data):
         old_val = super(ButtonEntity, self).process_modbus_data(timestamp, data)
-        
-        # the following implementation is based on the fact,
-        # that 'process_modbus_data' is called frequently
+
+        # timeouts run on the gateway timers, so they fire on time even if the next poll is late
         if old_val != self.state:
+            self.timestamp = timestamp
 
             if self.state == True:
                 self.click_count = self.click_count+1
+                self.start_timer(timestamp+ButtonEntity.LONG_PRESS_MIN, self.on_long_press)
             elif self.state == False:
                 if self.hold == True:
-                    self.gateway.mqtt_publish(
-                        self.mqtt_topic("long"),
-                        "RELEASE"
-                    )
+                    self.cancel_timer()
+                    self.publish_event("long", "RELEASE")
                     self.hold = False
                     self.click_count = 0
-
-            self.timestamp = timestamp
-        elif self.state == True and self.hold == False:
-            # possible click timeout (hold)
-            delta = timestamp - self.timestamp
-            if delta > ButtonEntity.LONG_PRESS_MIN:
-                self.gateway.mqtt_publish(
-                    self.mqtt_topic('long'),
-                    self.click_count
-                )
-                self.hold = True
-
-        elif self.state == False and self.click_count > 0:
-            # possible pause timeout (click)
-            delta = timestamp - self.timestamp
-            if delta > ButtonEntity.CLICK_PAUSE_MAX:
-                self.gateway.mqtt_publish(
-                    self.mqtt_topic("click"),
-                    self.click_count
-                )
-                self.click_count = 0
+                elif self.click_count > 0:
+                    self.start_timer(timestamp+ButtonEntity.CLICK_PAUSE_MAX, self.on_click_pause)
 
         return old_val
 
+    def on_long_press(self, deadline):
+        self.timer = None
+        if self.state == True and self.hold == False:
+            self.publish_event("long", self.click_count)
+            self.hold = True
+
+    def on_click_pause(self, deadline):
+        self.timer = None
+        if self.state == False and self.click_count > 0:
+            self.publish_event("click", self.click_count)
+            self.click_count = 0
+
 class RelayEntity(BitEntity):
 
-    def initialize(self):
-        super(RelayEntity, self).initialize()
+    __slots__ = ()
+
+    def initialize(self, entity_def):
+        super(RelayEntity, self).initialize(entity_def)
         self.gateway.mqtt_subscribe(self.mqtt_topic("set"), self.on_mqtt_set)
 
     def on_mqtt_set(self, msg):
-        payload = msg.payload.decode('utf-8')
+        if not self.command(msg.payload.decode('utf-8')):
+            logging.info("{}: unrecognized command {}".format(msg.topic, msg.payload))
+
+    def command(self, payload):
         upper_payload = str(payload).upper()
         value = None
         if upper_payload == "ON" or upper_payload == "1":
@@ -262,11 +629,11 @@ class RelayEntity(BitEntity):
         elif upper_payload == "TOGGLE":
             value = not self.state
 
-        if value is not None:
-            logging.info("{}: {} --> modbus({}) = {}".format(msg.topic, msg.payload, self.modbus_write_address, value))
-            self.gateway.modbus_write_coils(self.modbus_write_address, value)
-        else:
-            logging.info("{}: unrecognized command {}".format(msg.topic, msg.payload))
+        if value is None:
+            return False
+        logging.info("{}: {} --> modbus({}) = {}".format(self.mqtt_topic_base, payload, self.modbus_write_address, value))
+        self.gateway.modbus_write_coils(self.modbus_write_address, value)
+        return True
 
     @property
     def class_component(self):
@@ -275,41 +642,49 @@ class RelayEntity(BitEntity):
 
 class SensorEntity(Entity):
 
-    def initialize(self):
-        super(SensorEntity, self).initialize()
+    __slots__ = ("value_format",)
 
-        if self.modbus_class.data_type != TYPE_REGISTER:
+    @classmethod
+    def check(cls, entity_def, modbus_class):
+        super(SensorEntity, cls).check(entity_def, modbus_class)
+        if modbus_class.data_type != TYPE_REGISTER:
             raise Exception("SensorEntity only supports word data format")
-        if self.modbus_class.data_size > 2:
-            raise Exception("SensorEntity only supports up to two word data size: {}".format(self.modbus_class))
+        if modbus_class.data_size > 4:
+            raise Exception("SensorEntity only supports up to four word data size: {}".format(modbus_class))
+        ValueFormat.from_definition(entity_def, modbus_class.defaults, modbus_class.data_size)
+
+    def initialize(self, entity_def):
+        super(SensorEntity, self).initialize(entity_def)
+
+        if self.entity_name:
+            self.value_format = ValueFormat.from_definition(entity_def, self.modbus_class.defaults, self.modbus_class.data_size)
 
         if not self.modbus_class.read_only:
             self.gateway.mqtt_subscribe(self.mqtt_topic("set"), self.on_mqtt_set)
 
     def on_mqtt_set(self, msg):
-        payload = msg.payload.decode('utf-8')
+        self.command(msg.payload.decode('utf-8'))
+
+    def command(self, payload):
         try:
-            value = int(payload)
-            if self.modbus_class.data_size == 1:
-                encoded = [value]
-            else:
-                encoded = [value & 0xFFFF, (value >> 16) & 0xFFFF]
-            self.gateway.modbus_write_registers(self.modbus_write_address, encoded)
+            value = float(payload) if self.value_format.code in "fd" or not self.value_format.identity else int(payload)
+            self.gateway.modbus_write_registers(self.modbus_write_address, self.value_format.encode(value))
+            return True
         except:
             logger.warn("SensorEntity operation not supported: {}".format(payload))
+            return False
 
 
     def process_modbus_data(self, timestamp, data):
+        self.process_value(timestamp, self.value_format.decode(data))
 
-        # store current value
-        if self.modbus_class.data_size == 1:
-            value = data[0]
-        else:
-            value = (data[1]<<16)+data[0]
-
+    def process_value(self, timestamp, value):
+        ''' the decoded value, called by the entity set for every change '''
         if value != self.state:
-            self.gateway.mqtt_publish(self.mqtt_topic(Entity.TOPIC_STATE), value)
+            self.publish(Entity.TOPIC_STATE, value, timestamp=timestamp)
+            old_value = self.state
             self.state = value
+            self.fire("value", value, old_value, timestamp)
 
     @property
     def class_component(self):
@@ -318,6 +693,8 @@ class SensorEntity(Entity):
 
 class BlindEntity(Entity):
 
+    __slots__ = ("pos", "target", "t_up", "t_dn")
+
     def reset(self):
         super(BlindEntity, self).reset()
 
@@ -327,19 +704,24 @@ class BlindEntity(Entity):
         self.t_dn = None
         self.state = "stopped"
 
-    def initialize(self):
-        super(BlindEntity, self).initialize()
-
-        if self.modbus_class.data_type != TYPE_REGISTER:
+    @classmethod
+    def check(cls, entity_def, modbus_class):
+        super(BlindEntity, cls).check(entity_def, modbus_class)
+        if modbus_class.data_type != TYPE_REGISTER:
             raise Exception("BlindEntity only supports word data format")
-        if self.modbus_class.data_size != 2:
-            raise Exception("BlindEntity only supports two word data size: {}".format(self.modbus_class))
+        if modbus_class.data_size != 2:
+            raise Exception("BlindEntity only supports two word data size: {}".format(modbus_class))
+
+    def initialize(self, entity_def):
+        super(BlindEntity, self).initialize(entity_def)
 
         self.gateway.mqtt_subscribe(self.mqtt_topic("set"), self.on_mqtt_set)
         self.gateway.mqtt_subscribe(self.mqtt_topic("config"), self.on_mqtt_config)
 
     def on_mqtt_set(self, msg):
-        payload = msg.payload.decode('utf-8')
+        self.command(msg.payload.decode('utf-8'))
+
+    def command(self, payload):
         try:
             value = int(payload)
             if value < 0:
@@ -356,10 +738,11 @@ class BlindEntity(Entity):
                 value = 0 & 0x7F
             else:
                 logger.warn("BlindEntity operation not supported: {}".format(payload))
-                return
+                return False
 
         # TODO: overwriting current position
         self.gateway.modbus_write_registers(self.modbus_write_address, value)
+        return True
 
     def on_mqtt_config(self, msg):
         payload = msg.payload.decode('utf-8')
@@ -379,7 +762,7 @@ class BlindEntity(Entity):
     def process_modbus_data(self, timestamp, data):
 
         def publish_state(topic, val):
-            self.gateway.mqtt_publish(self.mqtt_topic(topic), val)
+            self.publish(topic, val, timestamp=timestamp)
 
         # store current value
         if data[0] & 0x80 == 0: # stop command
@@ -1,31 +1,35 @@
-from pymodbus.client.sync import ModbusTcpClient, ModbusUdpClient
-from pymodbus.bit_write_message import *
-from pymodbus.register_write_message import *
 from pymodbus.exceptions import ModbusException
-from pymodbus.constants import Defaults
 
 import paho.mqtt.client as mqtt
 
 from functools import partial
+import asyncio
 import logging
+import os
+import threading
 import time
 
+import aggregate
 import config
+import connection
 import entity
+from discovery import DiscoveryPublisher
+from echo import EchoReader
+from outbound import OutboundQueue
+from planner import ReadPlanner
+from recorder import Recorder
+from router import MqttRouter
+from scheduler import Scheduler, now_ms
+from snapshot import CatchUp, Snapshot
+from timers import Timers
+from tracing import tracer
+from transport import ModbusErrorResponse, create_transports
+from writer import WriteQueue
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('gateway')
 logger.setLevel(logging.INFO)
 
-# MODBUS
-Defaults.RetryOnEmpty = True
-Defaults.Timeout = 0.2
-Defaults.Retries = 5
-Defaults.Reconnects = 5
-
-modbus_udp_client = ModbusUdpClient(config.MODBUS_SERVER_HOST, timeout=3)
-modbus_tcp_client = ModbusTcpClient(config.MODBUS_SERVER_HOST)
-
 # MQTT
 mqtt_client = mqtt.Client(config.MQTT_CLIENT_NAME)
 mqtt_client.username_pw_set(username=config.MQTT_USER, password=config.MQTT_PASSWORD)
@@ -33,141 +37,239 @@ mqtt_client.username_pw_set(username=config.MQTT_USER, password=config.MQTT_PASS
 # last will
 mqtt_client.will_set(config.MQTT_AVAILABILITY_TOPIC, "offline", retain=True)
 
-# connect, loop_start will handle reconnections
-mqtt_client.connect(config.MQTT_HOST)
-mqtt_client.loop_start()
+# incoming commands, routed by topic
+router = MqttRouter(mqtt_client)
+
+# outgoing states and events, bounded and coalesced per topic
+outbound = OutboundQueue(mqtt_client, max_size=config.MQTT_QUEUE_SIZE)
 
 def on_mqtt_connect(client, data, flags, rc):
     logger.info("mqtt_client connected")
     mqtt_client.publish(config.MQTT_AVAILABILITY_TOPIC, "online")
+    router.on_connect()
+    outbound.on_connect()
+    discovery_publisher.on_connect()
+
+def on_mqtt_disconnect(client, data, rc):
+    logger.warning("mqtt_client disconnected: {}".format(rc))
+    router.on_disconnect()
+    outbound.on_disconnect()
+    discovery_publisher.on_disconnect()
+
+# discovery configs go out in the background, unchanged ones are skipped
+discovery_publisher = DiscoveryPublisher(
+    lambda topic, payload: mqtt_client.publish(topic, payload, retain=True).rc == mqtt.MQTT_ERR_SUCCESS,
+    cache_path=config.DISCOVERY_CACHE_PATH,
+    rate=config.DISCOVERY_RATE
+)
+
+def on_homeassistant_status(msg):
+    # homeassistant restarted, it may have lost the entities
+    if msg.payload.decode('utf-8') == "online":
+        discovery_publisher.republish()
+
+router.add("{}/status".format(config.DISCOVERY_PREFIX), on_homeassistant_status)
+
+def dump_trace():
+    # serializing a full buffer takes a while, keep it off the event loop and the mqtt thread
+    path = os.path.join(config.DATA_DIR, "trace_{}.json".format(time.strftime("%Y%m%d-%H%M%S")))
+    threading.Thread(target=tracer.dump, args=(path,), name="trace-dump", daemon=True).start()
+
+def on_trace_command(msg):
+    command = msg.payload.decode('utf-8').strip().lower()
+    if command == "on":
+        tracer.enable(config.TRACE_BUFFER)
+    elif command == "off":
+        tracer.disable()
+    elif command == "dump":
+        dump_trace()
+    else:
+        logger.warning("unknown trace command: {}".format(command))
 
-mqtt_client.on_connect = on_mqtt_connect
-
-
-def modbus_execute(request):
-    if not modbus_tcp_client.is_socket_open():
-        modbus_tcp_client.connect()
-
-    try:
-        ret = modbus_tcp_client.execute(request)
-        if ret.isError():
-            raise ret
-    except:
-        try:
-            ret = modbus_tcp_client.execute(request) # retry
-            if ret.isError():
-                raise ret
-        except e:
-            logging.error(e)
-            ret = None
-
-    return ret
+if config.TRACE:
+    tracer.enable(config.TRACE_BUFFER)
+router.add(config.TRACE_TOPIC, on_trace_command)
 
-def modbus_write_coils(address, data):
-    logger.info("modbus_write_coils({}, {})".format(address, data))
+# the callbacks are in place before connecting, so the first connect is not missed
+mqtt_client.on_connect = on_mqtt_connect
+mqtt_client.on_disconnect = on_mqtt_disconnect
+mqtt_client.on_publish = outbound.on_publish
 
-    if isinstance(data, list):
-        request = WriteMultipleCoilsRequest(address, data)
-    else:
-        request = WriteSingleCoilRequest(address, data)
-    modbus_execute(request)
+# connect, loop_start will handle reconnections
+mqtt_client.connect(config.MQTT_HOST, config.MQTT_PORT)
+mqtt_client.loop_start()
 
-def modbus_write_registers(address, data):
-    logger.info("modbus_write_registers({}, {})".format(address, data))
 
-    if isinstance(data, list):
-        request = WriteMultipleRegistersRequest(address, data)
-    else:
-        request = WriteSingleRegisterRequest(address, data)
-    modbus_execute(request)
+class Gateway(entity.GatewayInterface):
+    '''
+    Gateway for a single PLC: owns the modbus connections, the scheduler and the
+    write queue of the device, so a device going offline does not affect the others.
+    '''
 
-class ModbusNotAvailableException(Exception):
-    pass
+    PROBE_INTERVAL_MS = 500
+    SNAPSHOT_FLUSH_MS = 10000
+    CATCHUP_DELAY_MAX_MS = 1000
 
-class Gateway(entity.GatewayInterface):
-    
-    def __init__(self, device_info):
+    def __init__(self, device_info, name="plc", modbus_host=config.MODBUS_SERVER_HOST, modbus_port=config.MODBUS_SERVER_PORT, transport="udp", pipeline_depth=4, failover_transport=None, timeout_ms=1000, availability_topic=config.MQTT_AVAILABILITY_TOPIC):
         super(Gateway, self).__init__()
 
         self.device_info = device_info
+        self.name = name
+        self.availability_topic = availability_topic
+        self.logger = logger.getChild(name)
+
+        # modbus connections: reads use the configured transport, writes go over tcp,
+        # a pipelined connection carries both reads and writes; the failover transport
+        # takes over while the configured one does not reach the device
+        kinds = [transport] + ([failover_transport] if failover_transport not in (None, "none", transport) else [])
+        links = []
+        for kind in kinds:
+            read_transport, write_transport = create_transports(kind, modbus_host, port=modbus_port, pipeline_depth=pipeline_depth, timeout=timeout_ms/1000, name="{}-{}".format(name, kind))
+            links.append(connection.Link(kind, read_transport, write_transport))
+        self.connection = connection.Connection(links, name=name, on_state=self.__on_connection_state)
+
         # state init
         self.entity_sets = []
-        self.processors = []
         self.modbus_available = False
-
-        # mqtt init
-        logger.info("gateway sending availability message")
+        self.write_queue = WriteQueue(self.modbus_write, window_ms=config.WRITE_WINDOW_MS, max_size=config.WRITE_QUEUE_SIZE, name="{}-writer".format(name), on_written=self.__on_written)
+        self.echo_reader = None
+        self.rules = None
+        self.timers = Timers()
+        self.scheduler = Scheduler(name, timers=self.timers, budget_rps=config.POLL_BUDGET_RPS, backpressure=outbound.is_congested)
+        self.snapshot = None
+        self.recorder = None
+        # read group key -> poll task
+        self.poll_tasks = {}
+        self.started = False
+        self.catch_up = CatchUp(self.call_at, config.CATCHUP_RATE, now_ms) if config.CATCHUP_RATE > 0 else None
+
+        # statistics
+        self.modbus_errors = 0
+        self.probes = 0
+        self.split_reads = 0
+
+        self.logger.info("gateway for {}:{} over {}, availability on {}".format(modbus_host, modbus_port, " then ".join(kinds), availability_topic))
 
     def gateway_available(self):
-        self.mqtt_publish(config.MQTT_AVAILABILITY_TOPIC, "online")
+        self.mqtt_publish(self.availability_topic, "online")
 
     def gateway_unavailable(self):
         # push the unavailability message
-        self.mqtt_publish(config.MQTT_AVAILABILITY_TOPIC, "offline")
+        self.mqtt_publish(self.availability_topic, "offline")
 
         # reset all entities
-        [ e.reset() for eset in self.entity_sets for e in eset ]
+        [ eset.reset() for eset in self.entity_sets ]
 
     # GatewayInterface
-    def mqtt_publish(self, topic, payload, retain=True):
+    def mqtt_publish(self, topic, payload, retain=True, event=False):
         logger.debug("mqtt publish on {}: {}".format(topic, payload))
-        mqtt_client.publish(topic, payload, retain=retain)
+        outbound.publish(topic, payload, retain=retain, event=event)
+
+    def mqtt_publish_discovery(self, topic, payload):
+        discovery_publisher.add(topic, payload)
+
+    def mqtt_remove_discovery(self, topic):
+        discovery_publisher.remove(topic)
 
     def mqtt_subscribe(self, topic, callback):
         logger.debug("mqtt subscribe on {}".format(topic))
-        mqtt_client.message_callback_add(topic, lambda client, userdata, msg: callback(msg))
-        mqtt_client.subscribe(topic)
+        router.add(topic, callback)
+
+    def mqtt_unsubscribe(self, topic):
+        logger.debug("mqtt unsubscribe from {}".format(topic))
+        router.remove(topic)
 
     def modbus_write_coils(self, address, data):
-        return modbus_write_coils(address, data)
+        self.write_queue.submit(entity.TYPE_COIL, address, data)
 
     def modbus_write_registers(self, address, data):
-        return modbus_write_registers(address, data)
+        self.write_queue.submit(entity.TYPE_REGISTER, address, data)
+
+    def call_at(self, deadline, callback):
+        return self.timers.call_at(deadline, callback)
 
     # internal methods
-    def __process_entities(self, entities, time_wait, previous_timestamp):
-        if len(entities) == 0:
-            logger.debug("No entities to process in __process_entities")
+    async def modbus_read(self, data_type, address, count):
+        return await self.connection.read(data_type, address, count)
+
+    async def modbus_write(self, data_type, address, data):
+        return await self.connection.write(data_type, address, data)
+
+    async def __process_request(self, request):
+        trace_start = tracer.begin()
+        start = time.perf_counter()
+        values = await self.modbus_read(request.data_type, request.address, request.count)
+        latency_ms = (time.perf_counter() - start)*1000
+        tracer.async_span(trace_start, "read", "{} modbus".format(self.name), {"type": request.data_type, "address": request.address, "count": request.count})
+        for s in request.slices:
+            s.entity_set.polls += 1
+            s.entity_set.poll_latency.observe(latency_ms)
+        # the values are as of their arrival, not of the poll deadline
+        timestamp = now_ms()
+        if self.recorder is not None:
+            self.recorder.record(timestamp, request, values)
+        trace_start = tracer.begin()
+        changed = request.dispatch(timestamp, values)
+        tracer.span(trace_start, "dispatch", self.name, {"address": request.address, "changed": changed})
+        return changed
+
+    async def __echo_read(self, request):
+        if not self.modbus_available:
             return
 
-        # get actual timestamp
-        current_timestamp = time.time_ns() // 1000000 # get current time in ms
-
-        if current_timestamp - previous_timestamp > time_wait:
-            # get start address and how many bits need to be read
-            modbus_class:entity.ModbusClass = entities[0].modbus_class
-            data_type     = modbus_class.data_type
-            data_size    = modbus_class.data_size
-            start_address = modbus_class.read_offset
-            data_count    = data_size*len(entities)
-
-            # get the values via modbus 
-            if data_type == entity.TYPE_COIL:
-                result = modbus_udp_client.read_coils(start_address, data_count)
-                if result.isError():
-                    raise result
-                values = result.bits
-            elif data_type == entity.TYPE_REGISTER:
-                result = modbus_udp_client.read_holding_registers(start_address, data_count)
-                if result.isError():
-                    raise result
-                values = result.registers
+        self.scheduler.consume(1)
+        try:
+            await self.__process_request(request)
+        except ModbusException as e:
+            self.modbus_failed(e)
+            return
+        for s in request.slices:
+            s.entity_set.publish_aggregate(now_ms())
+
+    def __on_written(self, data_type, address, count):
+        self.scheduler.consume(1)
+        if self.rules is not None:
+            self.rules.on_written(self, data_type, address, count)
+        if self.echo_reader is not None:
+            self.echo_reader.on_written(data_type, address, count)
+
+    async def __process_group(self, group, timestamp):
+        if not self.modbus_available:
+            return False
+
+        # all requests of the group are issued at once, a pipelined transport keeps them in flight together
+        results = await asyncio.gather(
+            *[self.__process_request(request) for request in group.requests],
+            return_exceptions=True
+        )
+
+        changed = 0
+        requests = []
+        for request, result in zip(group.requests, results):
+            if isinstance(result, ModbusErrorResponse) and len(request.slices) > 1:
+                # the device does not accept reads across the merged gap, fall back to one read per slice
+                self.logger.warning("merged read rejected, splitting {}: {}".format(request, result))
+                self.split_reads += 1
+                requests.extend(request.split())
+            elif isinstance(result, ModbusException):
+                # the other requests of the group went through, their results and splits are kept
+                self.modbus_failed(result)
+                requests.append(request)
+            elif isinstance(result, BaseException):
+                raise result
             else:
-                raise Exception("data type not supported: {}".format(data_type))
-
-            # process entities
-            idx = 0
-            for e in entities:
-                new_idx = idx+data_size
-                e.on_modbus_data(current_timestamp, values[idx:new_idx])
-                idx = new_idx
-
-            return current_timestamp
-        else:
-            return previous_timestamp
-
-    def register_entity_set(self, modbus_class: entity.ModbusClass, entity_type, items, item_count, poll_delay_ms=0):
-        logger.info("registering modbus_class={}, entity_type={}, item_count={}".format(modbus_class, entity_type, item_count))
+                changed += result
+                requests.append(request)
+        group.requests = requests
+
+        # one aggregated message per set and poll, after all requests of the group are in
+        timestamp = now_ms()
+        for eset in group.entity_sets:
+            eset.publish_aggregate(timestamp)
+        return changed > 0
+
+    def register_entity_set(self, modbus_class: entity.ModbusClass, entity_type, items, item_count, poll_delay_ms=0, poll_min_ms=None, poll_max_ms=None, priority=0, aggregate_kind=None):
+        self.logger.info("registering modbus_class={}, entity_type={}, item_count={}".format(modbus_class, entity_type, item_count))
         if len(items) != item_count:
             raise Exception("number of names in item_names does not match item_count")
 
@@ -179,29 +281,183 @@ class Gateway(entity.GatewayInterface):
             raise Exception("names must be unique within set_id={}, duplicates: {}".format(modbus_class.name, dupes))
 
 
-        entities = [entity_type(self, items[idx], modbus_class, idx) for idx in range(0, item_count)]
-        self.entity_sets.append(entities)
-        self.processors.append( (0, partial(self.__process_entities, entities, poll_delay_ms)) )
-
-    def modbus_step(self):
-        try:
-            if self.modbus_available == False:
-                response = modbus_udp_client.read_coils(0, 1)
-                if response.isError():
-                    raise ModbusNotAvailableException()
-
-                # modbus server is back
-                self.gateway_available()
-                self.modbus_available = True
-                logger.info("modbus back online, gateway operational")
+        # unnamed points are only a place in the buffers of the set, no entity is created for them
+        entities = [entity_type(self, items[idx], modbus_class, idx) if item_names[idx] else None for idx in range(0, item_count)]
+        # the recorder writes the definitions to its log, the entities do not keep them
+        definitions = items if config.RECORD else None
+        eset = entity.EntitySet(modbus_class, entities, poll_delay_ms, poll_min_ms=poll_min_ms, poll_max_ms=poll_max_ms, priority=priority, definitions=definitions)
+        eset.entity_type = entity_type
+        eset.catch_up_queue = self.catch_up
+        eset.aggregate = aggregate.create(self, eset, aggregate_kind)
+        self.entity_sets.append(eset)
+        return eset
+
+    def remove_entity_set(self, eset, items):
+        ''' take 'eset' out of service, 'items' are the definitions its entities were created from '''
+        self.logger.info("removing entity set {}".format(eset.name))
+        eset.remove(items)
+        self.entity_sets.remove(eset)
+
+    def reconfigure_entity_set(self, eset, poll_delay_ms=0, poll_min_ms=None, poll_max_ms=None, priority=0, aggregate_kind=None):
+        ''' change the poll settings and the aggregate of 'eset', its entities and values stay '''
+        self.logger.info("reconfiguring entity set {}: poll_delay_ms={}, poll_min_ms={}, poll_max_ms={}, priority={}, aggregate={}".format(
+            eset.name, poll_delay_ms, poll_min_ms, poll_max_ms, priority, aggregate_kind))
+        eset.poll_delay_ms = poll_delay_ms
+        eset.poll_min_ms = poll_min_ms
+        eset.poll_max_ms = poll_max_ms
+        eset.priority = priority
+        if eset.aggregate is not None and not aggregate_kind:
+            # clear the retained aggregate
+            self.mqtt_publish(eset.aggregate.topic, "")
+        eset.aggregate = aggregate.create(self, eset, aggregate_kind)
+
+    def remove_entity(self, eset, idx, item):
+        ''' take entity 'idx' of 'eset' out of service, 'item' is the definition it was created from '''
+        self.logger.info("removing {}[{}]: {}".format(eset.name, idx, item))
+        e = eset.named[idx]
+        if e is not None:
+            e.remove(item)
+        eset.replace(idx, None)
+
+    def add_entity(self, eset, idx, item):
+        ''' 'item' becomes the definition of entity 'idx' of 'eset', after it was removed '''
+        self.logger.info("adding {}[{}]: {}".format(eset.name, idx, item))
+        eset.replace(idx, eset.entity_type(self, item, eset.modbus_class, idx) if item.get("name") else None)
+        if eset.definitions is not None:
+            eset.definitions[idx] = item
+
+    def apply_changes(self):
+        '''
+        bring the polls, the read-backs, the snapshot and the recording in line with the
+        entity sets after they were changed by a reload, unchanged read groups keep polling
+        '''
+        if not self.started:
+            # run sets all of it up
+            return
+        router.flush()
+        self.plan()
+        self.echo_reader.update(self.entity_sets)
+        self.open_snapshot()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.open_recorder()
+
+    def modbus_failed(self, e):
+        # the connection decides when the device is down, see __on_connection_state
+        self.modbus_errors += 1
+        self.logger.error("modbus request failed ({}): {}".format(self.connection.state, e))
+
+    def __on_connection_state(self, old, new):
+        if new == connection.DOWN:
+            self.modbus_available = False
+            self.gateway_unavailable()
+            self.logger.error("modbus not available, probing in {}ms".format(self.connection.next_probe_ms(Gateway.PROBE_INTERVAL_MS)))
+        elif old == connection.DOWN:
+            # modbus server is back
+            self.modbus_available = True
+            self.gateway_available()
+            self.logger.info("modbus back online over {}, gateway operational".format(self.connection.link))
+
+    async def modbus_probe(self, timestamp):
+        if await self.connection.probe():
+            self.probes += 1
+        # backoff while the device is down
+        self.probe_task.interval_ms = self.connection.next_probe_ms(Gateway.PROBE_INTERVAL_MS)
+
+    async def flush_snapshot(self, timestamp):
+        # gone when reopening it after a reload failed
+        if self.snapshot is not None:
+            self.snapshot.flush()
+
+    async def flush_recorder(self, timestamp):
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    def plan(self):
+        ''' the read groups of the entity sets, groups planned as before keep their poll task '''
+        planner = ReadPlanner(max_gap={
+            entity.TYPE_COIL: config.READ_GAP_COILS,
+            entity.TYPE_REGISTER: config.READ_GAP_REGISTERS
+        })
+        groups = planner.plan(self.entity_sets)
+
+        tasks = {}
+        started = 0
+        for group in groups:
+            key = group.key()
+            task = self.poll_tasks.pop(key, None)
+            if task is None:
+                started += 1
+                task = self.scheduler.add(
+                    group.name,
+                    group.interval_ms,
+                    partial(self.__process_group, group),
+                    min_interval_ms=group.min_interval_ms,
+                    max_interval_ms=group.max_interval_ms,
+                    priority=group.priority,
+                    cost=group.cost
+                )
+            tasks[key] = task
+            for eset in group.entity_sets:
+                eset.poll_task = task
+
+        if self.started:
+            self.logger.info("read plan: {} groups kept, {} started, {} stopped".format(len(tasks) - started, started, len(self.poll_tasks)))
+        for task in self.poll_tasks.values():
+            self.scheduler.remove(task)
+        self.poll_tasks = tasks
+        return groups
+
+    def open_snapshot(self):
+        ''' (re)open the snapshot for the entity sets, sets that had a region before keep their values '''
+        if self.snapshot is not None and [eset.snapshot for eset in self.entity_sets] == self.snapshot.regions:
+            return
 
-            self.processors = [(step(ts), step) for ts, step in self.processors]
-        except ModbusException as e:
-            logger.error("modbus not available, reconnecting in 500ms")
-            logger.error(e)
-            if self.modbus_available == True:
-                self.gateway_unavailable()
-                self.modbus_available = False
-            time.sleep(.5)
-                
+        kept = [(eset, eset.snapshot.data.tobytes(), eset.snapshot.valid.tobytes()) for eset in self.entity_sets if eset.snapshot is not None]
+        for eset in self.entity_sets:
+            eset.snapshot = None
+        # unmap the file before it is resized for the new layout
+        reopened = self.snapshot is not None
+        self.snapshot = None
 
+        self.snapshot = Snapshot.open(os.path.join(config.DATA_DIR, "snapshot_{}.bin".format(self.name)), self.entity_sets)
+        if self.snapshot is None:
+            return
+        if reopened:
+            # new sets start empty, even when the layout still matches the file
+            for eset in self.entity_sets:
+                eset.snapshot.valid[:] = bytes(len(eset))
+            for eset, data, valid in kept:
+                eset.snapshot.data.cast('B')[:] = data
+                eset.snapshot.valid[:] = valid
+        if "snapshot" not in [task.name for task in self.scheduler.tasks]:
+            self.scheduler.add("snapshot", Gateway.SNAPSHOT_FLUSH_MS, self.flush_snapshot)
+
+    def open_recorder(self):
+        ''' a new log of the raw read responses, for the current entity sets '''
+        path = os.path.join(config.DATA_DIR, "record_{}_{}.bin".format(self.name, time.strftime("%Y%m%d-%H%M%S")))
+        self.recorder = Recorder.open(path, self.entity_sets, max_bytes=config.RECORD_MAX_MB*1024*1024)
+        if self.recorder is not None and "recorder" not in [task.name for task in self.scheduler.tasks]:
+            self.scheduler.add("recorder", Gateway.SNAPSHOT_FLUSH_MS, self.flush_recorder)
+
+    async def run(self):
+        # the entities are registered, subscribe their command topics in one go
+        router.flush()
+
+        # last published values, so a restart does not publish everything again
+        self.open_snapshot()
+
+        # raw read responses for replaying them offline, a new log on every start
+        if config.RECORD:
+            self.open_recorder()
+
+        groups = self.plan()
+        if self.catch_up is not None and len(groups) > 0:
+            # wait for the first poll of the sets before publishing, so they are published in priority order
+            self.catch_up.delay_ms = min(max(group.interval_ms for group in groups), Gateway.CATCHUP_DELAY_MAX_MS)
+
+        self.echo_reader = EchoReader(self.entity_sets, self.__echo_read, self.timers, min_interval_ms=config.READ_AFTER_WRITE_MS)
+
+        self.probe_task = self.scheduler.add("probe", Gateway.PROBE_INTERVAL_MS, self.modbus_probe, cost=lambda: 0 if self.modbus_available else 1)
+        self.started = True
+        await asyncio.gather(self.scheduler.run(), self.write_queue.run())
@@ -0,0 +1,220 @@
+import asyncio
+import bisect
+import json
+import logging
+
+logger = logging.getLogger('metrics')
+logger.setLevel(logging.INFO)
+
+# upper bounds in ms, the same for all latency histograms
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class Histogram(object):
+    '''
+    Cumulative histogram with fixed buckets, 'observe' is a bisect and two additions,
+    cheap enough for every modbus request. The buckets are rendered cumulatively.
+    '''
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        # the last bucket is +Inf
+        self.counts = [0]*(len(bounds)+1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        ''' upper bound of the bucket holding the 'q' quantile, None when empty '''
+        if self.count == 0:
+            return None
+        rank = q*self.count
+        total = 0
+        for idx, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return self.bounds[idx] if idx < len(self.bounds) else float("inf")
+
+
+def labels(**kwargs):
+    if not kwargs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in kwargs.items()) + "}"
+
+
+class PrometheusWriter(object):
+    ''' text exposition format, the samples of a metric family are kept together '''
+
+    def __init__(self):
+        self.families = {}
+
+    def family(self, name, kind, help_text):
+        if name not in self.families:
+            self.families[name] = ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, kind)]
+        return self.families[name]
+
+    def sample(self, name, kind, help_text, value, **kwargs):
+        self.family(name, kind, help_text).append("{}{} {}".format(name, labels(**kwargs), value))
+
+    def histogram(self, name, help_text, histogram, scale=1, **kwargs):
+        ''' 'scale' converts the observed values, e.g. 0.001 for ms -> seconds '''
+        lines = self.family(name, "histogram", help_text)
+        total = 0
+        for bound, count in zip(histogram.bounds + ["+Inf"], histogram.counts):
+            total += count
+            le = bound if bound == "+Inf" else "{:g}".format(bound*scale)
+            lines.append("{}_bucket{} {}".format(name, labels(le=le, **kwargs), total))
+        lines.append("{}_sum{} {}".format(name, labels(**kwargs), histogram.sum*scale))
+        lines.append("{}_count{} {}".format(name, labels(**kwargs), histogram.count))
+
+    def text(self):
+        return "\n".join(line for lines in self.families.values() for line in lines) + "\n"
+
+
+def prometheus(gateways, outbound, rules=None):
+    ''' all metrics in the prometheus text format '''
+    w = PrometheusWriter()
+
+    for gw in gateways:
+        device = gw.name
+        w.sample("modbus_available", "gauge", "1 while the device answers", int(gw.modbus_available), device=device)
+        w.sample("modbus_errors_total", "counter", "failed modbus reads", gw.modbus_errors, device=device)
+        w.sample("modbus_probes_total", "counter", "reconnect probes while the device is offline", gw.probes, device=device)
+        w.sample("modbus_split_reads_total", "counter", "merged reads rejected by the device and split", gw.split_reads, device=device)
+        conn = gw.connection
+        for state, ms in conn.time_in_state().items():
+            w.sample("modbus_connection_state", "gauge", "1 for the current state of the connection", int(state == conn.state), device=device, state=state)
+            w.sample("modbus_connection_state_seconds_total", "counter", "time spent in every connection state", ms/1000, device=device, state=state)
+        w.sample("modbus_connection_transitions_total", "counter", "connection state changes", conn.transitions, device=device)
+        w.sample("modbus_connection_failovers_total", "counter", "switches between the configured and the failover transport", conn.failovers, device=device)
+        w.histogram("modbus_connection_recovery_seconds", "time from the connection going down until the device answers again", conn.recovery, scale=0.001, device=device)
+        for link in conn.links:
+            for name, transport in link.transports():
+                # the pymodbus clients do not count their timeouts and connects
+                kwargs = dict(device=device, connection=name, transport=link.kind)
+                w.sample("modbus_transport_timeouts_total", "counter", "requests without a response in time", getattr(transport, "timeouts", 0), **kwargs)
+                w.sample("modbus_transport_connects_total", "counter", "connections opened, more than one means reconnects", getattr(transport, "connects", 0), **kwargs)
+
+        for eset in gw.entity_sets:
+            kwargs = dict(device=device, set=eset.name)
+            w.histogram("modbus_poll_duration_seconds", "round trip of the reads of an entity set", eset.poll_latency, scale=0.001, **kwargs)
+            w.sample("modbus_polls_total", "counter", "reads of an entity set", eset.polls, **kwargs)
+            w.sample("modbus_poll_interval_seconds", "gauge", "configured (current, when adaptive) poll interval", eset.poll_interval_ms/1000, **kwargs)
+            w.sample("entity_changes_total", "counter", "entities with a changed value", eset.changes, **kwargs)
+            held = sum(e.publish_filter.held for e in eset.named if e is not None and e.publish_filter is not None)
+            w.sample("entity_publishes_held_total", "counter", "states held back by the deadband or the minimum publish interval", held, **kwargs)
+
+        scheduler = gw.scheduler
+        w.sample("scheduler_lag_seconds", "gauge", "lag of the last tick behind its deadline", scheduler.lag_ms/1000, device=device)
+        w.sample("scheduler_ticks_total", "counter", "scheduler wakeups starting tasks", scheduler.ticks, device=device)
+        w.sample("scheduler_missed_deadlines_total", "counter", "poll slots skipped because a run took too long", scheduler.missed_deadlines, device=device)
+        for task in scheduler.tasks:
+            w.sample("scheduler_task_deferred_total", "counter", "runs deferred by the budget or backpressure", task.deferred, device=device, task=task.name)
+
+        writer = gw.write_queue
+        w.histogram("modbus_write_latency_seconds", "time from a write command to its acknowledgement", writer.latency, scale=0.001, device=device)
+        w.sample("modbus_writes_total", "counter", "values written", writer.writes, device=device)
+        w.sample("modbus_write_requests_total", "counter", "write requests sent", writer.requests, device=device)
+        w.sample("modbus_writes_coalesced_total", "counter", "writes replaced by a newer value", writer.coalesced, device=device)
+        w.sample("modbus_writes_dropped_total", "counter", "writes dropped by a full queue", writer.dropped, device=device)
+        w.sample("modbus_write_errors_total", "counter", "failed write requests", writer.errors, device=device)
+        w.sample("modbus_write_queue_depth", "gauge", "writes waiting", len(writer.pending), device=device)
+
+    w.histogram("mqtt_publish_latency_seconds", "time from queueing a message to its publish", outbound.latency, scale=0.001)
+    w.sample("mqtt_published_total", "counter", "messages handed to the client", outbound.published)
+    w.sample("mqtt_coalesced_total", "counter", "states replaced by a newer one while queued", outbound.coalesced)
+    w.sample("mqtt_dropped_total", "counter", "events dropped by a full queue", outbound.dropped)
+    w.sample("mqtt_queue_depth", "gauge", "messages waiting", len(outbound))
+    w.sample("mqtt_inflight", "gauge", "messages handed to the client and not yet written", len(outbound.inflight))
+    w.sample("mqtt_congested", "gauge", "1 while polls are held back", int(outbound.congested))
+
+    if rules is not None:
+        stats = rules.stats()
+        w.sample("rule_writes_total", "counter", "writes executed by local rules", stats["writes"])
+        w.sample("rule_latency_max_seconds", "gauge", "longest edge to write latency of a rule", stats["max_latency_ms"]/1000)
+
+    return w.text()
+
+
+def device_metrics(gw, previous=None, interval_ms=None):
+    '''
+    summary of a device for the periodic mqtt message, the achieved poll rate is
+    computed from the poll counts in 'previous' (returned by the last call)
+    '''
+    sets = {}
+    for eset in gw.entity_sets:
+        polls = previous.get(eset.name, {}).get("polls", 0) if previous else 0
+        sets[eset.name] = {
+            "polls": eset.polls,
+            "poll_rate": round((eset.polls - polls)*1000/interval_ms, 2) if interval_ms else None,
+            "configured_rate": round(1000/eset.poll_interval_ms, 2) if eset.poll_interval_ms > 0 else None,
+            "poll_p50_ms": eset.poll_latency.quantile(0.5),
+            "poll_p99_ms": eset.poll_latency.quantile(0.99),
+            "changes": eset.changes
+        }
+    writer = gw.write_queue
+    return {
+        "available": gw.modbus_available,
+        "modbus_errors": gw.modbus_errors,
+        "connection": gw.connection.stats(),
+        "scheduler_lag_ms": gw.scheduler.lag_ms,
+        "scheduler_max_lag_ms": gw.scheduler.max_lag_ms,
+        "missed_deadlines": gw.scheduler.missed_deadlines,
+        "writes": writer.writes,
+        "write_errors": writer.errors,
+        "write_p99_ms": writer.latency.quantile(0.99),
+        "sets": sets
+    }
+
+
+class MetricsServer(object):
+    ''' minimal http server answering every GET with the prometheus metrics '''
+
+    def __init__(self, render, host="0.0.0.0", port=9105):
+        self.render = render
+        self.host = host
+        self.port = port
+
+    async def __on_client(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            if request.startswith(b"GET "):
+                body = self.render().encode("utf-8")
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            else:
+                writer.write(b"HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.exception("metrics request failed: {}".format(e))
+        finally:
+            writer.close()
+
+    async def run(self):
+        try:
+            server = await asyncio.start_server(self.__on_client, self.host, self.port, reuse_address=True)
+        except OSError as e:
+            # metrics are not worth stopping the gateway for
+            logger.warning("metrics not available on port {}: {}".format(self.port, e))
+            return
+        logger.info("metrics on http://{}:{}/metrics".format(self.host, self.port))
+        async with server:
+            await server.serve_forever()
+
+
+async def publish_periodically(gateways, publish, interval_ms):
+    ''' retained json summary per device on 'plc/<device>/metrics' every 'interval_ms' '''
+    previous = {}
+    while True:
+        await asyncio.sleep(interval_ms/1000)
+        for gw in gateways:
+            summary = device_metrics(gw, previous.get(gw.name), interval_ms)
+            previous[gw.name] = summary["sets"]
+            publish("plc/{}/metrics".format(gw.name), json.dumps(summary))
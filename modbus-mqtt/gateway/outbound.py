@@ -0,0 +1,204 @@
+import asyncio
+import collections
+import itertools
+import logging
+import threading
+
+from metrics import Histogram
+from scheduler import now_ms
+from tracing import tracer
+
+logger = logging.getLogger('outbound')
+logger.setLevel(logging.INFO)
+
+
+class OutboundMessage(object):
+
+    __slots__ = ("topic", "payload", "retain", "timestamp", "trace_start")
+
+    def __init__(self, topic, payload, retain, timestamp):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+        self.timestamp = timestamp
+        self.trace_start = tracer.begin()
+
+
+class OutboundQueue(object):
+    '''
+    Bounded stage between the entities and the mqtt client. States are coalesced per
+    topic, only the newest payload of a topic waits to be sent, so an outage or a slow
+    broker leaves at most one message per state topic. Events are never coalesced.
+
+    At most 'max_inflight' messages are handed to the client until it reports them as
+    written (on_publish), nothing is handed over while disconnected. When the queue
+    holds 'max_size' messages the oldest event is dropped. States are never dropped,
+    a dropped state would not be sent again until its value changes, their number is
+    bounded by the number of state topics anyway. 'congested' turns on at 3/4 of
+    'max_size' and off again at 1/4, the scheduler holds back polls meanwhile. There is
+    no backpressure while disconnected: holding back polls would not drain the queue,
+    it would only stop the polling and the rules until the broker is back.
+
+    All state is kept on the event loop thread, calls from other threads are passed
+    to it with 'call_soon_threadsafe'. The mqtt client runs from the import on, calls
+    made before 'start' are kept and run in order once the loop is known.
+    '''
+
+    STATS_INTERVAL_MS = 60000
+
+    def __init__(self, client, max_size=1000, max_inflight=64, name="outbound"):
+        self.client = client
+        self.max_size = max_size
+        self.max_inflight = max_inflight
+        self.name = name
+
+        self.pending = {}
+        self.events = collections.deque()
+        self.event_seq = itertools.count()
+        self.inflight = {}
+        self.connected = False
+        self.congested = False
+        self.loop = None
+        self.thread_id = None
+        self.early = []
+        self.lock = threading.Lock()
+
+        # statistics
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.latency_ms = 0
+        self.max_latency_ms = 0
+        self.latency = Histogram()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __call(self, callback, *args):
+        ''' run 'callback' on the event loop thread '''
+        if threading.get_ident() == self.thread_id:
+            callback(*args)
+            return
+        if self.loop is None:
+            with self.lock:
+                if self.loop is None:
+                    self.early.append((callback, args))
+                    return
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def start(self, loop):
+        ''' the calling thread runs 'loop' and owns the state from now on, the calls kept before run first '''
+        with self.lock:
+            self.loop = loop
+            self.thread_id = threading.get_ident()
+            early, self.early = self.early, []
+        # calls from other threads arriving meanwhile are scheduled on the loop, after these
+        for callback, args in early:
+            callback(*args)
+
+    def is_congested(self):
+        return self.congested and self.connected
+
+    # producers
+    def publish(self, topic, payload, retain=False, event=False):
+        self.__call(self.__put, topic, payload, retain, event)
+
+    def __put(self, topic, payload, retain, event):
+        message = OutboundMessage(topic, payload, retain, now_ms())
+        if event:
+            key = ("event", next(self.event_seq))
+            self.events.append(key)
+        else:
+            key = topic
+            queued = self.pending.get(key)
+            if queued is not None:
+                # the newer state replaces the queued one, in its place in the queue
+                queued.payload = payload
+                queued.retain = retain
+                self.coalesced += 1
+                return
+
+        if len(self.pending) >= self.max_size and len(self.events) > 0:
+            self.__drop()
+        self.pending[key] = message
+        self.max_depth = max(self.max_depth, len(self.pending))
+        if len(self.pending) >= self.max_size*3//4:
+            self.congested = True
+        self.__send()
+
+    def __drop(self):
+        message = self.pending.pop(self.events.popleft())
+        self.dropped += 1
+        logger.warning("{}: queue full, dropped {}".format(self.name, message.topic))
+
+    # sender
+    def __send(self):
+        while self.connected and len(self.pending) > 0 and len(self.inflight) < self.max_inflight:
+            key = next(iter(self.pending))
+            message = self.pending.pop(key)
+            if len(self.events) > 0 and self.events[0] == key:
+                self.events.popleft()
+
+            info = self.client.publish(message.topic, message.payload, retain=message.retain)
+            self.inflight[info.mid] = message
+            self.published += 1
+
+        if self.congested and len(self.pending) <= self.max_size//4:
+            self.congested = False
+
+    # client callbacks, called on the network thread of the client
+    def on_connect(self):
+        self.__call(self.__on_connect)
+
+    def __on_connect(self):
+        # whatever was in flight is gone with the old connection
+        self.inflight = {}
+        self.connected = True
+        self.__send()
+
+    def on_disconnect(self):
+        self.__call(self.__on_disconnect)
+
+    def __on_disconnect(self):
+        self.connected = False
+
+    def on_publish(self, client, userdata, mid):
+        self.__call(self.__on_publish, mid)
+
+    def __on_publish(self, mid):
+        message = self.inflight.pop(mid, None)
+        if message is None:
+            # published by someone else on the same client
+            return
+        tracer.async_span(message.trace_start, "publish", self.name, {"topic": message.topic})
+        latency_ms = now_ms() - message.timestamp
+        self.latency_ms = (self.latency_ms*7 + latency_ms)/8
+        self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+        self.latency.observe(latency_ms)
+        self.__send()
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "inflight": len(self.inflight),
+            "max_depth": self.max_depth,
+            "published": self.published,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "latency_ms": self.latency_ms,
+            "max_latency_ms": self.max_latency_ms,
+            "congested": self.congested
+        }
+
+    def log_stats(self):
+        logger.info("{}: depth={depth}, inflight={inflight}, max_depth={max_depth}, published={published}, coalesced={coalesced}, dropped={dropped}, avg_latency_ms={latency_ms:.0f}, max_latency_ms={max_latency_ms}, congested={congested}".format(
+            self.name, **self.stats()))
+
+    async def run(self):
+        self.start(asyncio.get_running_loop())
+        self.__send()
+
+        while True:
+            await asyncio.sleep(OutboundQueue.STATS_INTERVAL_MS/1000)
+            self.log_stats()
@@ -0,0 +1,183 @@
+import logging
+
+import entity
+from decoder import ResponseBuffer
+
+logger = logging.getLogger('planner')
+logger.setLevel(logging.INFO)
+
+# modbus PDU limits for a single read request
+MAX_READ_COUNT = {
+    entity.TYPE_COIL: 2000,
+    entity.TYPE_REGISTER: 125
+}
+
+
+class ReadSlice(object):
+    ''' part of a read request belonging to 'count' entities of an entity set, starting at entity 'first' '''
+
+    def __init__(self, entity_set, offset, first, count):
+        self.entity_set = entity_set
+        self.offset = offset
+        self.first = first
+        self.count = count
+
+    @property
+    def address(self):
+        return self.entity_set.modbus_class.read_offset + self.first*self.entity_set.modbus_class.data_size
+
+    @property
+    def size(self):
+        return self.count*self.entity_set.modbus_class.data_size
+
+    @property
+    def end(self):
+        return self.address + self.size
+
+    def __str__(self):
+        return "{}[{}:{}]".format(self.entity_set.name, self.first, self.first+self.count)
+
+
+class ReadRequest(object):
+    ''' a single modbus read, fanned out to the entity set slices it covers '''
+
+    def __init__(self, data_type, address, count, slices):
+        self.data_type = data_type
+        self.address = address
+        self.count = count
+        self.slices = slices
+        self.buffer = None
+
+    def dispatch(self, timestamp, data):
+        ''' decode the raw response data, returns the number of changed entities '''
+        # the merge may still grow the request after creation, the buffer is sized on first use
+        if self.buffer is None:
+            self.buffer = ResponseBuffer(self.data_type, self.count)
+        values = self.buffer.decode(data)
+
+        changed = 0
+        for s in self.slices:
+            changed += s.entity_set.on_modbus_data(timestamp, values, s.offset, s.first, s.count)
+        return changed
+
+    def split(self):
+        ''' one request per slice, used when the device rejects a merged read '''
+        return [
+            ReadRequest(self.data_type, s.address, s.size, [ReadSlice(s.entity_set, 0, s.first, s.count)])
+            for s in self.slices
+        ]
+
+    def __str__(self):
+        return "ReadRequest(data_type={}, address={}, count={}, slices=[{}])".format(
+            self.data_type,
+            self.address,
+            self.count,
+            ", ".join(str(s) for s in self.slices)
+        )
+
+
+class ReadGroup(object):
+    ''' all requests that are due at the same time '''
+
+    def __init__(self, interval_ms, requests, min_interval_ms=None, max_interval_ms=None):
+        self.interval_ms = interval_ms
+        self.requests = requests
+        self.min_interval_ms = min_interval_ms
+        self.max_interval_ms = max_interval_ms
+
+    def cost(self):
+        ''' number of modbus requests per run '''
+        return len(self.requests)
+
+    @property
+    def priority(self):
+        return max(s.entity_set.priority for r in self.requests for s in r.slices)
+
+    def key(self):
+        ''' groups with equal keys read the same ranges of the same sets at the same rate '''
+        return (self.interval_ms, self.min_interval_ms, self.max_interval_ms, self.priority, tuple(
+            (r.data_type, r.address, r.count, tuple((s.entity_set, s.offset, s.first, s.count) for s in r.slices))
+            for r in self.requests
+        ))
+
+    @property
+    def entity_sets(self):
+        sets = []
+        [sets.append(s.entity_set) for r in self.requests for s in r.slices if s.entity_set not in sets]
+        return sets
+
+    @property
+    def name(self):
+        names = []
+        [names.append(s.entity_set.name) for r in self.requests for s in r.slices if s.entity_set.name not in names]
+        return "+".join(names)
+
+
+class ReadPlanner(object):
+    '''
+    Builds the read plan from the entity set definitions: sets polled with the same
+    interval and the same data type are merged into one request when they are at most
+    'max_gap' addresses apart, sets larger than the PDU limit are split into legal chunks.
+    Entities are never split between two requests. Sets with an adaptive poll interval
+    get a read group of their own.
+    '''
+
+    def __init__(self, max_gap=None, max_count=None):
+        self.max_gap = max_gap if max_gap is not None else {}
+        self.max_count = max_count if max_count is not None else MAX_READ_COUNT
+
+    def segments(self, entity_set):
+        ''' split an entity set into slices that fit into a single request '''
+        data_size = entity_set.modbus_class.data_size
+        max_entities = self.max_count[entity_set.modbus_class.data_type] // data_size
+        if max_entities < 1:
+            raise Exception("data_size={} exceeds the modbus read limit: {}".format(data_size, entity_set.modbus_class))
+
+        return [
+            ReadSlice(entity_set, 0, first, min(max_entities, len(entity_set)-first))
+            for first in range(0, len(entity_set), max_entities)
+        ]
+
+    def merge(self, data_type, segments):
+        max_gap = self.max_gap.get(data_type, 0)
+        max_count = self.max_count[data_type]
+
+        requests = []
+        current = None
+        for s in sorted(segments, key=lambda s: (s.address, s.end)):
+            if current is not None \
+                    and s.address - (current.address+current.count) <= max_gap \
+                    and max(s.end, current.address+current.count) - current.address <= max_count:
+                s.offset = s.address - current.address
+                current.count = max(s.end, current.address+current.count) - current.address
+                current.slices.append(s)
+            else:
+                current = ReadRequest(data_type, s.address, s.size, [s])
+                requests.append(current)
+
+        return requests
+
+    def plan(self, entity_sets):
+        groups = {}
+        for eset in entity_sets:
+            if len(eset) == 0:
+                continue
+            adaptive = eset.name if eset.adaptive else ""
+            key = (eset.poll_delay_ms, adaptive, eset.modbus_class.data_type)
+            groups.setdefault(key, []).extend(self.segments(eset))
+
+        plan = {}
+        for (interval_ms, adaptive, data_type), segments in sorted(groups.items()):
+            plan.setdefault((interval_ms, adaptive), []).extend(self.merge(data_type, segments))
+
+        read_groups = []
+        for (interval_ms, adaptive), requests in sorted(plan.items()):
+            eset = requests[0].slices[0].entity_set
+            if adaptive:
+                read_groups.append(ReadGroup(eset.poll_min_ms, requests, eset.poll_min_ms, eset.poll_max_ms))
+                logger.info("read plan every {}-{}ms: {}".format(eset.poll_min_ms, eset.poll_max_ms, ", ".join(str(r) for r in requests)))
+            else:
+                read_groups.append(ReadGroup(interval_ms, requests))
+                logger.info("read plan every {}ms: {}".format(interval_ms, ", ".join(str(r) for r in requests)))
+
+        return read_groups
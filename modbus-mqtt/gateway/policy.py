@@ -0,0 +1,155 @@
+import logging
+
+from scheduler import now_ms
+
+logger = logging.getLogger('policy')
+logger.setLevel(logging.INFO)
+
+
+class PublishPolicy(object):
+    '''
+    When a changed state of an entity is published:
+
+    - 'deadband': numeric values closer than this to the last published value are held back,
+    - 'deadband_pct': the same, in percent of the last published value,
+    - 'min_interval_ms': at most one publish per topic within this interval,
+    - 'max_interval_ms': the current value is published again when nothing was published
+      for this long (heartbeat).
+
+    Held back values are not lost: a value held back by 'min_interval_ms' is published at
+    the end of the interval, a value held back by the deadband once it did not change for
+    SETTLE_MS (or with the next heartbeat), unless the value returns to the published one.
+    '''
+
+    KEYS = ("deadband", "deadband_pct", "min_interval_ms", "max_interval_ms")
+
+    SETTLE_MS = 5000
+
+    def __init__(self, deadband=0, deadband_pct=0, min_interval_ms=0, max_interval_ms=0):
+        self.deadband = deadband
+        self.deadband_pct = deadband_pct
+        self.min_interval_ms = min_interval_ms
+        self.max_interval_ms = max_interval_ms
+
+    @staticmethod
+    def from_definition(definition, defaults):
+        ''' the policy of an entity definition ('defaults' are the set defaults), None without any of the KEYS '''
+        values = {}
+        for key in PublishPolicy.KEYS:
+            value = definition.get(key) if key in definition else defaults.get(key)
+            if value not in (None, ""):
+                values[key] = float(value) if key.startswith("deadband") else int(value)
+        return PublishPolicy(**values) if values else None
+
+    def within_deadband(self, published, value):
+        if not isinstance(value, (int, float)) or not isinstance(published, (int, float)):
+            return False
+        delta = abs(value - published)
+        return delta < self.deadband or delta < abs(published)*self.deadband_pct/100
+
+    def __str__(self):
+        return "PublishPolicy(deadband={}, deadband_pct={}, min_interval_ms={}, max_interval_ms={})".format(
+            self.deadband, self.deadband_pct, self.min_interval_ms, self.max_interval_ms)
+
+
+class TopicState(object):
+    ''' last published and held back value of a topic '''
+
+    __slots__ = ("value", "retain", "timestamp", "pending", "pending_retain", "due", "timer", "heartbeat")
+
+    NONE = object()
+
+    def __init__(self):
+        self.value = TopicState.NONE
+        self.retain = True
+        self.timestamp = None
+        self.pending = TopicState.NONE
+        self.pending_retain = True
+        self.due = None
+        self.timer = None
+        self.heartbeat = None
+
+
+class PublishFilter(object):
+    '''
+    Applies a PublishPolicy to the publishes of one entity, a TopicState per topic
+    and at most two armed timers per topic. 'publish(topic, value, retain)' sends a
+    message, 'call_at(deadline, callback)' arms a timer on the entity clock.
+    '''
+
+    def __init__(self, policy, publish, call_at):
+        self.policy = policy
+        self.publish = publish
+        self.call_at = call_at
+        self.topics = {}
+
+        # statistics
+        self.held = 0
+
+    def reset(self):
+        for state in self.topics.values():
+            for timer in (state.timer, state.heartbeat):
+                if timer is not None:
+                    timer.cancel()
+        self.topics = {}
+
+    def offer(self, topic, value, retain, timestamp=None):
+        timestamp = timestamp if timestamp is not None else now_ms()
+        state = self.topics.get(topic)
+        if state is None:
+            state = TopicState()
+            self.topics[topic] = state
+
+        policy = self.policy
+        if state.timestamp is None:
+            self.__publish(topic, state, value, retain, timestamp)
+        elif value == state.value:
+            # back at the published value, nothing left to send
+            state.pending = TopicState.NONE
+        elif policy.within_deadband(state.value, value):
+            self.__hold(topic, state, value, retain, max(timestamp + PublishPolicy.SETTLE_MS, state.timestamp + policy.min_interval_ms))
+        elif timestamp - state.timestamp < policy.min_interval_ms:
+            self.__hold(topic, state, value, retain, state.timestamp + policy.min_interval_ms)
+        else:
+            self.__publish(topic, state, value, retain, timestamp)
+
+    def __publish(self, topic, state, value, retain, timestamp):
+        state.value = value
+        state.retain = retain
+        state.timestamp = timestamp
+        state.pending = TopicState.NONE
+        self.publish(topic, value, retain)
+
+        if self.policy.max_interval_ms > 0 and state.heartbeat is None:
+            state.heartbeat = self.call_at(timestamp + self.policy.max_interval_ms, lambda deadline: self.__on_heartbeat(topic, state, deadline))
+
+    def __hold(self, topic, state, value, retain, due):
+        self.held += 1
+        state.pending = value
+        state.pending_retain = retain
+        if state.timer is not None and state.due <= due:
+            # the armed timer checks the new due time when it fires
+            state.due = due
+            return
+        if state.timer is not None:
+            state.timer.cancel()
+        state.due = due
+        state.timer = self.call_at(due, lambda deadline: self.__on_due(topic, state, deadline))
+
+    def __on_due(self, topic, state, deadline):
+        state.timer = None
+        if state.pending is TopicState.NONE:
+            return
+        if deadline < state.due:
+            state.timer = self.call_at(state.due, lambda deadline: self.__on_due(topic, state, deadline))
+            return
+        self.__publish(topic, state, state.pending, state.pending_retain, deadline)
+
+    def __on_heartbeat(self, topic, state, deadline):
+        state.heartbeat = None
+        if deadline - state.timestamp < self.policy.max_interval_ms:
+            state.heartbeat = self.call_at(state.timestamp + self.policy.max_interval_ms, lambda deadline: self.__on_heartbeat(topic, state, deadline))
+            return
+        value = state.pending if state.pending is not TopicState.NONE else state.value
+        retain = state.pending_retain if state.pending is not TopicState.NONE else state.retain
+        self.__publish(topic, state, value, retain, deadline)
@@ -0,0 +1,124 @@
+import json
+import logging
+import struct
+
+import entity
+from scheduler import wall_ms
+
+logger = logging.getLogger('recorder')
+logger.setLevel(logging.INFO)
+
+MAGIC = b"MMQR"
+HEADER = struct.Struct("<4sI")
+# wall clock timestamp in ms, data type, address, count, data length, number of entity sets
+RECORD = struct.Struct("<qBHHHB")
+
+DATA_TYPES = [entity.TYPE_COIL, entity.TYPE_REGISTER]
+
+
+def layout(entity_sets):
+    ''' what is needed to build the entity sets again, stored in the header of the log '''
+    return [
+        {
+            "set_id": eset.name,
+            "entity_type": eset.entity_type.__name__ if eset.entity_type is not None else None,
+            "data_type": eset.modbus_class.data_type,
+            "data_size": eset.modbus_class.data_size,
+            "read_offset": eset.modbus_class.read_offset,
+            "write_offset": eset.modbus_class.write_offset,
+            "read_only": eset.modbus_class.read_only,
+            "defaults": eset.modbus_class.defaults,
+            "entities": eset.definitions if eset.definitions is not None else [None]*len(eset)
+        }
+        for eset in entity_sets
+    ]
+
+
+class Recorder(object):
+    '''
+    Append-only log of the raw read responses of a device: every record holds the
+    response data as received (packed coils, big endian registers), the address range
+    and the indexes of the entity sets it covers. The header holds the layout of the
+    entity sets as json. Every start of the gateway writes a new log, so a record cut
+    off by a crash stays at the end of its log.
+
+    Records are buffered, 'flush' writes them out. Recording stops when the log
+    reaches 'max_bytes'.
+    '''
+
+    def __init__(self, path, entity_sets, max_bytes=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index = {id(eset): idx for idx, eset in enumerate(entity_sets)}
+
+        header_json = json.dumps(layout(entity_sets)).encode("utf-8")
+        self.file = open(path, "wb", buffering=1 << 16)
+        self.file.write(HEADER.pack(MAGIC, len(header_json)) + header_json)
+        self.size = self.file.tell()
+        self.stopped = False
+
+        # statistics
+        self.records = 0
+
+    def record(self, timestamp, request, data):
+        if self.stopped:
+            return
+        try:
+            sets = bytes(self.index[id(s.entity_set)] for s in request.slices)
+        except KeyError:
+            # read of a set removed by a reload, in flight while the log was started
+            return
+        self.file.write(RECORD.pack(wall_ms(timestamp), DATA_TYPES.index(request.data_type), request.address, request.count, len(data), len(sets)))
+        self.file.write(sets)
+        self.file.write(data)
+        self.size += RECORD.size + len(sets) + len(data)
+        self.records += 1
+
+        if self.max_bytes > 0 and self.size >= self.max_bytes:
+            logger.warning("{} reached {} bytes, recording stopped".format(self.path, self.size))
+            self.stopped = True
+            self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def open(path, entity_sets, max_bytes=0):
+        ''' the recorder of the entity sets, None if the log can not be written '''
+        try:
+            recorder = Recorder(path, entity_sets, max_bytes=max_bytes)
+        except OSError as e:
+            logger.warning("recording to {} not available: {}".format(path, e))
+            return None
+        logger.info("recording read responses to {}".format(path))
+        return recorder
+
+
+class RecordReader(object):
+    ''' reads a log written by 'Recorder': 'layout' and the records as (timestamp, data_type, address, count, sets, data) '''
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        magic, size = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC:
+            raise Exception("{} is not a recording".format(path))
+        self.layout = json.loads(self.file.read(size).decode("utf-8"))
+
+    def __iter__(self):
+        while True:
+            head = self.file.read(RECORD.size)
+            if len(head) < RECORD.size:
+                # end of the log, or a record cut off by a crash
+                return
+            timestamp, data_type, address, count, length, set_count = RECORD.unpack(head)
+            sets = self.file.read(set_count)
+            data = self.file.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, DATA_TYPES[data_type], address, count, sets, data
+
+    def close(self):
+        self.file.close()
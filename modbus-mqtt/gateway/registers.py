@@ -0,0 +1,203 @@
+from array import array
+import struct
+import sys
+
+# value type -> struct code, number of registers
+VALUE_TYPES = {
+    "uint16": ("H", 1),
+    "int16": ("h", 1),
+    "uint32": ("I", 2),
+    "int32": ("i", 2),
+    "float32": ("f", 2),
+    "uint64": ("Q", 4),
+    "int64": ("q", 4),
+    "float64": ("d", 4)
+}
+
+# ValueFormat instances by their arguments, see ValueFormat.from_definition
+FORMATS = {}
+
+# the register values are native words, on a little endian host their bytes are swapped
+# compared to the wire; big endian bytes of the words are called 'wire' below
+NATIVE_IS_WIRE = sys.byteorder == "big"
+
+
+def native_bytes(words):
+    ''' the bytes of a memoryview of native words, or of a list of words '''
+    return words.tobytes() if isinstance(words, memoryview) else array('H', words).tobytes()
+
+
+def swap_bytes(data):
+    ''' the bytes of 'data' with the two bytes of every word swapped '''
+    words = array('H')
+    words.frombytes(data)
+    words.byteswap()
+    return words.tobytes()
+
+
+class ValueFormat(object):
+    '''
+    Typed value of a register entity: 'value_type' is one of VALUE_TYPES, 'word_order'
+    tells whether the first register holds the high ('big') or the low ('little') word
+    and 'byte_order' whether a register holds its high byte first ('big', the modbus
+    default) or last. The decoded value is 'raw*scale + value_offset', rounded to
+    'precision' decimals when set.
+
+    The entity definitions (or the set defaults) hold the same keys, the defaults keep
+    the previous behaviour: an unsigned value of 'data_size' registers, low word first.
+    '''
+
+    KEYS = ("value_type", "word_order", "byte_order", "scale", "value_offset", "precision")
+
+    def __init__(self, value_type="uint16", word_order="little", byte_order="big", scale=1, value_offset=0, precision=None):
+        if value_type not in VALUE_TYPES:
+            raise Exception("value_type not supported: {}, one of {}".format(value_type, ", ".join(VALUE_TYPES)))
+        if word_order not in ("big", "little") or byte_order not in ("big", "little"):
+            raise Exception("word_order and byte_order must be big or little: {}, {}".format(word_order, byte_order))
+
+        self.value_type = value_type
+        self.code, self.words = VALUE_TYPES[value_type]
+        self.word_order = word_order
+        self.byte_order = byte_order
+        self.scale = scale
+        self.value_offset = value_offset
+        self.precision = precision
+
+        # wire bytes read big endian cover the high word first/high byte first order, read
+        # little endian the low word first/low byte first order, the two mixed orders are
+        # the same with the bytes of every word swapped. This holds for single registers
+        # too, so they end up in the group of their word order.
+        self.wire = byte_order == word_order
+        self.prefix = ">" if word_order == "big" else "<"
+        self.struct = struct.Struct(self.prefix + self.code)
+        self.identity = scale == 1 and value_offset == 0 and precision is None
+
+    @staticmethod
+    def from_definition(definition, defaults, data_size):
+        ''' the format of an entity definition, 'defaults' are the set defaults '''
+        def get(key, default=None):
+            value = definition.get(key) if key in definition else defaults.get(key)
+            return value if value not in (None, "") else default
+
+        value_type = get("value_type", "uint16" if data_size == 1 else "uint32")
+        key = (
+            value_type,
+            get("word_order", "little"),
+            get("byte_order", "big"),
+            float(get("scale")) if get("scale") is not None else 1,
+            float(get("value_offset")) if get("value_offset") is not None else 0,
+            int(get("precision")) if get("precision") is not None else None
+        )
+        # formats are immutable, the entities of a bank share one
+        value_format = FORMATS.get(key)
+        if value_format is None:
+            value_format = ValueFormat(*key)
+            FORMATS[key] = value_format
+        if value_format.words > data_size:
+            raise Exception("value_type {} needs {} registers, data_size is {}".format(value_type, value_format.words, data_size))
+        return value_format
+
+    def convert(self, raw):
+        if self.identity:
+            return raw
+        value = raw*self.scale + self.value_offset
+        return round(value, self.precision) if self.precision is not None else value
+
+    def view(self, native):
+        ''' the bytes to unpack the value from, 'native' are the bytes of the native words '''
+        return native if self.wire == NATIVE_IS_WIRE else swap_bytes(native)
+
+    def decode(self, data):
+        ''' value of the native words 'data' (a memoryview or a list) '''
+        return self.convert(self.struct.unpack_from(self.view(native_bytes(data)))[0])
+
+    def encode(self, value):
+        ''' native words of 'value', for writing it '''
+        raw = (value - self.value_offset)/self.scale if not self.identity else value
+        if self.code not in "fd":
+            raw = int(round(raw))
+        words = array('H')
+        words.frombytes(self.view(self.struct.pack(raw)))
+        return list(words)
+
+
+class RegisterBlockDecoder(object):
+    '''
+    Decodes the typed values of a run of entities of a register set at once: the
+    entities are grouped by the byte view and order they need, each group is decoded
+    by one precompiled struct covering the whole run, registers of other groups and
+    unused registers are skipped as padding. Most sets use a single order, a run is
+    decoded with a single 'unpack_from' then.
+
+    'formats' holds the ValueFormat of every entity of the set (None for entities
+    without one), the compiled structs are cached per (first, count) run.
+    '''
+
+    def __init__(self, formats, data_size):
+        self.formats = formats
+        self.data_size = data_size
+        self.runs = {}
+
+    def compile(self, first, count):
+        groups = {}
+        for i in range(count):
+            value_format = self.formats[first+i]
+            if value_format is None:
+                continue
+            groups.setdefault((value_format.wire, value_format.prefix), []).append(i)
+
+        compiled = []
+        for (wire, prefix), indexes in groups.items():
+            fmt = [prefix]
+            pos = 0
+            for i in indexes:
+                start = i*self.data_size*2
+                if start > pos:
+                    fmt.append("{}x".format(start - pos))
+                fmt.append(self.formats[first+i].code)
+                pos = start + self.formats[first+i].words*2
+            formats = [self.formats[first+i] for i in indexes]
+            # a bank of the same quantity shares scale, offset and precision, converted in one comprehension
+            conversions = {(f.scale, f.value_offset, f.precision) for f in formats}
+            uniform = conversions.pop() if len(conversions) == 1 else None
+            compiled.append((wire, struct.Struct("".join(fmt)), indexes, formats, uniform))
+        return compiled
+
+    @staticmethod
+    def convert(raw, formats, uniform):
+        if uniform is None:
+            return [f.convert(value) for f, value in zip(formats, raw)]
+        scale, value_offset, precision = uniform
+        if scale == 1 and value_offset == 0 and precision is None:
+            return raw
+        if precision is None:
+            return [value*scale + value_offset for value in raw]
+        return [round(value*scale + value_offset, precision) for value in raw]
+
+    def decode(self, values, offset, first, count):
+        '''
+        values of the 'count' entities starting at 'first', their registers start at
+        'offset' within the native words 'values', None for entities without a format
+        '''
+        run = self.runs.get((first, count))
+        if run is None:
+            run = self.compile(first, count)
+            self.runs[(first, count)] = run
+
+        native = native_bytes(values[offset:offset+count*self.data_size])
+        swapped = None
+        decoded = [None]*count
+        for wire, block_struct, indexes, formats, uniform in run:
+            if wire == NATIVE_IS_WIRE:
+                data = native
+            else:
+                if swapped is None:
+                    swapped = swap_bytes(native)
+                data = swapped
+            group = RegisterBlockDecoder.convert(block_struct.unpack_from(data), formats, uniform)
+            if len(indexes) == count:
+                decoded = list(group)
+            else:
+                for i, value in zip(indexes, group):
+                    decoded[i] = value
+        return decoded
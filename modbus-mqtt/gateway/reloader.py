@@ -0,0 +1,278 @@
+import asyncio
+import json
+import logging
+import os
+
+import aggregate
+import config
+from config import text_to_dict
+from entity import ModbusClass, BlindEntity, BinarySensorEntity, ButtonEntity, RelayEntity, SensorEntity, TYPE_COIL, TYPE_REGISTER
+from gateway import router
+from rules import RuleEngine
+
+logger = logging.getLogger('reloader')
+logger.setLevel(logging.INFO)
+
+ENTITY_CLASSES = {
+    "binary_sensor": BinarySensorEntity,
+    "button": ButtonEntity,
+    "blind": BlindEntity,
+    "relay": RelayEntity,
+    "sensor": SensorEntity
+}
+
+# entity set options changed on the running set, changes of the others replace the set
+POLL_OPTIONS = ["poll_delay_ms", "poll_min_ms", "poll_max_ms", "priority", "aggregate"]
+
+
+def set_items(set_config):
+    return [text_to_dict(item) for item in set_config.get("entities", [])]
+
+
+def poll_options(set_config):
+    return dict(
+        poll_delay_ms=set_config.get("poll_delay_ms", 250),
+        poll_min_ms=set_config.get("poll_min_ms"),
+        poll_max_ms=set_config.get("poll_max_ms"),
+        priority=set_config.get("priority", 0),
+        aggregate_kind=set_config.get("aggregate")
+    )
+
+
+def modbus_class(set_config):
+    return ModbusClass(
+        set_config.get("set_id"),
+        read_offset=set_config.get("read_offset", 0),
+        write_offset=set_config.get("write_offset", 0),
+        read_only=set_config.get("read_only", True),
+        data_type=set_config.get("data_type"),
+        data_size=set_config.get("data_size", 1),
+        defaults=text_to_dict(set_config.get("defaults", ""))
+    )
+
+
+def register_set(gw, set_config):
+    ''' the entity set of an 'entity_sets' entry of the options, registered on 'gw' '''
+    return gw.register_entity_set(
+        modbus_class(set_config),
+        ENTITY_CLASSES.get(set_config.get("entity_type"), None),
+        set_items(set_config),
+        set_config.get("entity_count", 0),
+        **poll_options(set_config)
+    )
+
+
+def check_set(set_config):
+    ''' raises when the entity set can not be registered, before anything is changed '''
+    set_id = set_config.get("set_id")
+    items = set_items(set_config)
+    if len(items) != set_config.get("entity_count", 0):
+        raise Exception("set_id={}: {} entities for entity_count={}".format(set_id, len(items), set_config.get("entity_count", 0)))
+    names = [item["name"] for item in items if item.get("name")]
+    dupes = config.duplicates(names)
+    if len(dupes) > 0:
+        raise Exception("names must be unique within set_id={}, duplicates: {}".format(set_id, dupes))
+    if len(names) > 0 and set_config.get("entity_type") not in ENTITY_CLASSES:
+        raise Exception("set_id={}: entity_type not supported: {}".format(set_id, set_config.get("entity_type")))
+    if len(names) > 0 and set_config.get("data_type") not in [TYPE_COIL, TYPE_REGISTER]:
+        raise Exception("set_id={}: data_type not supported: {}".format(set_id, set_config.get("data_type")))
+    if set_config.get("aggregate") and set_config.get("aggregate") not in aggregate.AGGREGATES:
+        raise Exception("set_id={}: aggregate not supported: {}".format(set_id, set_config.get("aggregate")))
+    if len(names) > 0:
+        entity_class = ENTITY_CLASSES[set_config.get("entity_type")]
+        mc = modbus_class(set_config)
+        for item in items:
+            if item.get("name"):
+                try:
+                    entity_class.check(item, mc)
+                except Exception as e:
+                    raise Exception("set_id={}, entity {}: {}".format(set_id, item["name"], e))
+
+
+class SetChanges(object):
+    '''
+    Changes of the 'entity_sets' of a device, by set_id: 'removed' and 'added' sets, sets
+    'replaced' by a new one, sets with 'reconfigured' poll options and 'entities', the
+    indexes of the changed entities of a set.
+    '''
+
+    def __init__(self, old_sets, new_sets):
+        self.old = {set_config.get("set_id"): set_config for set_config in old_sets}
+        self.new = {set_config.get("set_id"): set_config for set_config in new_sets}
+        self.removed = [set_id for set_id in self.old if set_id not in self.new]
+        self.added = []
+        self.replaced = []
+        self.reconfigured = []
+        self.entities = {}
+
+        for set_id, set_config in self.new.items():
+            old = self.old.get(set_id)
+            if old == set_config:
+                continue
+            if old is None:
+                self.added.append(set_id)
+                continue
+
+            options = [k for k in set(old) | set(set_config) if old.get(k) != set_config.get(k)]
+            if any(k not in POLL_OPTIONS and k != "entities" for k in options):
+                self.replaced.append(set_id)
+                continue
+            if any(k in POLL_OPTIONS for k in options):
+                self.reconfigured.append(set_id)
+            if "entities" in options:
+                self.entities[set_id] = [idx for idx, (old_item, item) in enumerate(zip(set_items(old), set_items(set_config))) if old_item != item]
+
+
+class ConfigReloader(object):
+    '''
+    Applies changes of the options file to the running gateways, every 'interval_s' when
+    the file was modified or at once on a message on RELOAD_TOPIC. The entity sets of
+    every device are compared with the previous options by set_id:
+
+    - sets no longer configured are removed, new ones registered
+    - a set with changed poll options gets them in place, its entities and values stay
+    - a set with changed entities gets new entities for the changed points only
+    - a set with any other change (addresses, types, size, defaults) is replaced
+
+    Removed entities drop their command routes and their discovery configs are cleared.
+    Read groups planned exactly as before keep polling on their schedule, the rules are
+    built again. Devices added, removed or with changed connection options, and the other
+    options of the add-on, need a restart.
+    '''
+
+    def __init__(self, gateways, path, devices, rule_defs, interval_s=10):
+        self.gateways = {gw.name: gw for gw in gateways}
+        self.path = path
+        self.interval_s = interval_s
+        self.devices = {dev["name"]: dev for dev in devices}
+        self.mtime = self.stat()
+        self.loop = None
+        # at startup a broken rule stops the gateway like any other configuration error
+        self.rules = self.build_rules(rule_defs)
+
+        # statistics
+        self.reloads = 0
+        self.failures = 0
+
+        router.add(config.RELOAD_TOPIC, self.on_reload_command)
+
+    def stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def build_rules(self, rule_defs):
+        for gw in self.gateways.values():
+            gw.rules = None
+            for eset in gw.entity_sets:
+                for e in eset:
+                    e.rules = None
+        rules = None
+        if len(rule_defs) > 0:
+            rules = RuleEngine.build([text_to_dict(rule) for rule in rule_defs], list(self.gateways.values()))
+            for gw in self.gateways.values():
+                gw.rules = rules
+        return rules
+
+    def on_reload_command(self, msg):
+        # called from the mqtt thread
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.reload)
+
+    def reload(self):
+        ''' apply the options file, returns False when it was not applied '''
+        self.mtime = self.stat()
+        try:
+            with open(self.path) as json_file:
+                cfg = json.load(json_file)
+            devices = {dev["name"]: dev for dev in config.read_devices(cfg)}
+            for dev in devices.values():
+                for set_config in dev["entity_sets"]:
+                    check_set(set_config)
+        except Exception as e:
+            self.failures += 1
+            logger.error("{} not applied, keeping the running configuration: {}".format(self.path, e))
+            return False
+
+        logger.info("reloading {}".format(self.path))
+        changes = []
+        for name, dev in devices.items():
+            gw = self.gateways.get(name)
+            if gw is None:
+                logger.warning("device {} added, a restart is required to poll it".format(name))
+                continue
+            old = self.devices[name]
+            if {k: v for k, v in old.items() if k != "entity_sets"} != {k: v for k, v in dev.items() if k != "entity_sets"}:
+                logger.warning("connection options of device {} changed, a restart is required to apply them".format(name))
+            if old["entity_sets"] != dev["entity_sets"]:
+                changes.append((gw, SetChanges(old["entity_sets"], dev["entity_sets"]), dev["entity_sets"]))
+        for name in self.devices:
+            if name not in devices:
+                logger.warning("device {} removed, a restart is required to stop polling it".format(name))
+
+        # everything replaced is removed before anything is added: an entity renamed or moved
+        # to another set or device registers the routes and the discovery config of its name again
+        applied = True
+        try:
+            for gw, set_changes, entity_sets in changes:
+                self.remove_changed(gw, set_changes)
+            for gw, set_changes, entity_sets in changes:
+                self.add_changed(gw, set_changes, entity_sets)
+        except Exception as e:
+            applied = False
+            logger.exception("reload failed, a restart is required to apply {}: {}".format(self.path, e))
+        finally:
+            for gw, set_changes, entity_sets in changes:
+                gw.apply_changes()
+        if applied:
+            for gw, set_changes, entity_sets in changes:
+                # the connection keeps running with the options it was started with
+                self.devices[gw.name] = dict(self.devices[gw.name], entity_sets=entity_sets)
+
+        try:
+            self.rules = self.build_rules(cfg.get("rules", []))
+        except Exception as e:
+            self.rules = None
+            logger.error("rules disabled until the options are fixed: {}".format(e))
+
+        if not applied:
+            self.failures += 1
+            return False
+        self.reloads += 1
+        return True
+
+    def remove_changed(self, gw, changes):
+        entity_sets = {eset.name: eset for eset in gw.entity_sets}
+        for set_id in changes.removed + changes.replaced:
+            gw.remove_entity_set(entity_sets[set_id], set_items(changes.old[set_id]))
+        for set_id, indexes in changes.entities.items():
+            old_items = set_items(changes.old[set_id])
+            for idx in indexes:
+                gw.remove_entity(entity_sets[set_id], idx, old_items[idx])
+
+    def add_changed(self, gw, changes, new_sets):
+        entity_sets = {eset.name: eset for eset in gw.entity_sets}
+        for set_id in changes.reconfigured:
+            gw.reconfigure_entity_set(entity_sets[set_id], **poll_options(changes.new[set_id]))
+        for set_id, indexes in changes.entities.items():
+            items = set_items(changes.new[set_id])
+            for idx in indexes:
+                gw.add_entity(entity_sets[set_id], idx, items[idx])
+        for set_config in new_sets:
+            if set_config.get("set_id") in changes.added + changes.replaced:
+                register_set(gw, set_config)
+
+        # the order of the options, the snapshot and the records are laid out in it
+        order = [set_config.get("set_id") for set_config in new_sets]
+        gw.entity_sets.sort(key=lambda eset: order.index(eset.name))
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        if self.interval_s <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.interval_s)
+            if self.stat() != self.mtime:
+                logger.info("{} changed".format(self.path))
+                self.reload()
@@ -0,0 +1,86 @@
+import logging
+import threading
+
+from tracing import tracer
+
+logger = logging.getLogger('router')
+logger.setLevel(logging.INFO)
+
+
+def topic_filter(topic):
+    ''' the wildcard filter covering 'topic': plc/<set>/<entity>/set -> plc/<set>/+/set '''
+    levels = topic.split("/")
+    if len(levels) < 3:
+        return topic
+    levels[-2] = "+"
+    return "/".join(levels)
+
+
+class MqttRouter(object):
+    '''
+    Routes incoming messages to their handlers by a dict lookup on the exact topic.
+    The broker side uses one wildcard subscription per entity set and command instead
+    of a subscription per entity, all of them are sent in a single SUBSCRIBE and are
+    restored on every (re)connect.
+
+    Handlers are added from the main thread while the client calls back from its
+    network thread, the subscription state is guarded by a lock.
+    '''
+
+    def __init__(self, client, qos=0):
+        self.client = client
+        self.qos = qos
+        self.routes = {}
+        self.filters = []
+        self.pending = []
+        self.connected = False
+        self.lock = threading.Lock()
+
+        client.on_message = self.on_message
+
+    def add(self, topic, callback):
+        ''' route 'topic' to 'callback(msg)', the subscription is sent with the next flush '''
+        self.routes[topic] = callback
+        subscription = topic_filter(topic)
+        with self.lock:
+            if subscription not in self.filters:
+                self.filters.append(subscription)
+                self.pending.append(subscription)
+
+    def remove(self, topic):
+        ''' drop the route of 'topic' and the routes below it, the wildcard subscriptions stay '''
+        self.routes.pop(topic, None)
+        prefix = topic + "/"
+        for route in [route for route in self.routes if route.startswith(prefix)]:
+            del self.routes[route]
+
+    def flush(self):
+        ''' subscribe all filters added since the last flush, in one request '''
+        with self.lock:
+            if not self.connected or len(self.pending) == 0:
+                return
+            pending, self.pending = self.pending, []
+        logger.info("subscribing {} topic filters".format(len(pending)))
+        self.client.subscribe([(subscription, self.qos) for subscription in pending])
+
+    def on_connect(self):
+        # the broker may have dropped the session, subscribe everything again
+        with self.lock:
+            self.connected = True
+            self.pending = list(self.filters)
+        self.flush()
+
+    def on_disconnect(self):
+        with self.lock:
+            self.connected = False
+
+    def on_message(self, client, userdata, msg):
+        callback = self.routes.get(msg.topic)
+        if callback is None:
+            logger.debug("no route for {}".format(msg.topic))
+            return
+        tracer.instant("command", "mqtt commands", {"topic": msg.topic})
+        try:
+            callback(msg)
+        except Exception as e:
+            logger.exception("handler for {} failed: {}".format(msg.topic, e))
@@ -0,0 +1,158 @@
+import logging
+
+from scheduler import now_ms
+
+logger = logging.getLogger('rules')
+logger.setLevel(logging.INFO)
+
+
+class Rule(object):
+    '''
+    Binds an event of the 'trigger' entity to a command of the 'target' entity:
+
+        when=di/in0komlaz1,event=click,count=2,then=light/salon_gorne,action=TOGGLE
+
+    Events: 'click' and 'long' of buttons (optionally with the click 'count'), 'release'
+    after a long press, 'on' and 'off' edges of bit entities, 'above' and 'below' when a
+    sensor value crosses 'threshold'. The action is a payload of the set topic of the
+    target (ON/OFF/TOGGLE, OPEN/CLOSE/STOP, a position or a value).
+    '''
+
+    EVENTS = ["click", "long", "release", "on", "off", "above", "below"]
+
+    def __init__(self, name, trigger, event, target, action, count=None, threshold=None):
+        if event not in Rule.EVENTS:
+            raise Exception("rule {}: event not supported: {}, expected one of {}".format(name, event, ", ".join(Rule.EVENTS)))
+        if event in ["above", "below"] and threshold is None:
+            raise Exception("rule {}: event {} needs a threshold".format(name, event))
+
+        self.name = name
+        self.trigger = trigger
+        self.event = event
+        self.target = target
+        self.action = action
+        self.count = count
+        self.threshold = threshold
+
+        # statistics
+        self.fired = 0
+
+    def matches(self, event, value, old):
+        if self.event == "click":
+            return event == "click" and (self.count is None or value == self.count)
+        if self.event == "long":
+            return event == "long" and value != "RELEASE" and (self.count is None or value == self.count)
+        if self.event == "release":
+            return event == "long" and value == "RELEASE"
+        if old is None:
+            # the first value after a (re)start is no edge
+            return False
+        if self.event in ["on", "off"]:
+            return event == self.event
+        if self.event == "above":
+            return event == "value" and old <= self.threshold < value
+        return event == "value" and old >= self.threshold > value
+
+    def __str__(self):
+        return self.name
+
+
+class RuleEngine(object):
+    '''
+    Runs the configured rules inside the gateway: the command of a matching rule goes
+    straight into the write queue of the target device, without the round trip over
+    mqtt and homeassistant. The state of the target is read back and published as usual.
+
+    The latency from the edge that caused the event to the acknowledged write is
+    measured per rule, 'on_written' is called by the gateways for every written range.
+    '''
+
+    def __init__(self, rules):
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.trigger, []).append(rule)
+            rule.trigger.rules = self
+
+        # (gateway, data_type, address) -> (edge timestamp, rule)
+        self.pending = {}
+
+        # statistics
+        self.writes = 0
+        self.latency_total_ms = 0
+        self.latency_max_ms = 0
+
+    def __len__(self):
+        return sum(len(rules) for rules in self.rules.values())
+
+    def on_event(self, e, event, value, old, timestamp=None):
+        ''' 'timestamp' is the time of the edge that caused the event '''
+        for rule in self.rules.get(e, []):
+            if not rule.matches(event, value, old):
+                continue
+
+            edge = timestamp if timestamp is not None else now_ms()
+            target = rule.target
+            logger.debug("rule {}: {} {} -> {} {}".format(rule, e.entity_name, event, target.entity_name, rule.action))
+            if not target.command(rule.action):
+                logger.warning("rule {}: action {} not supported by {}".format(rule, rule.action, target.entity_name))
+                continue
+
+            rule.fired += 1
+            key = (target.gateway, target.modbus_class.data_type, target.modbus_write_address)
+            self.pending[key] = (edge, rule)
+
+    def on_written(self, gateway, data_type, address, count):
+        if len(self.pending) == 0:
+            return
+        timestamp = now_ms()
+        for offset in range(count):
+            pending = self.pending.pop((gateway, data_type, address+offset), None)
+            if pending is None:
+                continue
+            edge, rule = pending
+            latency_ms = timestamp - edge
+            self.writes += 1
+            self.latency_total_ms += latency_ms
+            self.latency_max_ms = max(self.latency_max_ms, latency_ms)
+            logger.info("rule {}: written {}ms after the edge".format(rule, latency_ms))
+
+    def stats(self):
+        return {
+            "rules": len(self),
+            "writes": self.writes,
+            "avg_latency_ms": self.latency_total_ms//self.writes if self.writes > 0 else 0,
+            "max_latency_ms": self.latency_max_ms
+        }
+
+    @staticmethod
+    def build(rule_defs, gateways):
+        '''
+        rules from the config entries (dicts of the rule attributes), entities are
+        referred to as '<set_id>/<unique id>' on any of the gateways
+        '''
+        entities = {
+            "{}/{}".format(eset.name, e.discovery_uid): e
+            for gw in gateways for eset in gw.entity_sets for e in eset
+        }
+
+        def lookup(name, ref):
+            if ref not in entities:
+                raise Exception("rule {}: unknown entity {}, expected <set_id>/<unique id>".format(name, ref))
+            return entities[ref]
+
+        rules = []
+        for idx, rule_def in enumerate(rule_defs):
+            name = rule_def.get("name") or "rule{}".format(idx)
+            count = rule_def.get("count")
+            threshold = rule_def.get("threshold")
+            rules.append(Rule(
+                name,
+                lookup(name, rule_def.get("when")),
+                rule_def.get("event"),
+                lookup(name, rule_def.get("then")),
+                rule_def.get("action"),
+                count=int(count) if count not in (None, "") else None,
+                threshold=float(threshold) if threshold not in (None, "") else None
+            ))
+            logger.info("rule {}: {}".format(name, rule_def))
+        return RuleEngine(rules)
@@ -1,43 +1,47 @@
-from entity import ModbusClass, BlindEntity, BinarySensorEntity, ButtonEntity, RelayEntity, SensorEntity
-from gateway import Gateway
-from config import ENTITY_SETS, DEVICE
+from gateway import Gateway, discovery_publisher, dump_trace, outbound
+from config import DEVICES, RULES
+from metrics import MetricsServer, prometheus, publish_periodically
+from reloader import ConfigReloader, register_set
+import config
 
-import time
-from config import text_to_dict
-import logging
+import asyncio
+import signal
 
-entity_classes = {
-    "binary_sensor": BinarySensorEntity,
-    "button": ButtonEntity,
-    "blind": BlindEntity,
-    "relay": RelayEntity,
-    "sensor": SensorEntity
-}
+# one gateway object per device
+gateways = []
+for dev in DEVICES:
+    gw = Gateway(
+        dev["device"],
+        name=dev["name"],
+        modbus_host=dev["modbus_host"],
+        modbus_port=dev["modbus_port"],
+        transport=dev["transport"],
+        pipeline_depth=dev["pipeline_depth"],
+        failover_transport=dev["failover_transport"],
+        timeout_ms=dev["timeout_ms"],
+        availability_topic=dev["availability_topic"]
+    )
 
-# the gateway object
-gw = Gateway(DEVICE)
+    # register all entity sets
+    [ register_set(gw, eset) for eset in dev["entity_sets"] ]
+    gateways.append(gw)
 
-# register all entity sets
-[
-    gw.register_entity_set(
-        ModbusClass(
-            eset.get("set_id"),
-            read_offset=eset.get("read_offset", 0),
-            write_offset=eset.get("write_offset", 0),
-            read_only=eset.get("read_only", True),
-            data_type=eset.get("data_type"),
-            data_size=eset.get("data_size", 1),
-            defaults=text_to_dict(eset.get("defaults", ""))
-        ),
-        entity_classes.get(eset.get("entity_type"), None),
-        [text_to_dict(item) for item in eset.get("entities", [])],
-        eset.get("entity_count", 0),
-        poll_delay_ms=eset.get("poll_delay_ms", 250)
-    ) for eset in ENTITY_SETS
-]
+# local rules, they may bind entities of different devices; changes of the entity sets
+# and the rules in the options file are applied while running
+reloader = ConfigReloader(gateways, config.CONFIG_PATH, DEVICES, RULES, interval_s=config.RELOAD_INTERVAL_S)
 
-# run the gateway loop
-while True:
-    gw.modbus_step()
-    time.sleep(0.005)
+async def main():
+    # kill -USR1 dumps the trace buffer
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dump_trace)
+
+    # the devices are polled in parallel, each one in its own failure domain,
+    # discovery runs next to them without delaying the first polls
+    services = [outbound.run(), discovery_publisher.run(), reloader.run()]
+    if config.METRICS_PORT > 0:
+        services.append(MetricsServer(lambda: prometheus(gateways, outbound, reloader.rules), port=config.METRICS_PORT).run())
+    if config.METRICS_INTERVAL_S > 0:
+        services.append(publish_periodically(gateways, lambda topic, payload: outbound.publish(topic, payload, retain=True), config.METRICS_INTERVAL_S*1000))
+    await asyncio.gather(*services, *[gw.run() for gw in gateways])
 
+# run the gateway loop
+asyncio.run(main())
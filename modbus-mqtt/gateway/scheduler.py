@@ -0,0 +1,292 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from tracing import tracer
+
+logger = logging.getLogger('scheduler')
+logger.setLevel(logging.INFO)
+
+
+def now_ms():
+    ''' monotonic time in ms, used for all deadlines and entity timestamps '''
+    return time.monotonic_ns() // 1000000
+
+
+def wall_ms(timestamp):
+    ''' convert a 'now_ms' timestamp to epoch time in ms '''
+    return time.time_ns() // 1000000 - (now_ms() - timestamp)
+
+
+class PollTask(object):
+    '''
+    A task polled every 'interval_ms'. With 'min_interval_ms' and 'max_interval_ms' set
+    the interval adapts: it drops to the minimum when the callback reports a change and
+    backs off towards the maximum while nothing changes. 'cost' returns the number of
+    modbus requests a run needs, tasks with a higher 'priority' get the budget first.
+    '''
+
+    BACKOFF = 1.5
+
+    def __init__(self, name, interval_ms, callback, min_interval_ms=None, max_interval_ms=None, priority=0, cost=None):
+        self.name = name
+        self.interval_ms = interval_ms
+        self.callback = callback
+        self.min_interval_ms = min_interval_ms
+        self.max_interval_ms = max_interval_ms
+        self.priority = priority
+        self.cost = cost if cost is not None else (lambda: 0)
+        self.deadline = 0
+        self.removed = False
+
+        # statistics
+        self.runs = 0
+        self.missed = 0
+        self.deferred = 0
+        self.max_lag_ms = 0
+
+    @property
+    def adaptive(self):
+        return self.min_interval_ms is not None and self.max_interval_ms is not None
+
+    def adapt(self, changed):
+        if not self.adaptive:
+            return
+
+        if changed:
+            interval_ms = self.min_interval_ms
+        else:
+            interval_ms = min(self.max_interval_ms, int(self.interval_ms*PollTask.BACKOFF)+1)
+
+        if interval_ms != self.interval_ms:
+            logger.debug("{}: poll interval {}ms -> {}ms".format(self.name, self.interval_ms, interval_ms))
+            self.interval_ms = interval_ms
+
+    def __str__(self):
+        return "PollTask(name={}, interval_ms={}, priority={}, runs={}, missed={}, deferred={}, max_lag_ms={})".format(
+            self.name,
+            self.interval_ms,
+            self.priority,
+            self.runs,
+            self.missed,
+            self.deferred,
+            self.max_lag_ms
+        )
+
+
+class Budget(object):
+    ''' token bucket limiting the number of modbus requests per second '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = now_ms()
+
+    def refill(self, timestamp):
+        self.tokens = min(self.burst, self.tokens + (timestamp - self.timestamp)*self.rate/1000)
+        self.timestamp = timestamp
+
+    def consume(self, count, timestamp):
+        ''' take 'count' tokens unconditionally, the balance may become negative '''
+        self.refill(timestamp)
+        self.tokens -= count
+
+    def try_consume(self, count, timestamp):
+        self.refill(timestamp)
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+    def delay_ms(self, count):
+        ''' time until 'count' tokens are available '''
+        return max(1, int((count - self.tokens)*1000/self.rate)+1)
+
+
+class Scheduler(object):
+    '''
+    Deadline driven scheduler: keeps a heap of the next due time of every task
+    and sleeps exactly until the earliest one. All tasks that are due at the same
+    time are started together and run concurrently, a task is never started again
+    before its previous run has finished. Timers armed on the optional 'timers'
+    heap are fired on time as well.
+
+    With 'budget_rps' set, tasks are started only while the request budget allows it,
+    due tasks are started in priority order and the others are deferred until enough
+    budget is available again.
+
+    While 'backpressure()' returns True the consumers of the poll results fall behind,
+    tasks making modbus requests are deferred by one interval unless their priority
+    is above zero.
+    '''
+
+    STATS_INTERVAL_MS = 60000
+
+    def __init__(self, name="scheduler", timers=None, budget_rps=0, backpressure=None):
+        self.name = name
+        self.timers = timers
+        self.budget = Budget(budget_rps, budget_rps/10) if budget_rps > 0 else None
+        self.backpressure = backpressure
+        self.tasks = []
+        self.queue = []
+        self.running = set()
+        self.seq = itertools.count()
+        self.wakeup = None
+
+        # statistics
+        self.ticks = 0
+        self.lag_ms = 0
+        self.max_lag_ms = 0
+        self.missed_deadlines = 0
+        self.stats_timestamp = 0
+
+        if self.timers is not None:
+            self.timers.on_arm = self.__on_timer_armed
+
+    def __on_timer_armed(self, deadline):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def next_deadline(self):
+        deadline = self.queue[0][0] if self.queue else None
+        timer_deadline = self.timers.next_deadline() if self.timers is not None else None
+        if deadline is None or (timer_deadline is not None and timer_deadline < deadline):
+            return timer_deadline
+        return deadline
+
+    def add(self, name, interval_ms, callback, **kwargs):
+        '''
+        register a coroutine function 'callback(timestamp)' to be called every 'interval_ms',
+        the callback returns True when it has seen a change (used by adaptive tasks)
+        '''
+        task = PollTask(name, interval_ms, callback, **kwargs)
+        self.tasks.append(task)
+        if self.budget is not None:
+            self.budget.burst = max(self.budget.burst, task.cost())
+        self.__push(task, now_ms())
+        return task
+
+    def remove(self, task):
+        ''' stop polling 'task', a run in progress is finished but not scheduled again '''
+        task.removed = True
+        self.tasks.remove(task)
+
+    def consume(self, count):
+        ''' account for modbus requests made outside of the scheduled tasks '''
+        if self.budget is not None:
+            self.budget.consume(count, now_ms())
+
+    def intervals(self):
+        ''' current poll interval of every task '''
+        return {task.name: task.interval_ms for task in self.tasks}
+
+    def __push(self, task, deadline):
+        task.deadline = deadline
+        heapq.heappush(self.queue, (deadline, next(self.seq), task))
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def __reschedule(self, task, timestamp):
+        if task.removed:
+            return
+        deadline = task.deadline + task.interval_ms
+        if deadline <= timestamp:
+            # the run took longer than the interval, skip the missed slots instead of bursting
+            missed = (timestamp - deadline) // max(task.interval_ms, 1) + 1
+            task.missed += missed
+            self.missed_deadlines += missed
+            deadline = timestamp
+        self.__push(task, deadline)
+
+    async def __run_task(self, task, timestamp):
+        start = tracer.begin()
+        try:
+            task.adapt(await task.callback(timestamp))
+        except Exception as e:
+            logger.exception("task {} failed: {}".format(task.name, e))
+        finally:
+            tracer.async_span(start, task.name, "{} polls".format(self.name))
+            task.runs += 1
+            self.running.discard(task)
+            self.__reschedule(task, now_ms())
+
+    async def __wait(self, timeout_ms):
+        # not using asyncio.wait_for: it can swallow a cancellation arriving together with the wakeup
+        self.wakeup.clear()
+        handle = None
+        if timeout_ms is not None:
+            handle = asyncio.get_running_loop().call_later(timeout_ms/1000, self.wakeup.set)
+        try:
+            await self.wakeup.wait()
+        finally:
+            if handle is not None:
+                handle.cancel()
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.stats_timestamp = now_ms()
+
+        while True:
+            timestamp = now_ms()
+            if self.timers is not None:
+                self.timers.run_due(timestamp)
+
+            deadline = self.next_deadline()
+            if deadline is None:
+                await self.__wait(None)
+                continue
+
+            if deadline > timestamp:
+                await self.__wait(deadline - timestamp)
+                continue
+
+            if not self.queue or self.queue[0][0] > timestamp:
+                # only timers were due
+                continue
+
+            deadline = self.queue[0][0]
+            start = tracer.begin()
+
+            # start everything that is due
+            self.ticks += 1
+            self.lag_ms = timestamp - deadline
+            self.max_lag_ms = max(self.max_lag_ms, self.lag_ms)
+            due = []
+            while self.queue and self.queue[0][0] <= timestamp:
+                deadline, _, task = heapq.heappop(self.queue)
+                if not task.removed:
+                    due.append((deadline, task))
+
+            congested = self.backpressure is not None and self.backpressure()
+            for deadline, task in sorted(due, key=lambda d: -d[1].priority):
+                if congested and task.priority <= 0 and task.cost() > 0:
+                    task.deferred += 1
+                    self.__push(task, timestamp + task.interval_ms)
+                    continue
+                if self.budget is not None:
+                    cost = task.cost()
+                    if cost > 0 and not self.budget.try_consume(cost, timestamp):
+                        task.deferred += 1
+                        self.__push(task, timestamp + self.budget.delay_ms(cost))
+                        continue
+                task.max_lag_ms = max(task.max_lag_ms, timestamp - deadline)
+                self.running.add(task)
+                asyncio.ensure_future(self.__run_task(task, timestamp))
+            tracer.span(start, "tick", self.name, {"due": len(due), "lag_ms": self.lag_ms})
+
+            if timestamp - self.stats_timestamp > Scheduler.STATS_INTERVAL_MS:
+                self.log_stats()
+                self.stats_timestamp = timestamp
+
+            # let the started tasks progress before looking at the queue again
+            await asyncio.sleep(0)
+
+    def log_stats(self):
+        logger.info("{}: ticks={}, lag_ms={}, max_lag_ms={}, missed_deadlines={}".format(
+            self.name, self.ticks, self.lag_ms, self.max_lag_ms, self.missed_deadlines))
+        for task in self.tasks:
+            logger.info("{}: {}".format(self.name, task))
+        self.max_lag_ms = 0
@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+
+import entity
+
+logger = logging.getLogger('snapshot')
+logger.setLevel(logging.INFO)
+
+MAGIC = b"MMQS"
+HEADER = struct.Struct("<4sI")
+
+
+def align(size, alignment=8):
+    return (size + alignment - 1) // alignment * alignment
+
+
+class SnapshotRegion(object):
+    ''' last published data of an entity set, laid out like 'EntitySet.previous', and a valid flag per entity '''
+
+    def __init__(self, data, valid):
+        self.data = data
+        self.valid = valid
+
+
+class Snapshot(object):
+    '''
+    Last published raw value of every entity of a device, memory mapped: storing a value
+    is a memory copy and the file survives restarts of the gateway.
+
+    The file holds a header with the layout of the entity sets as json, followed by a
+    region per set: the data block (a byte per coil, a native word per register) and a
+    byte per entity telling whether the value is valid. When the layout of the file does
+    not match the configured sets, the snapshot starts empty.
+    '''
+
+    def __init__(self, path, entity_sets):
+        self.path = path
+
+        layout = json.dumps([
+            [eset.name, eset.modbus_class.data_type, len(eset), eset.modbus_class.data_size]
+            for eset in entity_sets
+        ]).encode("utf-8")
+        header = HEADER.pack(MAGIC, len(layout)) + layout
+
+        sizes = []
+        size = align(len(header))
+        for eset in entity_sets:
+            width = 1 if eset.modbus_class.data_type == entity.TYPE_COIL else 2
+            data_size = align(len(eset)*eset.modbus_class.data_size*width)
+            sizes.append((size, data_size, width))
+            size += data_size + align(len(eset))
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.read(fd, len(header)) if os.fstat(fd).st_size == size else b""
+            if existing != header:
+                logger.info("new snapshot {} for {} entity sets".format(path, len(entity_sets)))
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.mmap[:len(header)] = header
+
+        self.regions = []
+        view = memoryview(self.mmap)
+        for eset, (offset, data_size, width) in zip(entity_sets, sizes):
+            data = view[offset:offset+len(eset)*eset.modbus_class.data_size*width]
+            valid = view[offset+data_size:offset+data_size+len(eset)]
+            self.regions.append(SnapshotRegion(data.cast('H') if width == 2 else data, valid))
+
+    def attach(self, entity_sets):
+        for eset, region in zip(entity_sets, self.regions):
+            eset.snapshot = region
+
+    def flush(self):
+        self.mmap.flush()
+
+    @staticmethod
+    def open(path, entity_sets):
+        ''' the snapshot of the entity sets, None if it can not be used '''
+        try:
+            snapshot = Snapshot(path, entity_sets)
+        except (OSError, ValueError) as e:
+            logger.warning("snapshot {} not available, starting without: {}".format(path, e))
+            return None
+        snapshot.attach(entity_sets)
+        return snapshot
+
+
+class CatchUp(object):
+    '''
+    Paced first publish of the entities after a (re)start: entities whose value differs
+    from the snapshot are queued and published at 'rate' entities per second, outputs
+    and blinds (writable sets) first, then by set priority. The current value of the
+    entity is published when its turn comes. The first entity of a catch-up waits
+    'delay_ms', so the sets polled within that time are ordered together.
+    '''
+
+    TICK_MS = 20
+
+    def __init__(self, call_at, rate, clock, delay_ms=TICK_MS):
+        self.call_at = call_at
+        self.clock = clock
+        self.delay_ms = delay_ms
+        self.interval_ms = max(CatchUp.TICK_MS, 1000/rate)
+        self.batch = max(1, round(rate*self.interval_ms/1000))
+        self.heap = []
+        self.queued = set()
+        self.seq = itertools.count()
+        self.timer = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, entity_set, idx):
+        key = (id(entity_set), idx)
+        if key in self.queued:
+            return
+        self.queued.add(key)
+        order = (0 if not entity_set.modbus_class.read_only else 1, -entity_set.priority)
+        heapq.heappush(self.heap, (order, next(self.seq), entity_set, idx))
+        if self.timer is None:
+            self.timer = self.call_at(self.clock() + self.delay_ms, self.__drain)
+
+    def __drain(self, deadline):
+        self.timer = None
+        for _ in range(min(self.batch, len(self.heap))):
+            _, _, entity_set, idx = heapq.heappop(self.heap)
+            self.queued.discard((id(entity_set), idx))
+            entity_set.catch_up(deadline, idx)
+        if self.heap:
+            self.timer = self.call_at(deadline + self.interval_ms, self.__drain)
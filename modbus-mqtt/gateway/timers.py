@@ -0,0 +1,66 @@
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger('timers')
+logger.setLevel(logging.INFO)
+
+
+class Timer(object):
+
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Timers(object):
+    '''
+    Heap of one-shot timers shared by all entities. Cancelling is O(1), cancelled
+    timers are dropped when they reach the top of the heap. The owner calls 'run_due'
+    whenever it wakes up and uses 'next_deadline' to decide how long it may sleep.
+    '''
+
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()
+        self.on_arm = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def call_at(self, deadline, callback):
+        '''
+        call 'callback(deadline)' once at 'deadline' (ms, same clock as the entity timestamps)
+        '''
+        timer = Timer(deadline, callback)
+        wake = not self.heap or deadline < self.heap[0][0]
+        heapq.heappush(self.heap, (deadline, next(self.seq), timer))
+        if wake and self.on_arm is not None:
+            self.on_arm(deadline)
+        return timer
+
+    def next_deadline(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def run_due(self, timestamp):
+        ''' fire all timers due at 'timestamp', returns the number of timers fired '''
+        fired = 0
+        while self.heap and self.heap[0][0] <= timestamp:
+            deadline, _, timer = heapq.heappop(self.heap)
+            if timer.cancelled:
+                continue
+            timer.cancelled = True
+            fired += 1
+            try:
+                timer.callback(deadline)
+            except Exception as e:
+                logger.exception("timer callback failed: {}".format(e))
+        return fired
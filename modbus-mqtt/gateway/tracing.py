@@ -0,0 +1,119 @@
+import itertools
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('tracing')
+logger.setLevel(logging.INFO)
+
+
+class Tracer(object):
+    '''
+    Span recorder for latency investigations, exported in the chrome trace format
+    (chrome://tracing, ui.perfetto.dev). The spans are kept in a ring buffer of
+    'size' entries, the oldest ones are overwritten.
+
+    Work done on the event loop without awaiting never overlaps, it is recorded with
+    'span' on one track per device. Work awaiting something (polls, reads, writes,
+    publishes) overlaps and is recorded with 'async_span'.
+
+    While disabled 'begin' returns 0 and the recording methods return right away,
+    callers pass the value of 'begin' along instead of checking 'enabled' themselves:
+
+        start = tracer.begin()
+        ...
+        tracer.span(start, "dispatch", "plc")
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.size = 0
+        self.buffer = []
+        self.index = 0
+        self.ids = itertools.count(1)
+
+    def enable(self, size=50000):
+        size = max(1, size)
+        if size != self.size:
+            self.size = size
+            self.index = 0
+            self.buffer = [None]*size
+        self.enabled = True
+        logger.info("tracing enabled, keeping the last {} spans".format(size))
+
+    def disable(self):
+        # the buffer is kept, so the spans until now can still be dumped
+        self.enabled = False
+        logger.info("tracing disabled")
+
+    def begin(self):
+        ''' start timestamp in us, 0 while disabled '''
+        return time.monotonic_ns()//1000 if self.enabled else 0
+
+    def __add(self, entry):
+        # may be called from the mqtt network thread, a lost race overwrites a single span
+        buffer = self.buffer
+        buffer[self.index % len(buffer)] = entry
+        self.index += 1
+
+    def span(self, start, name, track, args=None):
+        ''' a span from 'start' until now on 'track' '''
+        if start == 0 or not self.enabled:
+            return
+        self.__add(("X", name, track, start, time.monotonic_ns()//1000 - start, args))
+
+    def async_span(self, start, name, category, args=None):
+        ''' a span from 'start' until now that may overlap others of its 'category' '''
+        if start == 0 or not self.enabled:
+            return
+        self.__add(("b", name, category, start, time.monotonic_ns()//1000 - start, args))
+
+    def instant(self, name, track, args=None):
+        if not self.enabled:
+            return
+        self.__add(("i", name, track, time.monotonic_ns()//1000, 0, args))
+
+    def entries(self):
+        ''' the recorded spans, oldest first '''
+        buffer = list(self.buffer)
+        if self.index <= len(buffer):
+            return buffer[:self.index]
+        start = self.index % len(buffer)
+        return buffer[start:] + buffer[:start]
+
+    def chrome_trace(self):
+        ''' the spans as a chrome trace object '''
+        events = []
+        tracks = {}
+        for kind, name, track, start, duration, args in self.entries():
+            if track not in tracks:
+                tracks[track] = len(tracks) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tracks[track], "args": {"name": track}})
+            tid = tracks[track]
+            if kind == "b":
+                # async spans are a begin/end pair linked by id, shown on a track of their own
+                span_id = next(self.ids)
+                events.append({"name": name, "cat": track, "ph": "b", "id": span_id, "pid": 1, "tid": tid, "ts": start, "args": args or {}})
+                events.append({"name": name, "cat": track, "ph": "e", "id": span_id, "pid": 1, "tid": tid, "ts": start + duration})
+            elif kind == "i":
+                events.append({"name": name, "ph": "i", "s": "t", "pid": 1, "tid": tid, "ts": start, "args": args or {}})
+            else:
+                events.append({"name": name, "ph": "X", "pid": 1, "tid": tid, "ts": start, "dur": duration, "args": args or {}})
+        events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "modbus-mqtt"}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path):
+        ''' write the spans to 'path', returns the number of spans written '''
+        trace = self.chrome_trace()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as trace_file:
+            json.dump(trace, trace_file)
+        os.replace(tmp_path, path)
+        count = sum(1 for e in trace["traceEvents"] if e["ph"] != "M" and e["ph"] != "e")
+        logger.info("{} spans written to {}".format(count, path))
+        return count
+
+
+# one tracer for the whole process, disabled by default
+tracer = Tracer()
@@ -0,0 +1,294 @@
+from pymodbus.bit_write_message import *
+from pymodbus.register_write_message import *
+from pymodbus.exceptions import ModbusException, ModbusIOException, ConnectionException
+from pymodbus.pdu import ModbusResponse
+from pymodbus.client.sync import ModbusTcpClient, ModbusUdpClient
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import struct
+
+import entity
+
+logger = logging.getLogger('transport')
+logger.setLevel(logging.INFO)
+
+
+class ModbusErrorResponse(ModbusException):
+    ''' the device answered with a modbus exception code '''
+    pass
+
+class ModbusDisconnected(ModbusIOException):
+    ''' the request was in flight when its connection was dropped for another request's failure '''
+    pass
+
+def modbus_check(result):
+    if result.isError():
+        raise result if isinstance(result, ModbusException) else ModbusErrorResponse(str(result))
+    return result
+
+class RawReadResponse(ModbusResponse):
+    ''' read response keeping the raw data bytes, decoding is left to decoder.ResponseBuffer '''
+
+    def __init__(self, data=b"", **kwargs):
+        ModbusResponse.__init__(self, **kwargs)
+        self.data = data
+
+    def encode(self):
+        return bytes([len(self.data)]) + bytes(self.data)
+
+    def decode(self, data):
+        self.data = memoryview(data)[1:1+data[0]]
+
+class RawReadCoilsResponse(RawReadResponse):
+    function_code = 0x01
+
+class RawReadRegistersResponse(RawReadResponse):
+    function_code = 0x03
+
+def modbus_read(client, data_type, address, count):
+    ''' returns the raw response data: packed coils or big endian registers '''
+    if data_type == entity.TYPE_COIL:
+        return modbus_check(client.read_coils(address, count)).data
+    elif data_type == entity.TYPE_REGISTER:
+        return modbus_check(client.read_holding_registers(address, count)).data
+    else:
+        raise Exception("data type not supported: {}".format(data_type))
+
+def modbus_execute(client, request):
+    # retries are up to the connection (connection.Connection), it knows whether another attempt makes sense
+    if not client.is_socket_open():
+        client.connect()
+    return modbus_check(client.execute(request))
+
+def modbus_write_coils(client, address, data):
+    logger.info("modbus_write_coils({}, {})".format(address, data))
+
+    if isinstance(data, list):
+        request = WriteMultipleCoilsRequest(address, data)
+    else:
+        request = WriteSingleCoilRequest(address, data)
+    return modbus_execute(client, request)
+
+def modbus_write_registers(client, address, data):
+    logger.info("modbus_write_registers({}, {})".format(address, data))
+
+    if isinstance(data, list):
+        request = WriteMultipleRegistersRequest(address, data)
+    else:
+        request = WriteSingleRegisterRequest(address, data)
+    return modbus_execute(client, request)
+
+def modbus_write(client, data_type, address, data):
+    if data_type == entity.TYPE_COIL:
+        return modbus_write_coils(client, address, data)
+    elif data_type == entity.TYPE_REGISTER:
+        return modbus_write_registers(client, address, data)
+    else:
+        raise Exception("data type not supported: {}".format(data_type))
+
+
+class SyncTransport(object):
+    '''
+    Blocking pymodbus client. The client is not thread safe, so all its requests
+    go through a single worker thread and are executed one after the other.
+    '''
+
+    def __init__(self, client, name="modbus"):
+        self.client = client
+        self.client.register(RawReadCoilsResponse)
+        self.client.register(RawReadRegistersResponse)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    async def read(self, data_type, address, count):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, modbus_read, self.client, data_type, address, count)
+
+    async def write(self, data_type, address, data):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, modbus_write, self.client, data_type, address, data)
+
+    def close(self):
+        self.client.close()
+
+
+FC_READ_COILS = 0x01
+FC_READ_HOLDING_REGISTERS = 0x03
+FC_WRITE_SINGLE_COIL = 0x05
+FC_WRITE_SINGLE_REGISTER = 0x06
+FC_WRITE_MULTIPLE_COILS = 0x0F
+FC_WRITE_MULTIPLE_REGISTERS = 0x10
+
+MBAP_HEADER = struct.Struct(">HHHB")
+
+def pack_bits(bits):
+    packed = bytearray((len(bits)+7)//8)
+    for idx, bit in enumerate(bits):
+        if bit:
+            packed[idx >> 3] |= 1 << (idx & 7)
+    return bytes(packed)
+
+
+class PipelinedTcpTransport(object):
+    '''
+    Modbus TCP client keeping up to 'depth' requests in flight on a single connection,
+    responses are matched to their requests by the MBAP transaction id.
+
+    A timeout of a request sent while others were outstanding is taken as a sign that the device
+    can not handle pipelining, the transport then falls back to one request at a time.
+    With 'depth=1' the transport is serial from the start.
+    '''
+
+    def __init__(self, host, port=502, depth=4, timeout=3.0, unit=0, name="modbus"):
+        self.host = host
+        self.port = port
+        self.depth = depth
+        self.timeout = timeout
+        self.unit = unit
+        self.name = name
+
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.pending = {}
+        self.transaction_id = 0
+        self.slots = None
+        self.lock = None
+
+        # statistics
+        self.connects = 0
+        self.timeouts = 0
+
+    async def __connect(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.writer is not None:
+                return
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise ConnectionException("{}:{} {}".format(self.host, self.port, e))
+            self.connects += 1
+            self.receiver = asyncio.ensure_future(self.__receive(self.reader))
+
+    async def __receive(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(MBAP_HEADER.size)
+                transaction_id, _, length, _ = MBAP_HEADER.unpack(header)
+                pdu = await reader.readexactly(length-1)
+                future = self.pending.pop(transaction_id, None)
+                if future is not None and not future.done():
+                    future.set_result(pdu)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            reason = "{}:{} connection lost: {}".format(self.host, self.port, e)
+            self.__disconnect(reason, ConnectionException(reason))
+
+    def __disconnect(self, reason, e=None):
+        '''
+        closes the connection and fails the requests in flight, the first one with 'e' and the
+        others with ModbusDisconnected: one lost connection is one failure, not one per request
+        '''
+        if self.writer is not None:
+            self.writer.close()
+        if self.receiver is not None and self.receiver is not asyncio.current_task():
+            self.receiver.cancel()
+        self.reader = self.writer = self.receiver = None
+
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(e if e is not None else ModbusDisconnected(reason))
+                e = None
+
+    async def execute(self, pdu):
+        ''' send a request pdu and return the response pdu '''
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.depth)
+
+        async with self.slots:
+            await self.__connect()
+            connection = self.connects
+
+            self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+            transaction_id = self.transaction_id
+            future = asyncio.get_running_loop().create_future()
+            pipelined = len(self.pending) > 0
+            self.pending[transaction_id] = future
+            self.writer.write(MBAP_HEADER.pack(transaction_id, 0, len(pdu)+1, self.unit) + pdu)
+
+            try:
+                response = await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self.pending.pop(transaction_id, None)
+                if self.writer is None or self.connects != connection:
+                    # timed out together with a request that already dropped the connection
+                    raise ModbusDisconnected("{}: dropped after a timed out request".format(self.name))
+                self.timeouts += 1
+                if self.depth > 1 and pipelined:
+                    logger.warning("{}: pipelined request timed out, falling back to serial requests".format(self.name))
+                    self.depth = 1
+                    self.slots = asyncio.Semaphore(1)
+                # a late response would be matched against a reused transaction id, start over,
+                # the timeout raised below is the failure, the requests dropped with it are not
+                self.__disconnect("{}: dropped after a timed out request".format(self.name))
+                raise ModbusIOException("{}: request timed out".format(self.name))
+
+        if response[0] & 0x80:
+            raise ModbusErrorResponse("function code {:#04x}, exception code {}".format(response[0] & 0x7F, response[1]))
+        return response
+
+    async def read(self, data_type, address, count):
+        ''' returns the raw response data: packed coils or big endian registers '''
+        if data_type == entity.TYPE_COIL:
+            function_code = FC_READ_COILS
+        elif data_type == entity.TYPE_REGISTER:
+            function_code = FC_READ_HOLDING_REGISTERS
+        else:
+            raise Exception("data type not supported: {}".format(data_type))
+        response = await self.execute(struct.pack(">BHH", function_code, address, count))
+        return memoryview(response)[2:2+response[1]]
+
+    async def write(self, data_type, address, data):
+        logger.info("{}: write {}({}, {})".format(self.name, data_type, address, data))
+        if data_type == entity.TYPE_COIL:
+            if isinstance(data, list):
+                packed = pack_bits(data)
+                pdu = struct.pack(">BHHB", FC_WRITE_MULTIPLE_COILS, address, len(data), len(packed)) + packed
+            else:
+                pdu = struct.pack(">BHH", FC_WRITE_SINGLE_COIL, address, 0xFF00 if data else 0x0000)
+        elif data_type == entity.TYPE_REGISTER:
+            if isinstance(data, list):
+                pdu = struct.pack(">BHHB{}H".format(len(data)), FC_WRITE_MULTIPLE_REGISTERS, address, len(data), 2*len(data), *data)
+            else:
+                pdu = struct.pack(">BHH", FC_WRITE_SINGLE_REGISTER, address, data)
+        else:
+            raise Exception("data type not supported: {}".format(data_type))
+        return await self.execute(pdu)
+
+    def close(self):
+        self.__disconnect("{}: closed".format(self.name))
+
+
+TRANSPORTS = ["udp", "tcp", "tcp-pipelined"]
+
+def create_transports(kind, host, port=502, pipeline_depth=4, timeout=1.0, name="modbus"):
+    '''
+    read and write transport of a transport 'kind': reads use the given kind, writes go over
+    tcp, a pipelined connection carries both. The pymodbus clients make a single attempt
+    per request, a dead device blocks their worker for at most 'timeout' seconds.
+    '''
+    single_attempt = dict(timeout=timeout, retries=1, retry_on_empty=False)
+    if kind == "udp":
+        read_transport = SyncTransport(ModbusUdpClient(host, port=port, **single_attempt), name="{}-udp-read".format(name))
+    elif kind == "tcp":
+        read_transport = SyncTransport(ModbusTcpClient(host, port=port, **single_attempt), name="{}-tcp-read".format(name))
+    elif kind == "tcp-pipelined":
+        read_transport = PipelinedTcpTransport(host, port=port, depth=pipeline_depth, timeout=timeout, name=name)
+        return read_transport, read_transport
+    else:
+        raise Exception("transport not supported: {}, one of {}".format(kind, ", ".join(TRANSPORTS)))
+    return read_transport, SyncTransport(ModbusTcpClient(host, port=port, **single_attempt), name="{}-{}-write".format(name, kind))
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import threading
+
+import entity
+from metrics import Histogram
+from scheduler import now_ms
+from tracing import tracer
+
+logger = logging.getLogger('writer')
+logger.setLevel(logging.INFO)
+
+# modbus PDU limits for a single write request
+MAX_WRITE_COUNT = {
+    entity.TYPE_COIL: 1968,
+    entity.TYPE_REGISTER: 123
+}
+
+
+class WriteRun(object):
+    ''' consecutive addresses written with one modbus request '''
+
+    def __init__(self, data_type, address):
+        self.data_type = data_type
+        self.address = address
+        self.values = []
+        self.timestamps = []
+
+    def __str__(self):
+        return "WriteRun(data_type={}, address={}, values={})".format(self.data_type, self.address, self.values)
+
+
+class WriteQueue(object):
+    '''
+    Bounded write queue with a single worker per modbus connection.
+
+    'submit' may be called from any thread (e.g. the mqtt network thread). Writes arriving
+    within 'window_ms' of the first pending write are sent together: writes to the same
+    address keep only the latest value, writes to adjacent addresses are merged into one
+    multiple coils/registers request. 'execute(data_type, address, data)' is a coroutine
+    function doing the actual write, 'data' is a list for multiple writes. The optional
+    'on_written(data_type, address, count)' is called for every acknowledged request.
+    Writes submitted before the worker runs (retained commands arrive right after the
+    subscription) are kept and queued when it starts.
+    '''
+
+    STATS_INTERVAL_MS = 60000
+
+    def __init__(self, execute, window_ms=5, max_size=256, name="writer", on_written=None):
+        self.execute = execute
+        self.on_written = on_written
+        self.window_ms = window_ms
+        self.max_size = max_size
+        self.name = name
+        self.loop = None
+        self.wakeup = None
+        self.early = []
+        self.lock = threading.Lock()
+        # (data_type, address) -> (value, enqueue timestamp), insertion ordered
+        self.pending = {}
+
+        # statistics
+        self.writes = 0
+        self.requests = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency_total_ms = 0
+        self.latency_max_ms = 0
+        self.latency = Histogram()
+        self.stats_timestamp = 0
+
+    def submit(self, data_type, address, data):
+        values = data if isinstance(data, list) else [data]
+        if self.loop is None:
+            with self.lock:
+                if self.loop is None:
+                    self.early.append((data_type, address, values, now_ms()))
+                    return
+        self.loop.call_soon_threadsafe(self.__enqueue, data_type, address, values, now_ms())
+
+    def __enqueue(self, data_type, address, values, timestamp):
+        for idx, value in enumerate(values):
+            key = (data_type, address+idx)
+            if key in self.pending:
+                # only the latest value is written
+                self.coalesced += 1
+                del self.pending[key]
+            elif len(self.pending) >= self.max_size:
+                oldest = next(iter(self.pending))
+                logger.error("{}: queue full, dropping write {}".format(self.name, oldest))
+                del self.pending[oldest]
+                self.dropped += 1
+            self.pending[key] = (value, timestamp)
+        tracer.instant("queued", self.name, {"type": data_type, "address": address, "count": len(values)})
+        self.wakeup.set()
+
+    def runs(self, pending):
+        ''' group pending writes into runs of consecutive addresses '''
+        runs = []
+        current = None
+        for (data_type, address), (value, timestamp) in sorted(pending.items()):
+            if current is None \
+                    or current.data_type != data_type \
+                    or current.address+len(current.values) != address \
+                    or len(current.values) >= MAX_WRITE_COUNT[data_type]:
+                current = WriteRun(data_type, address)
+                runs.append(current)
+            current.values.append(value)
+            current.timestamps.append(timestamp)
+        return runs
+
+    async def __write(self, run):
+        data = run.values if len(run.values) > 1 else run.values[0]
+        start = tracer.begin()
+        try:
+            await self.execute(run.data_type, run.address, data)
+        except Exception as e:
+            tracer.async_span(start, "write failed", self.name, {"address": run.address, "error": str(e)})
+            self.errors += 1
+            logger.error("{}: {} failed: {}".format(self.name, run, e))
+            return
+
+        tracer.async_span(start, "write", self.name, {"type": run.data_type, "address": run.address, "count": len(run.values)})
+        timestamp = now_ms()
+        self.requests += 1
+        self.writes += len(run.values)
+        for t in run.timestamps:
+            latency = timestamp - t
+            self.latency_total_ms += latency
+            self.latency_max_ms = max(self.latency_max_ms, latency)
+            self.latency.observe(latency)
+        logger.debug("{}: {} acknowledged after {}ms".format(self.name, run, timestamp - min(run.timestamps)))
+
+        if self.on_written is not None:
+            self.on_written(run.data_type, run.address, len(run.values))
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.stats_timestamp = now_ms()
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            early, self.early = self.early, []
+        for write in early:
+            self.__enqueue(*write)
+
+        while True:
+            await self.wakeup.wait()
+            if self.window_ms > 0:
+                await asyncio.sleep(self.window_ms/1000)
+            self.wakeup.clear()
+
+            pending, self.pending = self.pending, {}
+            for run in self.runs(pending):
+                await self.__write(run)
+
+            if now_ms() - self.stats_timestamp > WriteQueue.STATS_INTERVAL_MS:
+                self.log_stats()
+                self.stats_timestamp = now_ms()
+
+    def log_stats(self):
+        logger.info("{}: writes={}, requests={}, coalesced={}, dropped={}, errors={}, avg_latency_ms={}, max_latency_ms={}".format(
+            self.name,
+            self.writes,
+            self.requests,
+            self.coalesced,
+            self.dropped,
+            self.errors,
+            self.latency_total_ms // self.writes if self.writes else 0,
+            self.latency_max_ms
+        ))
+        self.latency_max_ms = 0
@@ -0,0 +1,31 @@
+'''
+The gateway modules read their options at import: the tests run them with the default
+options of config.json, from a temporary directory, and without an mqtt broker.
+'''
+import json
+import os
+import sys
+import tempfile
+
+import paho.mqtt.client as mqtt
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+GATEWAY_DIR = os.path.join(os.path.dirname(TESTS_DIR), "gateway")
+
+if GATEWAY_DIR not in sys.path:
+    sys.path.insert(0, GATEWAY_DIR)
+
+with open(os.path.join(os.path.dirname(TESTS_DIR), "config.json")) as json_file:
+    options = json.load(json_file)["options"]
+options_path = os.path.join(tempfile.mkdtemp(prefix="modbus-mqtt-test-"), "options.json")
+with open(options_path, "w") as json_file:
+    json.dump(options, json_file)
+
+os.environ["CONFIG_PATH"] = options_path
+os.environ.setdefault("MQTT_HOST", "localhost")
+os.environ.setdefault("MQTT_USER", "")
+os.environ.setdefault("MQTT_PASSWORD", "")
+
+# the gateway module connects when it is imported, there is no broker to connect to
+mqtt.Client.connect = lambda self, *args, **kwargs: mqtt.MQTT_ERR_SUCCESS
+mqtt.Client.loop_start = lambda self: mqtt.MQTT_ERR_SUCCESS
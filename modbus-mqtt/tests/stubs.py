@@ -0,0 +1,35 @@
+import entity
+
+
+class StubGateway(entity.GatewayInterface):
+    ''' records the publishes and writes of the entities, timers are armed on 'timers' when given '''
+
+    def __init__(self, timers=None):
+        self.published = []
+        self.writes = []
+        self.timers = timers
+
+    def mqtt_publish(self, topic, payload, retain=True, event=False):
+        self.published.append((topic, payload))
+
+    def mqtt_publish_discovery(self, topic, payload):
+        pass
+
+    def mqtt_remove_discovery(self, topic):
+        pass
+
+    def mqtt_subscribe(self, topic, callback):
+        pass
+
+    def mqtt_unsubscribe(self, topic):
+        pass
+
+    def modbus_write_coils(self, address, data):
+        self.writes.append((entity.TYPE_COIL, address, data))
+
+    def modbus_write_registers(self, address, data):
+        self.writes.append((entity.TYPE_REGISTER, address, data))
+
+    def call_at(self, deadline, callback):
+        if self.timers is not None:
+            return self.timers.call_at(deadline, callback)
@@ -0,0 +1,99 @@
+import json
+import struct
+from array import array
+
+import pytest
+
+import aggregate
+from entity import BinarySensorEntity, EntitySet, ModbusClass, SensorEntity, TYPE_COIL, TYPE_REGISTER
+from scheduler import wall_ms
+from stubs import StubGateway
+
+
+def coil_set(gw, kind, names):
+    modbus_class = ModbusClass("meter", data_type=TYPE_COIL)
+    entities = [BinarySensorEntity(gw, {"name": name}, modbus_class, idx) if name else None for idx, name in enumerate(names)]
+    eset = EntitySet(modbus_class, entities)
+    eset.aggregate = aggregate.create(gw, eset, kind)
+    return eset
+
+
+def register_set(gw, kind, definitions, data_size=2):
+    modbus_class = ModbusClass("meter", data_type=TYPE_REGISTER, data_size=data_size)
+    entities = [SensorEntity(gw, definition, modbus_class, idx) if definition else None for idx, definition in enumerate(definitions)]
+    eset = EntitySet(modbus_class, entities)
+    eset.aggregate = aggregate.create(gw, eset, kind)
+    return eset
+
+
+def poll(eset, timestamp, values):
+    if eset.modbus_class.data_type == TYPE_REGISTER:
+        values = memoryview(array('H', values))
+    eset.on_modbus_data(timestamp, values, 0, 0, len(eset))
+    eset.publish_aggregate(timestamp)
+
+
+def aggregates(gw):
+    return [payload for topic, payload in gw.published if topic == "plc/meter/aggregate"]
+
+
+def test_json_values_match_state_topics():
+    gw = StubGateway()
+    eset = register_set(gw, "json", [
+        {"name": "P", "scale": "0.1"},
+        {"name": "T", "value_type": "float32", "word_order": "big"},
+        {"name": "E", "value_type": "int32"}
+    ])
+    temperature = list(struct.unpack(">2H", struct.pack(">f", 21.5)))
+    energy = list(struct.unpack("<2H", struct.pack("<i", -70000)))
+    poll(eset, 0, [1234, 0] + temperature + energy)
+
+    changed = json.loads(aggregates(gw)[0])["changed"]
+    states = {topic.split("/")[2]: payload for topic, payload in gw.published if topic.endswith("/state")}
+    assert changed == {"p": 123.4, "t": 21.5, "e": -70000}
+    assert [changed[name] for name in "pte"] == [states[name] for name in "pte"]
+
+
+def test_kinds():
+    gw = StubGateway()
+    eset = coil_set(gw, None, ["A"])
+    assert aggregate.create(gw, eset, "") is None
+    assert isinstance(aggregate.create(gw, eset, "packed"), aggregate.PackedAggregate)
+    with pytest.raises(Exception):
+        aggregate.create(gw, eset, "csv")
+    with pytest.raises(TypeError):
+        aggregate.Aggregate(gw, eset)
+
+
+def test_packed_coils():
+    gw = StubGateway()
+    eset = coil_set(gw, "packed", ["A", None, "C", "D", "E"])
+    poll(eset, 0, bytes([1, 0, 0, 1, 1]))
+    # entity i in bit i, five coils in two hex digits
+    assert aggregates(gw) == ["19"]
+
+    poll(eset, 1, bytes([1, 0, 0, 1, 1]))
+    assert aggregates(gw) == ["19"]
+    poll(eset, 2, bytes([0, 0, 1, 1, 1]))
+    assert aggregates(gw) == ["19", "1c"]
+
+
+def test_packed_registers():
+    gw = StubGateway()
+    eset = register_set(gw, "packed", [{"name": "P"}, {"name": "Q"}])
+    poll(eset, 0, [0x1234, 0x0001, 0xABCD, 0])
+    assert aggregates(gw) == ["12340001abcd0000"]
+
+
+def test_json_delta():
+    gw = StubGateway()
+    eset = register_set(gw, "json", [{"name": "P"}, None, {"name": "Q"}], data_size=1)
+    poll(eset, 1000, [1, 2, 3])
+    message = json.loads(aggregates(gw)[0])
+    assert message == {"timestamp": wall_ms(1000), "changed": {"p": 1, "q": 3}}
+
+    # unnamed points are left out, no message without a named change
+    poll(eset, 2000, [1, 5, 3])
+    assert len(aggregates(gw)) == 1
+    poll(eset, 3000, [1, 5, 4])
+    assert json.loads(aggregates(gw)[1])["changed"] == {"q": 4}
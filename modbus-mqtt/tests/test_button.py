@@ -0,0 +1,101 @@
+import json
+
+from entity import ButtonEntity, ModbusClass, TYPE_COIL
+from stubs import StubGateway
+from timers import Timers
+
+PAUSE = ButtonEntity.CLICK_PAUSE_MAX
+LONG = ButtonEntity.LONG_PRESS_MIN
+
+
+class Button(object):
+    ''' a button polled on a manual clock, 'advance' fires the due timers '''
+
+    def __init__(self):
+        self.now = 0
+        self.timers = Timers()
+        self.gateway = StubGateway(self.timers)
+        self.entity = ButtonEntity(self.gateway, {"name": "B"}, ModbusClass("di", data_type=TYPE_COIL), 0)
+        self.poll(0, False)
+
+    def poll(self, at, pressed):
+        self.advance(at)
+        self.entity.on_modbus_data(at, bytes([pressed]))
+
+    def advance(self, to):
+        while True:
+            deadline = self.timers.next_deadline()
+            if deadline is None or deadline > to:
+                break
+            self.now = deadline
+            self.timers.run_due(deadline)
+        self.now = to
+
+    def events(self):
+        return [(json.loads(payload)["event"], json.loads(payload)["value"]) for topic, payload in self.gateway.published if topic.endswith("/event")]
+
+
+def test_single_click():
+    button = Button()
+    button.poll(100, True)
+    button.poll(200, False)
+    button.advance(200 + PAUSE - 1)
+    assert button.events() == []
+    button.advance(200 + PAUSE)
+    assert button.events() == [("click", 1)]
+    assert ("plc/di/b/click", 1) in button.gateway.published
+
+
+def test_double_click():
+    button = Button()
+    button.poll(100, True)
+    button.poll(200, False)
+    button.poll(300, True)
+    button.poll(400, False)
+    button.advance(2000)
+    assert button.events() == [("click", 2)]
+
+
+def test_long_press_and_release():
+    button = Button()
+    button.poll(100, True)
+    button.advance(100 + LONG - 1)
+    assert button.events() == []
+    button.advance(100 + LONG)
+    assert button.events() == [("long", 1)]
+
+    button.poll(2000, False)
+    button.advance(5000)
+    assert button.events() == [("long", 1), ("long", "RELEASE")]
+
+
+def test_click_then_long_press():
+    button = Button()
+    button.poll(100, True)
+    button.poll(200, False)
+    button.poll(300, True)
+    button.advance(300 + LONG)
+    assert button.events() == [("long", 2)]
+
+
+def test_timer_cancelled_on_press():
+    button = Button()
+    button.poll(100, True)
+    button.poll(200, False)
+    timer = button.entity.timer
+    # pressed again within the click pause, the pause timer gives way to the long press timer
+    button.poll(200 + PAUSE - 50, True)
+    assert timer.cancelled
+    assert button.entity.timer.deadline == 200 + PAUSE - 50 + LONG
+    button.poll(200 + PAUSE, False)
+    button.advance(5000)
+    assert button.events() == [("click", 2)]
+
+
+def test_reset_cancels_timer():
+    button = Button()
+    button.poll(100, True)
+    button.entity.reset()
+    button.advance(5000)
+    assert button.events() == []
+    assert button.timers.next_deadline() is None
@@ -0,0 +1,44 @@
+import pytest
+
+from config import MQTT_AVAILABILITY_TOPIC, read_devices
+
+
+def test_single_device():
+    devices = read_devices({"modbus_host": "10.0.0.1", "entity_sets": [{"set_id": "di"}]})
+    assert len(devices) == 1
+    assert devices[0]["name"] == "plc"
+    assert devices[0]["modbus_host"] == "10.0.0.1"
+    assert devices[0]["availability_topic"] == MQTT_AVAILABILITY_TOPIC
+    assert devices[0]["entity_sets"] == [{"set_id": "di"}]
+
+
+def test_entity_sets_by_device():
+    devices = read_devices({
+        "devices": [
+            {"name": "house", "modbus_host": "10.0.0.1", "device_info": "name=House PLC,model=750-881"},
+            {"name": "garage", "modbus_host": "10.0.0.2", "transport": "tcp"}
+        ],
+        "entity_sets": [
+            {"set_id": "di", "device": "house"},
+            {"set_id": "door", "device": "garage"},
+            {"set_id": "light", "device": "house"}
+        ]
+    })
+    house, garage = devices
+    assert [eset["set_id"] for eset in house["entity_sets"]] == ["di", "light"]
+    assert [eset["set_id"] for eset in garage["entity_sets"]] == ["door"]
+    assert house["device"] == {"name": "House PLC", "model": "750-881"}
+    assert garage["availability_topic"] == "plc/garage/availability"
+    assert garage["failover_transport"] == "udp"
+
+
+def test_entity_set_without_device():
+    with pytest.raises(Exception, match="without a configured device"):
+        read_devices({"devices": [{"name": "house"}], "entity_sets": [{"set_id": "di", "device": "barn"}]})
+
+
+def test_unique_names():
+    with pytest.raises(Exception, match="device names"):
+        read_devices({"devices": [{"name": "house"}, {"name": "house"}]})
+    with pytest.raises(Exception, match="set_id"):
+        read_devices({"entity_sets": [{"set_id": "di"}, {"set_id": "di"}]})
@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+from pymodbus.exceptions import ModbusIOException
+
+import connection
+from connection import CONNECTED, DEGRADED, DOWN, Connection, Link
+from entity import TYPE_COIL
+from transport import ModbusDisconnected, ModbusErrorResponse
+
+
+class FakeTransport(object):
+    ''' answers or fails with 'error' '''
+
+    def __init__(self):
+        self.error = None
+        self.requests = 0
+
+    async def read(self, data_type, address, count):
+        self.requests += 1
+        if self.error is not None:
+            raise self.error
+        return b"\x00"
+
+    async def write(self, data_type, address, data):
+        return await self.read(data_type, address, 1)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(connection, "now_ms", lambda: now[0])
+    return now
+
+
+def connect(kinds=("tcp",), **kwargs):
+    transports = [FakeTransport() for kind in kinds]
+    links = [Link(kind, transport, transport) for kind, transport in zip(kinds, transports)]
+    states = []
+    conn = Connection(links, on_state=lambda old, new: states.append(new), **kwargs)
+    assert asyncio.run(conn.probe())
+    return conn, transports, states
+
+
+def read(conn):
+    try:
+        asyncio.run(conn.read(TYPE_COIL, 0, 1))
+    except ModbusIOException:
+        pass
+
+
+def test_state_transitions(clock):
+    conn, (transport,), states = connect(down_after=3)
+    assert conn.state == CONNECTED
+
+    transport.error = ModbusIOException("no answer")
+    read(conn)
+    assert conn.state == DEGRADED
+    transport.error = None
+    read(conn)
+    assert conn.state == CONNECTED
+
+    transport.error = ModbusIOException("no answer")
+    for i in range(3):
+        read(conn)
+    assert conn.state == DOWN
+    assert states == [CONNECTED, DEGRADED, CONNECTED, DEGRADED, DOWN]
+    assert conn.failed_requests == 4
+
+    # only probes while down
+    assert asyncio.run(conn.probe())
+    assert conn.state == DOWN
+    transport.error = None
+    clock[0] = 1500
+    assert asyncio.run(conn.probe())
+    assert conn.state == CONNECTED
+    assert conn.last_recovery_ms == 1500
+
+
+def test_exception_response_is_not_a_failure(clock):
+    conn, (transport,), states = connect()
+    transport.error = ModbusErrorResponse("illegal address")
+    with pytest.raises(ModbusErrorResponse):
+        asyncio.run(conn.read(TYPE_COIL, 0, 1))
+    assert conn.state == CONNECTED
+    assert conn.failed_requests == 0
+
+
+def test_one_failure_per_disconnect(clock):
+    conn, (transport,), states = connect(down_after=3)
+    transport.error = ModbusIOException("timed out")
+    read(conn)
+    # the requests in flight with the one that timed out
+    transport.error = ModbusDisconnected("dropped")
+    read(conn)
+    read(conn)
+    assert conn.state == DEGRADED
+    assert conn.failures == 1
+    assert conn.failed_requests == 3
+
+
+def test_write_retried_once(clock):
+    conn, (transport,), states = connect(down_after=3)
+    transport.error = ModbusIOException("no answer")
+    with pytest.raises(ModbusIOException):
+        asyncio.run(conn.write(TYPE_COIL, 0, True))
+    assert transport.requests == 1 + Connection.WRITE_ATTEMPTS
+    assert conn.failures == Connection.WRITE_ATTEMPTS
+
+
+def test_backoff(clock):
+    conn, (transport,), states = connect(down_after=1, backoff_min_ms=500, backoff_max_ms=4000)
+    assert conn.next_probe_ms(250) == 250
+
+    transport.error = ModbusIOException("no answer")
+    read(conn)
+    assert conn.state == DOWN
+    for i in range(6):
+        backoff_ms = min(4000, 500*2**i)
+        for j in range(20):
+            assert backoff_ms/2 <= conn.next_probe_ms(250) <= backoff_ms
+        asyncio.run(conn.probe())
+    assert conn.probe_failures == 6
+
+
+def test_failover_and_failback(clock):
+    conn, (tcp, udp), states = connect(kinds=("tcp", "udp"), down_after=1, failback_ms=60000)
+    assert conn.link.kind == "tcp"
+
+    tcp.error = ModbusIOException("no answer")
+    read(conn)
+    assert conn.state == DOWN
+    # PROBES_PER_LINK failed probes over tcp, then udp is tried
+    for i in range(Connection.PROBES_PER_LINK):
+        asyncio.run(conn.probe())
+    assert tcp.requests == 1 + 1 + Connection.PROBES_PER_LINK
+    assert asyncio.run(conn.probe())
+    assert udp.requests == 1
+    assert (conn.state, conn.link.kind, conn.failovers) == (CONNECTED, "udp", 1)
+
+    # the first link is probed every 'failback_ms' only
+    tcp.error = None
+    clock[0] += 59999
+    assert not asyncio.run(conn.probe())
+    clock[0] += 1
+    assert asyncio.run(conn.probe())
+    assert (conn.state, conn.link.kind, conn.failovers) == (CONNECTED, "tcp", 2)
+
@@ -0,0 +1,108 @@
+import asyncio
+
+from discovery import DiscoveryPublisher, digest
+
+
+class Broker(object):
+    ''' takes the messages while 'up' '''
+
+    def __init__(self):
+        self.up = True
+        self.messages = []
+
+    def publish(self, topic, payload):
+        if self.up:
+            self.messages.append((topic, payload))
+        return self.up
+
+
+async def settle(publisher, connect=True):
+    task = asyncio.ensure_future(publisher.run())
+    await asyncio.sleep(0)
+    if connect:
+        publisher.on_connect()
+    await asyncio.sleep(0.05)
+    return task
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_nothing_published_before_connect():
+    async def main():
+        broker = Broker()
+        publisher = DiscoveryPublisher(broker.publish, rate=0)
+        publisher.add("a/config", "A")
+        task = await settle(publisher, connect=False)
+        assert broker.messages == []
+        assert publisher.published == {}
+
+        publisher.on_connect()
+        await asyncio.sleep(0.05)
+        assert broker.messages == [("a/config", "A")]
+        assert publisher.published == {"a/config": digest("A")}
+        task.cancel()
+    run(main())
+
+
+def test_failed_publish_stays_queued(monkeypatch):
+    monkeypatch.setattr(DiscoveryPublisher, "RETRY_S", 0.01)
+
+    async def main():
+        broker = Broker()
+        broker.up = False
+        publisher = DiscoveryPublisher(broker.publish, rate=0)
+        publisher.add("a/config", "A")
+        task = await settle(publisher)
+        assert publisher.published == {}
+        assert "a/config" in publisher.queue
+
+        broker.up = True
+        await asyncio.sleep(0.05)
+        assert broker.messages == [("a/config", "A")]
+        assert publisher.published == {"a/config": digest("A")}
+        task.cancel()
+    run(main())
+
+
+def test_queued_while_disconnected():
+    async def main():
+        broker = Broker()
+        publisher = DiscoveryPublisher(broker.publish, rate=0)
+        task = await settle(publisher)
+        publisher.on_disconnect()
+        publisher.add("a/config", "A")
+        await asyncio.sleep(0.05)
+        assert broker.messages == []
+
+        publisher.on_connect()
+        await asyncio.sleep(0.05)
+        assert broker.messages == [("a/config", "A")]
+        task.cancel()
+    run(main())
+
+
+def test_unchanged_configs_skipped(tmp_path, caplog):
+    async def main():
+        cache_path = str(tmp_path / "discovery_cache.json")
+        broker = Broker()
+        publisher = DiscoveryPublisher(broker.publish, cache_path=cache_path, rate=1000)
+        publisher.add("a/config", "A")
+        publisher.add("b/config", "B")
+        task = await settle(publisher)
+        task.cancel()
+        assert len(broker.messages) == 2
+
+        # after a restart: a unchanged, b changed, c new, the retained config of d is gone
+        broker.messages = []
+        publisher = DiscoveryPublisher(broker.publish, cache_path=cache_path, rate=1000)
+        publisher.published["d/config"] = digest("D")
+        publisher.add("a/config", "A")
+        publisher.add("b/config", "B2")
+        publisher.add("c/config", "C")
+        task = await settle(publisher)
+        task.cancel()
+        assert sorted(broker.messages) == [("b/config", "B2"), ("c/config", "C"), ("d/config", "")]
+        assert "2 configs published, 1 cleared, 1 unchanged" in caplog.text
+    run(main())
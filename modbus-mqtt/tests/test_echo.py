@@ -0,0 +1,45 @@
+import asyncio
+
+from echo import EchoReader
+from entity import EntitySet, ModbusClass, TYPE_COIL
+from timers import Timers
+
+
+def coil_set(name, size, read_only=False):
+    return EntitySet(ModbusClass(name, data_type=TYPE_COIL, read_offset=100, write_offset=100, read_only=read_only), [None]*size)
+
+
+def run(timers):
+    async def main():
+        for k in range(5):
+            timers.run_due(10**12)
+            await asyncio.sleep(0)
+    asyncio.run(main())
+
+
+def test_written_range_read_back():
+    requests = []
+
+    async def read(request):
+        requests.append(request)
+
+    timers = Timers()
+    reader = EchoReader([coil_set("light", 16), coil_set("di", 16, read_only=True)], read, timers)
+    reader.on_written(TYPE_COIL, 103, 2)
+    reader.on_written(TYPE_COIL, 110, 1)
+    run(timers)
+    assert [(r.address, r.count) for r in requests] == [(103, 8)]
+    assert len(reader.tasks) == 0
+
+
+def test_failed_read_back_is_logged(caplog):
+    async def read(request):
+        raise ValueError("unexpected")
+
+    timers = Timers()
+    reader = EchoReader([coil_set("light", 16)], read, timers)
+    reader.on_written(TYPE_COIL, 100, 1)
+    run(timers)
+    assert "read after write" in caplog.text
+    assert "unexpected" in caplog.text
+    assert not reader.sets[0].reading
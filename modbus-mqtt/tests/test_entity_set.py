@@ -0,0 +1,83 @@
+from array import array
+
+from entity import BinarySensorEntity, EntitySet, ModbusClass, SensorEntity, TYPE_COIL, TYPE_REGISTER, diff_indexes
+from stubs import StubGateway
+
+
+def coil_set(gw, names):
+    modbus_class = ModbusClass("di", data_type=TYPE_COIL)
+    entities = [BinarySensorEntity(gw, {"name": name}, modbus_class, idx) if name else None for idx, name in enumerate(names)]
+    return EntitySet(modbus_class, entities)
+
+
+def states(gw):
+    return [(topic.split("/")[2], payload) for topic, payload in gw.published if topic.endswith("/state")]
+
+
+def test_first_poll_dispatches_all_named():
+    gw = StubGateway()
+    eset = coil_set(gw, ["A", None, "C"])
+    assert eset.on_modbus_data(0, bytes([0, 1, 0]), 0, 0, 3) == 3
+    assert states(gw) == [("a", "OFF"), ("c", "OFF")]
+
+
+def test_only_changed_entities_dispatched():
+    gw = StubGateway()
+    eset = coil_set(gw, ["A", "B", "C", "D"])
+    eset.on_modbus_data(0, bytes([0, 0, 0, 0]), 0, 0, 4)
+    gw.published = []
+
+    assert eset.on_modbus_data(1, bytes([0, 0, 0, 0]), 0, 0, 4) == 0
+    assert gw.published == []
+
+    assert eset.on_modbus_data(2, bytes([0, 1, 0, 1]), 0, 0, 4) == 2
+    assert states(gw) == [("b", "ON"), ("d", "ON")]
+
+
+def test_partial_read():
+    ''' a request covering entities 2 and 3 only, their data at 'offset' in the response '''
+    gw = StubGateway()
+    eset = coil_set(gw, ["A", "B", "C", "D"])
+    eset.on_modbus_data(0, bytes(4), 0, 0, 4)
+    gw.published = []
+    assert eset.on_modbus_data(1, bytes([9, 9, 1, 0]), 2, 2, 2) == 1
+    assert states(gw) == [("c", "ON")]
+
+
+def test_reset_dispatches_again():
+    gw = StubGateway()
+    eset = coil_set(gw, ["A"])
+    eset.on_modbus_data(0, bytes([1]), 0, 0, 1)
+    eset.reset()
+    gw.published = []
+    eset.on_modbus_data(1, bytes([1]), 0, 0, 1)
+    assert states(gw) == [("a", "ON")]
+
+
+def test_registers():
+    gw = StubGateway()
+    modbus_class = ModbusClass("meter", data_type=TYPE_REGISTER, data_size=2)
+    entities = [SensorEntity(gw, {"name": name}, modbus_class, idx) for idx, name in enumerate(["P", "Q"])]
+    eset = EntitySet(modbus_class, entities)
+    eset.on_modbus_data(0, memoryview(array('H', [1, 0, 2, 0])), 0, 0, 2)
+    gw.published = []
+    assert eset.on_modbus_data(1, memoryview(array('H', [1, 0, 2, 1])), 0, 0, 2) == 1
+    assert states(gw) == [("q", 65538)]
+
+
+def test_diff_indexes():
+    assert diff_indexes(bytes(8), bytes(8), 1) == []
+    assert diff_indexes(bytes([0, 1, 0, 0, 0, 0, 0, 1]), bytes(8), 1) == [1, 7]
+    assert diff_indexes(bytes([1]*8), bytes([1, 1, 0, 1, 1, 1, 1, 0]), 1) == [2, 7]
+    # items of two and four bytes, any bit of an item marks it
+    assert diff_indexes(bytes(8), bytes([0, 0, 0, 0x80, 0, 0, 0, 0]), 2) == [1]
+    assert diff_indexes(bytes(8), bytes([1, 0, 0, 0, 0, 0, 0, 0x80]), 4) == [0, 1]
+    assert diff_indexes(array('H', [1, 2, 3]), array('H', [1, 2, 4]), 2) == [2]
+
+
+def test_diff_indexes_large_block():
+    old = bytes(2000)
+    new = bytearray(old)
+    for idx in (0, 999, 1000, 1999):
+        new[idx] = 1
+    assert diff_indexes(old, new, 1) == [0, 999, 1000, 1999]
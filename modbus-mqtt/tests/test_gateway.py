@@ -0,0 +1,52 @@
+import asyncio
+
+from pymodbus.exceptions import ModbusIOException
+
+import aggregate
+from entity import EntitySet, ModbusClass, TYPE_COIL
+from gateway import Gateway
+from planner import ReadPlanner
+from stubs import StubGateway
+from transport import ModbusErrorResponse
+
+
+def coil_set(gw, name, size, read_offset):
+    eset = EntitySet(ModbusClass(name, data_type=TYPE_COIL, read_offset=read_offset), [None]*size, 100)
+    eset.aggregate = aggregate.create(gw, eset, "packed")
+    return eset
+
+
+def test_failed_request_keeps_the_group():
+    stub = StubGateway()
+    esets = [coil_set(stub, "a", 8, 0), coil_set(stub, "b", 8, 16), coil_set(stub, "c", 8, 100)]
+    group, = ReadPlanner(max_gap={TYPE_COIL: 8}).plan(esets)
+    assert [(r.address, r.count) for r in group.requests] == [(0, 24), (100, 8)]
+
+    gw = Gateway("", name="test", transport="tcp-pipelined")
+    gw.modbus_available = True
+    reads = []
+
+    async def modbus_read(data_type, address, count):
+        reads.append((address, count))
+        if count > 8:
+            raise ModbusErrorResponse("illegal data address")
+        if address == 100:
+            raise ModbusIOException("timed out")
+        return bytes([0xFF])
+    gw.modbus_read = modbus_read
+
+    process_group = gw._Gateway__process_group
+    assert asyncio.run(process_group(group, 0)) is False
+    # the merged read is split although the other request of the group failed
+    assert [(r.address, r.count) for r in group.requests] == [(0, 8), (16, 8), (100, 8)]
+
+    reads.clear()
+    assert asyncio.run(process_group(group, 1)) is True
+    assert reads == [(0, 8), (16, 8), (100, 8)]
+    assert [(r.address, r.count) for r in group.requests] == [(0, 8), (16, 8), (100, 8)]
+    # the aggregates of the sets read are published
+    assert stub.published == [("plc/a/aggregate", "ff"), ("plc/b/aggregate", "ff")]
+    assert gw.modbus_errors == 2
+
+    gw.modbus_available = False
+    assert asyncio.run(process_group(group, 2)) is False
@@ -0,0 +1,88 @@
+import asyncio
+import socket
+
+import config
+from metrics import Histogram, MetricsServer, PrometheusWriter, labels
+
+
+def test_metrics_off_by_default():
+    assert config.METRICS_PORT == 0
+
+
+def test_histogram_buckets():
+    histogram = Histogram([10, 100])
+    for value in (1, 10, 11, 100, 5000):
+        histogram.observe(value)
+    # upper bounds are inclusive, the last bucket is +Inf
+    assert histogram.counts == [2, 2, 1]
+    assert (histogram.sum, histogram.count) == (5122, 5)
+
+
+def test_histogram_quantile():
+    histogram = Histogram([10, 100])
+    assert histogram.quantile(0.5) is None
+    for value in (1, 2, 3, 50, 500):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 10
+    assert histogram.quantile(0.8) == 100
+    assert histogram.quantile(0.99) == float("inf")
+
+
+def test_labels():
+    assert labels() == ""
+    assert labels(device="plc", set='a"b') == '{device="plc",set="a\\"b"}'
+
+
+def test_exposition_format():
+    w = PrometheusWriter()
+    w.sample("polls_total", "counter", "reads", 3, device="a")
+    w.sample("depth", "gauge", "waiting", 1)
+    w.sample("polls_total", "counter", "reads", 4, device="b")
+    histogram = Histogram([10, 100])
+    histogram.observe(5)
+    histogram.observe(50)
+    w.histogram("latency_seconds", "round trip", histogram, scale=0.001, device="a")
+
+    assert w.text().split("\n") == [
+        "# HELP polls_total reads",
+        "# TYPE polls_total counter",
+        'polls_total{device="a"} 3',
+        'polls_total{device="b"} 4',
+        "# HELP depth waiting",
+        "# TYPE depth gauge",
+        "depth 1",
+        "# HELP latency_seconds round trip",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.01",device="a"} 1',
+        'latency_seconds_bucket{le="0.1",device="a"} 2',
+        'latency_seconds_bucket{le="+Inf",device="a"} 2',
+        'latency_seconds_sum{device="a"} 0.055',
+        'latency_seconds_count{device="a"} 2',
+        ""
+    ]
+
+
+def test_server():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    async def request(data):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(data)
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def main():
+        server = asyncio.ensure_future(MetricsServer(lambda: "up 1\n", host="127.0.0.1", port=port).run())
+        await asyncio.sleep(0.05)
+        try:
+            return await request(b"GET /metrics HTTP/1.1\r\n\r\n"), await request(b"POST /metrics HTTP/1.1\r\n\r\n")
+        finally:
+            server.cancel()
+
+    get, post = asyncio.run(main())
+    assert get.startswith(b"HTTP/1.0 200 OK\r\n")
+    assert get.endswith(b"\r\n\r\nup 1\n")
+    assert post.startswith(b"HTTP/1.0 405")
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+
+from outbound import OutboundQueue
+
+
+class Info(object):
+    def __init__(self, mid):
+        self.mid = mid
+
+
+class Client(object):
+    ''' records the messages handed over, acknowledged with 'ack' '''
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, retain=False):
+        self.messages.append((topic, payload, retain))
+        return Info(len(self.messages))
+
+
+def new_queue(client, **kwargs):
+    ''' a queue owned by the test thread '''
+    queue = OutboundQueue(client, **kwargs)
+    queue.start(None)
+    return queue
+
+
+def connected_queue(client, **kwargs):
+    queue = new_queue(client, **kwargs)
+    queue.on_connect()
+    return queue
+
+
+def test_states_coalesced_per_topic():
+    client = Client()
+    queue = new_queue(client, max_size=10)
+    queue.publish("a/state", "1")
+    queue.publish("b/state", "1")
+    queue.publish("a/state", "2", retain=True)
+    assert len(queue) == 2
+    assert queue.coalesced == 1
+
+    queue.on_connect()
+    # the newer payload in the place of the first one
+    assert client.messages == [("a/state", "2", True), ("b/state", "1", False)]
+
+
+def test_events_not_coalesced():
+    client = Client()
+    queue = new_queue(client, max_size=10)
+    queue.publish("a/event", "click", event=True)
+    queue.publish("a/event", "click", event=True)
+    assert len(queue) == 2
+    queue.on_connect()
+    assert client.messages == [("a/event", "click", False), ("a/event", "click", False)]
+
+
+def test_full_queue_drops_oldest_event():
+    client = Client()
+    queue = new_queue(client, max_size=3)
+    queue.publish("a/event", "1", event=True)
+    queue.publish("a/state", "ON")
+    queue.publish("a/event", "2", event=True)
+    queue.publish("a/event", "3", event=True)
+    assert queue.dropped == 1
+    queue.on_connect()
+    assert [payload for topic, payload, retain in client.messages] == ["ON", "2", "3"]
+
+
+def test_states_never_dropped():
+    client = Client()
+    queue = new_queue(client, max_size=2)
+    for k in range(5):
+        queue.publish("{}/state".format(k), "ON")
+    assert len(queue) == 5
+    assert queue.dropped == 0
+
+
+def test_inflight_limit():
+    client = Client()
+    queue = connected_queue(client, max_size=10, max_inflight=2)
+    for k in range(4):
+        queue.publish("{}/state".format(k), "ON")
+    assert len(client.messages) == 2
+    queue.on_publish(client, None, 1)
+    assert len(client.messages) == 3
+    assert len(queue) == 1
+
+
+def test_congestion():
+    client = Client()
+    queue = connected_queue(client, max_size=8, max_inflight=1)
+    for k in range(7):
+        queue.publish("{}/state".format(k), "ON")
+    # one in flight, six waiting
+    assert queue.congested and queue.is_congested()
+
+    for mid in range(1, 5):
+        queue.on_publish(client, None, mid)
+    assert len(queue) == 2
+    assert not queue.congested
+
+
+def test_no_backpressure_while_disconnected():
+    client = Client()
+    queue = new_queue(client, max_size=8)
+    for k in range(7):
+        queue.publish("{}/state".format(k), "ON")
+    assert queue.congested
+    assert not queue.is_congested()
+
+    queue.on_connect()
+    assert len(client.messages) == 7
+    assert not queue.is_congested()
+
+    queue.on_disconnect()
+    assert not queue.connected
+
+
+def test_calls_before_start_kept():
+    client = Client()
+    queue = OutboundQueue(client, max_size=10)
+    # the mqtt client thread connects and the entities publish before the loop runs
+    thread = threading.Thread(target=queue.on_connect)
+    thread.start()
+    thread.join()
+    queue.publish("a/state", "ON")
+    assert not queue.connected and len(queue) == 0
+
+    async def main():
+        runner = asyncio.ensure_future(queue.run())
+        await asyncio.sleep(0)
+        thread = threading.Thread(target=queue.publish, args=("b/state", "OFF"))
+        thread.start()
+        thread.join()
+        await asyncio.sleep(0.01)
+        runner.cancel()
+
+    asyncio.run(main())
+    assert client.messages == [("a/state", "ON", False), ("b/state", "OFF", False)]
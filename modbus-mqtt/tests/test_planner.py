@@ -0,0 +1,76 @@
+import pytest
+
+from entity import EntitySet, ModbusClass, TYPE_COIL, TYPE_REGISTER
+from planner import ReadPlanner
+
+
+def entity_set(name, size, read_offset, data_type=TYPE_COIL, data_size=1, poll_delay_ms=100, **kwargs):
+    modbus_class = ModbusClass(name, data_type=data_type, data_size=data_size, read_offset=read_offset)
+    return EntitySet(modbus_class, [None]*size, poll_delay_ms, **kwargs)
+
+
+def requests(groups):
+    return [[(r.address, r.count, [(str(s), s.offset) for s in r.slices]) for r in g.requests] for g in groups]
+
+
+def test_close_sets_merged():
+    planner = ReadPlanner(max_gap={TYPE_COIL: 32})
+    groups = planner.plan([entity_set("a", 16, 0), entity_set("b", 8, 40)])
+    assert requests(groups) == [[(0, 48, [("a[0:16]", 0), ("b[0:8]", 40)])]]
+
+
+def test_distant_sets_not_merged():
+    planner = ReadPlanner(max_gap={TYPE_COIL: 32})
+    groups = planner.plan([entity_set("a", 16, 0), entity_set("b", 8, 49)])
+    assert requests(groups) == [[(0, 16, [("a[0:16]", 0)]), (49, 8, [("b[0:8]", 0)])]]
+
+
+def test_groups_by_interval_and_type():
+    planner = ReadPlanner(max_gap={TYPE_COIL: 32, TYPE_REGISTER: 8})
+    groups = planner.plan([
+        entity_set("fast", 8, 0, poll_delay_ms=20),
+        entity_set("slow", 8, 8, poll_delay_ms=1000),
+        entity_set("reg", 4, 0, data_type=TYPE_REGISTER, poll_delay_ms=20)
+    ])
+    assert [g.interval_ms for g in groups] == [20, 1000]
+    assert requests(groups) == [
+        [(0, 8, [("fast[0:8]", 0)]), (0, 4, [("reg[0:4]", 0)])],
+        [(8, 8, [("slow[0:8]", 0)])]
+    ]
+    assert [r.data_type for r in groups[0].requests] == [TYPE_COIL, TYPE_REGISTER]
+
+
+def test_large_set_split_at_pdu_limit():
+    planner = ReadPlanner()
+    groups = planner.plan([entity_set("coils", 4500, 0), entity_set("regs", 200, 0, data_type=TYPE_REGISTER)])
+    assert [(r.address, r.count) for r in groups[0].requests] == [(0, 2000), (2000, 2000), (4000, 500), (0, 125), (125, 75)]
+
+
+def test_entities_not_split():
+    planner = ReadPlanner()
+    groups = planner.plan([entity_set("meter", 100, 1000, data_type=TYPE_REGISTER, data_size=4)])
+    # 31 entities of 4 registers fit into 125 registers
+    assert [(r.address, r.count) for r in groups[0].requests] == [(1000, 124), (1124, 124), (1248, 124), (1372, 28)]
+
+
+def test_merge_within_pdu_limit():
+    planner = ReadPlanner(max_gap={TYPE_REGISTER: 8})
+    groups = planner.plan([
+        entity_set("a", 100, 0, data_type=TYPE_REGISTER),
+        entity_set("b", 20, 100, data_type=TYPE_REGISTER),
+        entity_set("c", 10, 120, data_type=TYPE_REGISTER)
+    ])
+    assert requests(groups) == [[(0, 120, [("a[0:100]", 0), ("b[0:20]", 100)]), (120, 10, [("c[0:10]", 0)])]]
+
+
+def test_data_size_beyond_limit():
+    planner = ReadPlanner(max_count={TYPE_COIL: 2000, TYPE_REGISTER: 2})
+    with pytest.raises(Exception, match="read limit"):
+        planner.plan([entity_set("wide", 2, 0, data_type=TYPE_REGISTER, data_size=4)])
+
+
+def test_adaptive_set_planned_alone():
+    planner = ReadPlanner(max_gap={TYPE_COIL: 32})
+    groups = planner.plan([entity_set("a", 8, 0), entity_set("b", 8, 8, poll_min_ms=20, poll_max_ms=500)])
+    assert [(g.interval_ms, g.min_interval_ms, g.max_interval_ms) for g in groups] == [(100, None, None), (20, 20, 500)]
+    assert requests(groups) == [[(0, 8, [("a[0:8]", 0)])], [(8, 8, [("b[0:8]", 0)])]]
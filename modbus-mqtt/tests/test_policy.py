@@ -0,0 +1,96 @@
+from policy import PublishFilter, PublishPolicy
+from timers import Timers
+
+
+class Clock(object):
+    ''' a filter on a manual clock, 'advance' fires the due timers '''
+
+    def __init__(self, policy):
+        self.now = 0
+        self.timers = Timers()
+        self.published = []
+        self.filter = PublishFilter(policy, lambda topic, value, retain: self.published.append((self.now, value)), self.timers.call_at)
+
+    def offer(self, value, at):
+        self.advance(at)
+        self.filter.offer("state", value, True, timestamp=at)
+
+    def advance(self, to):
+        while True:
+            deadline = self.timers.next_deadline()
+            if deadline is None or deadline > to:
+                break
+            self.now = deadline
+            self.timers.run_due(deadline)
+        self.now = to
+
+
+def test_policy_from_definition():
+    assert PublishPolicy.from_definition({}, {}) is None
+    assert PublishPolicy.from_definition({"name": "P", "deadband": ""}, {}) is None
+    policy = PublishPolicy.from_definition({"deadband": "0.5"}, {"min_interval_ms": "1000", "deadband": "2"})
+    assert (policy.deadband, policy.deadband_pct, policy.min_interval_ms, policy.max_interval_ms) == (0.5, 0, 1000, 0)
+
+
+def test_within_deadband():
+    policy = PublishPolicy(deadband=0.5, deadband_pct=10)
+    assert policy.within_deadband(20, 20.4)
+    assert policy.within_deadband(20, 21.9)
+    assert not policy.within_deadband(20, 22)
+    assert not PublishPolicy(deadband=0.5).within_deadband("ON", "OFF")
+
+
+def test_deadband_settles():
+    clock = Clock(PublishPolicy(deadband=1))
+    clock.offer(20.0, 0)
+    clock.offer(20.5, 100)
+    clock.offer(21.5, 200)
+    assert clock.published == [(0, 20.0), (200, 21.5)]
+
+    clock.offer(21.8, 300)
+    clock.advance(300 + PublishPolicy.SETTLE_MS - 1)
+    assert len(clock.published) == 2
+    clock.advance(300 + PublishPolicy.SETTLE_MS)
+    assert clock.published[-1] == (300 + PublishPolicy.SETTLE_MS, 21.8)
+
+
+def test_deadband_back_at_published_value():
+    clock = Clock(PublishPolicy(deadband=1))
+    clock.offer(20.0, 0)
+    clock.offer(20.5, 100)
+    clock.offer(20.0, 200)
+    clock.advance(10*PublishPolicy.SETTLE_MS)
+    assert clock.published == [(0, 20.0)]
+
+
+def test_min_interval():
+    clock = Clock(PublishPolicy(min_interval_ms=1000))
+    clock.offer(1, 0)
+    clock.offer(2, 100)
+    clock.offer(3, 500)
+    assert clock.published == [(0, 1)]
+    clock.advance(1000)
+    assert clock.published == [(0, 1), (1000, 3)]
+    clock.offer(4, 2500)
+    assert clock.published[-1] == (2500, 4)
+
+
+def test_heartbeat():
+    clock = Clock(PublishPolicy(max_interval_ms=1000))
+    clock.offer("ON", 0)
+    clock.offer("OFF", 600)
+    clock.advance(1500)
+    assert clock.published == [(0, "ON"), (600, "OFF")]
+    clock.advance(1600)
+    assert clock.published == [(0, "ON"), (600, "OFF"), (1600, "OFF")]
+    clock.advance(2600)
+    assert clock.published[-1] == (2600, "OFF")
+
+
+def test_reset_cancels_timers():
+    clock = Clock(PublishPolicy(min_interval_ms=1000, max_interval_ms=5000))
+    clock.offer(1, 0)
+    clock.offer(2, 100)
+    clock.filter.reset()
+    clock.advance(10000)
+    assert clock.published == [(0, 1)]
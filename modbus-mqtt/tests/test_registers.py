@@ -0,0 +1,82 @@
+import struct
+from array import array
+
+import pytest
+
+from registers import RegisterBlockDecoder, ValueFormat
+
+
+def registers(fmt, value):
+    ''' the register values of 'value' packed big endian with 'fmt', high word first '''
+    data = struct.pack(">" + fmt, value)
+    return list(struct.unpack(">{}H".format(len(data)//2), data))
+
+
+def words(*values):
+    return memoryview(array('H', values))
+
+
+@pytest.mark.parametrize("word_order,byte_order,regs", [
+    ("big", "big", [0x1234, 0x5678]),
+    ("little", "big", [0x5678, 0x1234]),
+    ("big", "little", [0x3412, 0x7856]),
+    ("little", "little", [0x7856, 0x3412]),
+])
+def test_word_and_byte_orders(word_order, byte_order, regs):
+    value_format = ValueFormat("uint32", word_order, byte_order)
+    assert value_format.decode(words(*regs)) == 0x12345678
+    assert value_format.encode(0x12345678) == regs
+
+    decoder = RegisterBlockDecoder([value_format], 2)
+    assert decoder.decode(words(*regs), 0, 0, 1) == [0x12345678]
+
+
+def test_value_types():
+    assert ValueFormat("int16").decode(words(0xFFFF)) == -1
+    assert ValueFormat("uint16").decode(words(0xFFFF)) == 0xFFFF
+    assert ValueFormat("float32", "big").decode(words(*registers("f", 1.5))) == 1.5
+    assert ValueFormat("int64", "big").decode(words(*registers("q", -2))) == -2
+    assert ValueFormat("float64", "big").decode(words(*registers("d", -0.25))) == -0.25
+
+
+def test_scale_offset_precision():
+    value_format = ValueFormat("int16", scale=0.1, value_offset=-40, precision=1)
+    assert value_format.decode(words(653)) == 25.3
+    assert value_format.encode(25.3) == [653]
+
+
+def test_defaults_by_data_size():
+    assert ValueFormat.from_definition({}, {}, 1).value_type == "uint16"
+    assert ValueFormat.from_definition({}, {}, 2).value_type == "uint32"
+    assert ValueFormat.from_definition({}, {"value_type": "int16"}, 2).value_type == "int16"
+    assert ValueFormat.from_definition({"scale": "0.5"}, {"scale": "2"}, 1).scale == 0.5
+    with pytest.raises(Exception, match="registers"):
+        ValueFormat.from_definition({"value_type": "float64"}, {}, 2)
+
+
+def test_block_with_mixed_formats():
+    formats = [
+        ValueFormat("uint32", "big"),
+        None,
+        ValueFormat("float32", "little"),
+        ValueFormat("int16", "little", scale=0.5),
+        ValueFormat("uint32", "big", "little")
+    ]
+    regs = [0x0001, 0x0002, 0xAAAA, 0xBBBB]
+    f = registers("f", 3.25)
+    regs += [f[1], f[0]]
+    regs += [0xFFFE, 0x0000]
+    regs += [0x3412, 0x7856]
+    decoder = RegisterBlockDecoder(formats, 2)
+    expected = [0x00010002, None, 3.25, -1.0, 0x12345678]
+    assert decoder.decode(words(*regs), 0, 0, 5) == expected
+    assert [f.decode(words(*regs[2*i:2*i+2])) if f is not None else None for i, f in enumerate(formats)] == expected
+
+
+def test_partial_run():
+    ''' entities 1 and 2 of the set, their registers at 'offset' within the response '''
+    formats = [ValueFormat("uint16"), ValueFormat("int16"), ValueFormat("uint16", scale=10)]
+    decoder = RegisterBlockDecoder(formats, 1)
+    assert decoder.decode(words(99, 0xFFFF, 7), 1, 1, 2) == [-1, 70]
+    assert decoder.decode(words(5, 0xFFFF, 7), 0, 0, 3) == [5, -1, 70]
+    assert set(decoder.runs) == {(1, 2), (0, 3)}
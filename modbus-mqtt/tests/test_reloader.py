@@ -0,0 +1,129 @@
+import json
+
+import pytest
+
+from gateway import Gateway, discovery_publisher, router
+from reloader import ConfigReloader, SetChanges, check_set, register_set
+
+
+def relay_set(entities, **options):
+    set_config = {
+        "set_id": "light",
+        "entity_type": "relay",
+        "entity_count": len(entities),
+        "entities": ["name={}".format(name) for name in entities],
+        "data_type": "coil",
+        "read_only": False,
+        "read_offset": 100,
+        "write_offset": 100,
+        "poll_delay_ms": 750
+    }
+    set_config.update(options)
+    return set_config
+
+
+def sensor_set(entities, **options):
+    set_config = {
+        "set_id": "meter",
+        "entity_type": "sensor",
+        "entity_count": len(entities),
+        "entities": entities,
+        "data_type": "register",
+        "data_size": 2,
+        "read_offset": 200
+    }
+    set_config.update(options)
+    return set_config
+
+
+def test_changes_by_set_id():
+    old = [relay_set(["A", "B"]), sensor_set(["name=P"]), dict(relay_set(["C"]), set_id="gone")]
+    new = [
+        relay_set(["A", "X"], poll_delay_ms=500),
+        sensor_set(["name=P"], read_offset=300),
+        dict(relay_set(["D"]), set_id="added")
+    ]
+    changes = SetChanges(old, new)
+    assert changes.removed == ["gone"]
+    assert changes.added == ["added"]
+    assert changes.replaced == ["meter"]
+    assert changes.reconfigured == ["light"]
+    assert changes.entities == {"light": [1]}
+
+
+def test_unchanged_sets():
+    sets = [relay_set(["A", "B"]), sensor_set(["name=P"])]
+    changes = SetChanges(sets, json.loads(json.dumps(sets)))
+    assert (changes.removed, changes.added, changes.replaced, changes.reconfigured, changes.entities) == ([], [], [], [], {})
+
+
+def test_check_set_entity_options():
+    check_set(sensor_set(["name=P,value_type=int32,scale=0.1,word_order=big,deadband=0.5"]))
+    with pytest.raises(Exception, match="value_type"):
+        check_set(sensor_set(["name=P,value_type=foo"]))
+    with pytest.raises(Exception, match="word_order"):
+        check_set(sensor_set(["name=P,word_order=middle"]))
+    with pytest.raises(Exception, match="registers"):
+        check_set(sensor_set(["name=P,value_type=float64"]))
+    with pytest.raises(Exception):
+        check_set(sensor_set(["name=P,scale=x"]))
+    with pytest.raises(Exception):
+        check_set(sensor_set(["name=P,min_interval_ms=soon"]))
+    with pytest.raises(Exception, match="word data"):
+        check_set(sensor_set(["name=P"], data_type="coil"))
+
+
+@pytest.fixture
+def reloader(tmp_path):
+    gw = Gateway({}, name="plc")
+    entity_sets = [relay_set(["A", "B", "X"])]
+    path = tmp_path / "options.json"
+    path.write_text(json.dumps({"entity_sets": entity_sets}))
+    for set_config in entity_sets:
+        register_set(gw, set_config)
+    reloader = ConfigReloader([gw], str(path), [{"name": "plc", "entity_sets": entity_sets}], [], interval_s=0)
+    yield reloader
+    # the router and the discovery publisher are shared by all gateways
+    reloader.remove_changed(gw, SetChanges(reloader.devices["plc"]["entity_sets"], []))
+
+
+def apply(reloader, entity_sets):
+    with open(reloader.path, "w") as json_file:
+        json.dump({"entity_sets": entity_sets}, json_file)
+    return reloader.reload()
+
+
+def routes():
+    return sorted(topic for topic in router.routes if topic.startswith("plc/light/"))
+
+
+def configs():
+    return sorted(topic.split("/")[-2] for topic in discovery_publisher.configs if "/plc/" in topic)
+
+
+def test_rename_within_set(reloader):
+    # B moves from index 1 to index 0, its routes and config are registered again
+    assert apply(reloader, [relay_set(["B", "C", "X"])])
+    assert routes() == ["plc/light/b/set", "plc/light/c/set", "plc/light/x/set"]
+    assert configs() == ["b", "c", "x"]
+    eset = reloader.gateways["plc"].entity_sets[0]
+    assert [e.entity_name for e in eset] == ["B", "C", "X"]
+    assert router.routes["plc/light/b/set"].__self__ is eset.named[0]
+
+
+def test_swap(reloader):
+    assert apply(reloader, [relay_set(["B", "A", "X"])])
+    assert routes() == ["plc/light/a/set", "plc/light/b/set", "plc/light/x/set"]
+    assert configs() == ["a", "b", "x"]
+    eset = reloader.gateways["plc"].entity_sets[0]
+    assert router.routes["plc/light/a/set"].__self__ is eset.named[1]
+    assert router.routes["plc/light/b/set"].__self__ is eset.named[0]
+
+
+def test_invalid_entity_keeps_running_configuration(reloader):
+    broken = relay_set(["A", "B", "X"], entity_type="sensor", data_type="register", data_size=2)
+    broken["entities"][0] = "name=A,value_type=foo"
+    assert not apply(reloader, [broken])
+    assert routes() == ["plc/light/a/set", "plc/light/b/set", "plc/light/x/set"]
+    assert reloader.devices["plc"]["entity_sets"] == [relay_set(["A", "B", "X"])]
+    assert reloader.failures == 1
@@ -0,0 +1,100 @@
+import pytest
+
+from entity import BinarySensorEntity, EntitySet, ModbusClass, RelayEntity, TYPE_COIL
+from rules import Rule, RuleEngine
+from snapshot import SnapshotRegion
+from stubs import StubGateway
+
+
+def rule(event, **kwargs):
+    return Rule("r", None, event, None, "TOGGLE", **kwargs)
+
+
+def test_click_count():
+    assert rule("click").matches("click", 3, None)
+    assert rule("click", count=2).matches("click", 2, None)
+    assert not rule("click", count=2).matches("click", 1, None)
+    assert not rule("click").matches("long", 1, None)
+
+
+def test_long_and_release():
+    assert rule("long").matches("long", 1, None)
+    assert not rule("long").matches("long", "RELEASE", None)
+    assert not rule("long", count=2).matches("long", 1, None)
+    assert rule("release").matches("long", "RELEASE", None)
+    assert not rule("release").matches("long", 1, None)
+
+
+def test_bit_edges():
+    assert rule("on").matches("on", True, False)
+    assert not rule("on").matches("off", False, True)
+    assert rule("off").matches("off", False, True)
+    # the first value is no edge
+    assert not rule("on").matches("on", True, None)
+
+
+def test_thresholds():
+    above = rule("above", threshold=20)
+    assert above.matches("value", 21, 20)
+    assert above.matches("value", 25, 10)
+    assert not above.matches("value", 20, 10)
+    assert not above.matches("value", 30, 21)
+    assert not above.matches("value", 30, None)
+
+    below = rule("below", threshold=20)
+    assert below.matches("value", 19, 20)
+    assert not below.matches("value", 20, 25)
+    assert not below.matches("value", 10, 19)
+
+
+def test_validation():
+    with pytest.raises(Exception, match="not supported"):
+        rule("pressed")
+    with pytest.raises(Exception, match="threshold"):
+        rule("above")
+
+
+@pytest.fixture
+def bits():
+    ''' a binary sensor switching a relay on its 'on' edge, and the gateway of both '''
+    gw = StubGateway()
+    sensor = BinarySensorEntity(gw, {"name": "Door"}, ModbusClass("di", data_type=TYPE_COIL), 0)
+    relay = RelayEntity(gw, {"name": "Light"}, ModbusClass("light", data_type=TYPE_COIL, read_only=False, write_offset=100), 0)
+    eset = EntitySet(sensor.modbus_class, [sensor])
+    RuleEngine([Rule("door", sensor, "on", relay, "ON")])
+    return gw, eset
+
+
+def poll(eset, value):
+    eset.on_modbus_data(0, bytes([value]), 0, 0, 1)
+
+
+def test_edge_fires(bits):
+    gw, eset = bits
+    poll(eset, 0)
+    assert gw.writes == []
+    poll(eset, 1)
+    assert gw.writes == [(TYPE_COIL, 100, True)]
+
+
+def test_no_edge_across_restart(bits):
+    gw, eset = bits
+    # OFF was published before the restart, the door opened meanwhile
+    eset.snapshot = SnapshotRegion(bytearray([0]), bytearray([1]))
+    poll(eset, 1)
+    assert gw.writes == []
+    assert ("plc/di/door/state", "ON") in gw.published
+
+    # the next edge is a live one
+    poll(eset, 0)
+    poll(eset, 1)
+    assert gw.writes == [(TYPE_COIL, 100, True)]
+
+
+def test_edge_after_unchanged_restore(bits):
+    gw, eset = bits
+    eset.snapshot = SnapshotRegion(bytearray([0]), bytearray([1]))
+    poll(eset, 0)
+    assert gw.published == []
+    poll(eset, 1)
+    assert gw.writes == [(TYPE_COIL, 100, True)]
@@ -0,0 +1,114 @@
+import asyncio
+
+from scheduler import Budget, PollTask, Scheduler, now_ms
+from timers import Timers
+
+
+def run_for(scheduler, seconds):
+    async def main():
+        runner = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(seconds)
+        runner.cancel()
+    asyncio.run(main())
+
+
+def counting(runs, duration=0):
+    ''' a task callback appending its timestamps to 'runs' '''
+    async def callback(timestamp):
+        runs.append(timestamp)
+        if duration > 0:
+            await asyncio.sleep(duration)
+        return False
+    return callback
+
+
+def test_deadlines():
+    scheduler = Scheduler(timers=Timers())
+    fast, slow, fired = [], [], []
+    start = now_ms()
+    fast_task = scheduler.add("fast", 20, counting(fast))
+    slow_task = scheduler.add("slow", 50, counting(slow))
+    scheduler.timers.call_at(start + 30, fired.append)
+    run_for(scheduler, 0.23)
+
+    assert 8 <= len(fast) <= 12
+    assert 3 <= len(slow) <= 5
+    # never before the deadline
+    assert all(timestamp >= start + 20*i for i, timestamp in enumerate(fast))
+    assert all(timestamp >= start + 50*i for i, timestamp in enumerate(slow))
+    assert fast_task.missed == slow_task.missed == 0
+    assert fired == [start + 30]
+
+
+def test_missed_slots_skipped():
+    scheduler = Scheduler()
+    runs = []
+    task = scheduler.add("slow", 10, counting(runs, duration=0.05))
+    run_for(scheduler, 0.22)
+
+    # a late task runs again right away, but once, not once per missed slot
+    assert 3 <= len(runs) <= 5
+    assert task.missed >= 3*(len(runs) - 1)
+    assert scheduler.missed_deadlines == task.missed
+
+
+def test_adaptive_interval():
+    task = PollTask("adaptive", 50, None, min_interval_ms=10, max_interval_ms=100)
+    task.adapt(False)
+    assert task.interval_ms == 76
+    task.adapt(False)
+    assert task.interval_ms == 100
+    task.adapt(True)
+    assert task.interval_ms == 10
+    fixed = PollTask("fixed", 50, None)
+    fixed.adapt(True)
+    assert fixed.interval_ms == 50
+
+
+def test_budget():
+    budget = Budget(10, 2)
+    budget.timestamp = 0
+    assert budget.try_consume(2, 0)
+    assert not budget.try_consume(1, 50)
+    assert budget.delay_ms(1) == 51
+    assert budget.try_consume(1, 100)
+    budget.consume(3, 100)
+    assert budget.tokens == -3
+    # refilled up to the burst only
+    assert budget.try_consume(2, 1000) and budget.tokens == 0
+
+
+def test_budget_by_priority():
+    scheduler = Scheduler(budget_rps=10)
+    high, low = [], []
+    high_task = scheduler.add("high", 1000, counting(high), priority=1, cost=lambda: 1)
+    low_task = scheduler.add("low", 1000, counting(low), cost=lambda: 1)
+    run_for(scheduler, 0.05)
+    assert (len(high), len(low), low_task.deferred) == (1, 0, 1)
+
+
+def test_budget_limits_rate():
+    scheduler = Scheduler(budget_rps=100)
+    runs = []
+    task = scheduler.add("greedy", 1, counting(runs), cost=lambda: 5)
+    run_for(scheduler, 0.2)
+    # a burst of 10 requests plus 100 per second
+    assert 3 <= len(runs) <= 7
+    assert task.deferred > 0
+
+
+def test_backpressure():
+    congested = [True]
+    scheduler = Scheduler(backpressure=lambda: congested[0])
+    polled, urgent, free = [], [], []
+    polled_task = scheduler.add("polled", 20, counting(polled), cost=lambda: 1)
+    scheduler.add("urgent", 20, counting(urgent), priority=1, cost=lambda: 1)
+    scheduler.add("free", 20, counting(free))
+    run_for(scheduler, 0.07)
+
+    assert len(polled) == 0 and polled_task.deferred >= 2
+    assert len(urgent) >= 2 and len(free) >= 2
+
+    congested[0] = False
+    run_for(scheduler, 0.05)
+    assert len(polled) >= 1
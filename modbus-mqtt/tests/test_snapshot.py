@@ -0,0 +1,130 @@
+from entity import BinarySensorEntity, EntitySet, ModbusClass, TYPE_COIL, TYPE_REGISTER
+from snapshot import CatchUp, Snapshot
+from stubs import StubGateway
+from timers import Timers
+
+
+def coil_set(gw, name, names, read_only=True, priority=0):
+    modbus_class = ModbusClass(name, data_type=TYPE_COIL, read_only=read_only)
+    entities = [BinarySensorEntity(gw, {"name": n}, modbus_class, idx) for idx, n in enumerate(names)]
+    return EntitySet(modbus_class, entities, priority=priority)
+
+
+def states(gw):
+    return [(topic.split("/")[2], payload) for topic, payload in gw.published if topic.endswith("/state")]
+
+
+def restart(path, names, values, catch_up=None):
+    ''' a new gateway with the snapshot at 'path' polling 'values' once '''
+    gw = StubGateway()
+    eset = coil_set(gw, "di", names)
+    eset.catch_up_queue = catch_up
+    snapshot = Snapshot.open(path, [eset])
+    eset.on_modbus_data(0, bytes(values), 0, 0, len(values))
+    return gw, eset, snapshot
+
+
+def test_silent_restore(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    gw, eset, snapshot = restart(path, ["A", "B"], [1, 0])
+    assert states(gw) == [("a", "ON"), ("b", "OFF")]
+    assert (bytes(eset.snapshot.data), bytes(eset.snapshot.valid)) == (bytes([1, 0]), bytes([1, 1]))
+    snapshot.flush()
+
+    gw, eset, snapshot = restart(path, ["A", "B"], [1, 1])
+    # the unchanged value is taken over silently, the changed one is published
+    assert states(gw) == [("b", "ON")]
+    assert [e.state for e in eset] == [1, 1]
+
+
+def test_layout_change_invalidates(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    restart(path, ["A", "B"], [1, 0])
+    gw, eset, snapshot = restart(path, ["A", "B", "C"], [1, 0, 0])
+    assert states(gw) == [("a", "ON"), ("b", "OFF"), ("c", "OFF")]
+
+    # same size, other data type
+    modbus_class = ModbusClass("di", data_type=TYPE_REGISTER)
+    snapshot = Snapshot.open(path, [EntitySet(modbus_class, [None]*3)])
+    assert bytes(snapshot.regions[0].valid) == bytes(3)
+
+
+def test_unusable_snapshot(tmp_path):
+    gw = StubGateway()
+    assert Snapshot.open(str(tmp_path / "missing" / "snapshot.bin"), [coil_set(gw, "di", ["A"])]) is None
+
+
+class Clock(object):
+    ''' a catch-up on a manual clock, recording the (time, set, index) of every publish '''
+
+    def __init__(self, rate, delay_ms=CatchUp.TICK_MS):
+        self.now = 0
+        self.timers = Timers()
+        self.published = []
+        self.catch_up = CatchUp(self.timers.call_at, rate, lambda: self.now, delay_ms=delay_ms)
+
+    def entity_set(self, name, read_only=True, priority=0):
+        clock = self
+
+        class FakeSet(object):
+            modbus_class = ModbusClass(name, read_only=read_only)
+
+            def catch_up(self, timestamp, idx):
+                clock.published.append((timestamp, name, idx))
+
+        eset = FakeSet()
+        eset.priority = priority
+        return eset
+
+    def advance(self, to):
+        while True:
+            deadline = self.timers.next_deadline()
+            if deadline is None or deadline > to:
+                break
+            self.now = deadline
+            self.timers.run_due(deadline)
+        self.now = to
+
+
+def test_paced_at_rate():
+    clock = Clock(rate=10)
+    eset = clock.entity_set("di")
+    for idx in range(3):
+        clock.catch_up.add(eset, idx)
+    clock.catch_up.add(eset, 0)
+    assert len(clock.catch_up) == 3
+
+    clock.advance(1000)
+    assert clock.published == [(20, "di", 0), (120, "di", 1), (220, "di", 2)]
+
+    # a fast rate publishes batches every tick
+    clock = Clock(rate=200)
+    eset = clock.entity_set("di")
+    for idx in range(5):
+        clock.catch_up.add(eset, idx)
+    clock.advance(1000)
+    assert [timestamp for timestamp, name, idx in clock.published] == [20, 20, 20, 20, 40]
+
+
+def test_writable_sets_first():
+    clock = Clock(rate=1000, delay_ms=100)
+    sensors = clock.entity_set("sensors", priority=5)
+    others = clock.entity_set("others", priority=1)
+    relays = clock.entity_set("relays", read_only=False)
+    clock.catch_up.add(others, 0)
+    clock.catch_up.add(sensors, 0)
+    clock.catch_up.add(relays, 0)
+    clock.catch_up.add(sensors, 1)
+    clock.advance(1000)
+    assert [(name, idx) for timestamp, name, idx in clock.published] == [("relays", 0), ("sensors", 0), ("sensors", 1), ("others", 0)]
+
+
+def test_changed_value_caught_up(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    restart(path, ["A", "B"], [1, 0])
+    clock = Clock(rate=10)
+    gw, eset, snapshot = restart(path, ["A", "B"], [1, 1], catch_up=clock.catch_up)
+    assert states(gw) == []
+    clock.advance(1000)
+    assert states(gw) == [("b", "ON")]
+    assert bytes(eset.snapshot.data) == bytes([1, 1])
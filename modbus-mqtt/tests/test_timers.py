@@ -0,0 +1,61 @@
+from timers import Timers
+
+
+def test_fired_in_deadline_order():
+    timers = Timers()
+    fired = []
+    timers.call_at(30, lambda deadline: fired.append(("b", deadline)))
+    timers.call_at(10, lambda deadline: fired.append(("a", deadline)))
+    timers.call_at(30, lambda deadline: fired.append(("c", deadline)))
+    assert timers.next_deadline() == 10
+
+    assert timers.run_due(5) == 0
+    assert timers.run_due(30) == 3
+    assert fired == [("a", 10), ("b", 30), ("c", 30)]
+    assert timers.next_deadline() is None
+
+
+def test_cancel():
+    timers = Timers()
+    fired = []
+    first = timers.call_at(10, fired.append)
+    timers.call_at(20, fired.append)
+    first.cancel()
+    # cancelled timers are dropped when they reach the top
+    assert timers.next_deadline() == 20
+    assert len(timers) == 1
+    assert timers.run_due(100) == 1
+    assert fired == [20]
+
+
+def test_fired_once():
+    timers = Timers()
+    fired = []
+    timer = timers.call_at(10, fired.append)
+    timers.run_due(10)
+    timer.cancel()
+    timers.run_due(20)
+    assert fired == [10]
+
+
+def test_armed_earlier_wakes_owner():
+    timers = Timers()
+    armed = []
+    timers.on_arm = armed.append
+    timers.call_at(50, None)
+    timers.call_at(80, None)
+    timers.call_at(20, None)
+    assert armed == [50, 20]
+
+
+def test_failing_callback_does_not_stop_others():
+    timers = Timers()
+    fired = []
+
+    def fail(deadline):
+        raise ValueError("broken")
+
+    timers.call_at(10, fail)
+    timers.call_at(10, fired.append)
+    assert timers.run_due(10) == 2
+    assert fired == [10]
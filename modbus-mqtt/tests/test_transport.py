@@ -0,0 +1,139 @@
+import asyncio
+import struct
+
+import pytest
+from pymodbus.exceptions import ModbusIOException
+
+from connection import DEGRADED, Connection, Link
+from entity import TYPE_COIL, TYPE_REGISTER
+from transport import MBAP_HEADER, ModbusDisconnected, PipelinedTcpTransport, pack_bits
+
+
+async def read_request(reader):
+    transaction_id, _, length, _ = MBAP_HEADER.unpack(await reader.readexactly(MBAP_HEADER.size))
+    return transaction_id, await reader.readexactly(length-1)
+
+def frame(transaction_id, pdu):
+    return MBAP_HEADER.pack(transaction_id, 0, len(pdu)+1, 0) + pdu
+
+def registers_response(request):
+    ''' every register read holds its address '''
+    _, address, count = struct.unpack(">BHH", request)
+    return struct.pack(">BB{}H".format(count), 0x03, 2*count, *range(address, address+count))
+
+
+def run_with_server(handler, client):
+    ''' runs 'client(port)' against a local server calling 'handler(reader, writer)' per connection '''
+
+    async def serve(reader, writer):
+        try:
+            await handler(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(serve, "127.0.0.1", 0)
+        try:
+            return await client(server.sockets[0].getsockname()[1])
+        finally:
+            server.close()
+
+    return asyncio.run(main())
+
+
+def test_responses_matched_by_transaction_id():
+    requests = []
+
+    async def reversed_answers(reader, writer):
+        # answers every two requests in reverse order
+        while True:
+            first = await read_request(reader)
+            second = await read_request(reader)
+            requests.extend([first, second])
+            for transaction_id, pdu in [second, first]:
+                writer.write(frame(transaction_id, registers_response(pdu)))
+
+    async def client(port):
+        transport = PipelinedTcpTransport("127.0.0.1", port=port, depth=2, timeout=1.0)
+        results = await asyncio.gather(transport.read(TYPE_REGISTER, 10, 2), transport.read(TYPE_REGISTER, 20, 1))
+        transport.close()
+        return transport, [bytes(result) for result in results]
+
+    transport, results = run_with_server(reversed_answers, client)
+    assert results == [struct.pack(">2H", 10, 11), struct.pack(">H", 20)]
+    assert [transaction_id for transaction_id, pdu in requests] == [1, 2]
+    assert (transport.connects, transport.timeouts, transport.depth) == (1, 0, 2)
+
+
+def test_write_frames():
+    requests = []
+
+    async def echo(reader, writer):
+        while True:
+            transaction_id, pdu = await read_request(reader)
+            requests.append(pdu)
+            writer.write(frame(transaction_id, pdu[:5]))
+
+    async def client(port):
+        transport = PipelinedTcpTransport("127.0.0.1", port=port, depth=1, timeout=1.0)
+        await transport.write(TYPE_COIL, 3, True)
+        await transport.write(TYPE_COIL, 8, [True, False, True])
+        await transport.write(TYPE_REGISTER, 4, [1, 2])
+        transport.close()
+
+    run_with_server(echo, client)
+    assert requests == [
+        struct.pack(">BHH", 0x05, 3, 0xFF00),
+        struct.pack(">BHHB", 0x0F, 8, 3, 1) + pack_bits([True, False, True]),
+        struct.pack(">BHHB2H", 0x10, 4, 2, 4, 1, 2)
+    ]
+
+
+def test_serial_fallback():
+
+    async def serial_device(reader, writer):
+        # answers one request at a time, requests arriving meanwhile are lost
+        while True:
+            transaction_id, pdu = await read_request(reader)
+            try:
+                await asyncio.wait_for(read_request(reader), 0.05)
+            except asyncio.TimeoutError:
+                pass
+            writer.write(frame(transaction_id, registers_response(pdu)))
+
+    async def client(port):
+        transport = PipelinedTcpTransport("127.0.0.1", port=port, depth=2, timeout=0.2)
+        first = await asyncio.gather(transport.read(TYPE_REGISTER, 1, 1), transport.read(TYPE_REGISTER, 2, 1), return_exceptions=True)
+        second = await asyncio.gather(transport.read(TYPE_REGISTER, 1, 1), transport.read(TYPE_REGISTER, 2, 1), return_exceptions=True)
+        transport.close()
+        return transport, first, second
+
+    transport, first, second = run_with_server(serial_device, client)
+    assert bytes(first[0]) == struct.pack(">H", 1)
+    assert isinstance(first[1], ModbusIOException) and not isinstance(first[1], ModbusDisconnected)
+    assert transport.depth == 1
+    assert [bytes(result) for result in second] == [struct.pack(">H", 1), struct.pack(">H", 2)]
+    assert (transport.connects, transport.timeouts) == (2, 1)
+
+
+def test_timeout_counts_one_failure():
+
+    async def silent(reader, writer):
+        while True:
+            await read_request(reader)
+
+    async def client(port):
+        transport = PipelinedTcpTransport("127.0.0.1", port=port, depth=3, timeout=0.1)
+        conn = Connection([Link("tcp-pipelined", transport, transport)], down_after=3)
+        conn.state = DEGRADED
+        results = await asyncio.gather(*[conn.read(TYPE_REGISTER, address, 1) for address in range(3)], return_exceptions=True)
+        conn.close()
+        return conn, transport, results
+
+    conn, transport, results = run_with_server(silent, client)
+    assert all(isinstance(result, ModbusIOException) for result in results)
+    assert sum(isinstance(result, ModbusDisconnected) for result in results) == 2
+    assert transport.timeouts == 1
+    assert (conn.state, conn.failures, conn.failed_requests) == (DEGRADED, 1, 3)
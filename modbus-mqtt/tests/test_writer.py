@@ -0,0 +1,96 @@
+import asyncio
+
+from entity import TYPE_COIL, TYPE_REGISTER
+from writer import MAX_WRITE_COUNT, WriteQueue
+
+
+def write_all(writes, before_run=False, **kwargs):
+    '''
+    submit 'writes' (data_type, address, data) at once, while the queue runs or before
+    it is started, returns the requests and the queue
+    '''
+    requests = []
+    written = []
+
+    async def execute(data_type, address, data):
+        requests.append((data_type, address, data))
+
+    async def main():
+        queue = WriteQueue(execute, on_written=lambda *args: written.append(args), **kwargs)
+        if before_run:
+            for write in writes:
+                queue.submit(*write)
+        task = asyncio.ensure_future(queue.run())
+        await asyncio.sleep(0)
+        if not before_run:
+            for write in writes:
+                queue.submit(*write)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return queue
+
+    queue = asyncio.run(main())
+    return requests, written, queue
+
+
+def test_latest_value_per_address():
+    requests, written, queue = write_all([(TYPE_COIL, 5, True), (TYPE_COIL, 5, False)])
+    assert requests == [(TYPE_COIL, 5, False)]
+    assert queue.coalesced == 1
+
+
+def test_adjacent_addresses_merged():
+    requests, written, queue = write_all([
+        (TYPE_REGISTER, 11, 2),
+        (TYPE_REGISTER, 10, 1),
+        (TYPE_REGISTER, 12, [3, 4]),
+        (TYPE_REGISTER, 20, 9),
+        (TYPE_COIL, 12, True)
+    ])
+    assert requests == [(TYPE_COIL, 12, True), (TYPE_REGISTER, 10, [1, 2, 3, 4]), (TYPE_REGISTER, 20, 9)]
+    assert written == [(TYPE_COIL, 12, 1), (TYPE_REGISTER, 10, 4), (TYPE_REGISTER, 20, 1)]
+    assert queue.requests == 3
+    assert queue.writes == 6
+
+
+def test_writes_before_run_kept():
+    requests, written, queue = write_all([(TYPE_COIL, 5, True), (TYPE_COIL, 6, False), (TYPE_COIL, 5, False)], before_run=True)
+    assert requests == [(TYPE_COIL, 5, [False, False])]
+    assert queue.coalesced == 1
+
+
+def test_full_queue_drops_oldest():
+    requests, written, queue = write_all([(TYPE_COIL, 1, True), (TYPE_COIL, 3, True), (TYPE_COIL, 5, True)], max_size=2)
+    assert requests == [(TYPE_COIL, 3, True), (TYPE_COIL, 5, True)]
+    assert queue.dropped == 1
+
+
+def test_runs_split_at_pdu_limit():
+    queue = WriteQueue(None)
+    count = MAX_WRITE_COUNT[TYPE_REGISTER] + 10
+    runs = queue.runs({(TYPE_REGISTER, address): (address, 0) for address in range(count)})
+    assert [(run.address, len(run.values)) for run in runs] == [(0, MAX_WRITE_COUNT[TYPE_REGISTER]), (MAX_WRITE_COUNT[TYPE_REGISTER], 10)]
+
+
+def test_failed_write():
+    requests = []
+
+    async def execute(data_type, address, data):
+        requests.append(address)
+        if address == 1:
+            raise IOError("no response")
+
+    async def main():
+        queue = WriteQueue(execute)
+        task = asyncio.ensure_future(queue.run())
+        await asyncio.sleep(0)
+        queue.submit(TYPE_COIL, 1, True)
+        queue.submit(TYPE_COIL, 3, True)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return queue
+
+    queue = asyncio.run(main())
+    assert requests == [1, 3]
+    assert queue.errors == 1
+    assert queue.requests == 1